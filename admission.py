@@ -0,0 +1,208 @@
+"""
+Controle de admissão das requisições da API
+
+Recusa com 429 e Retry-After, antes de qualquer acesso ao banco:
+
+- device em loop: token bucket por device nas rotas /api/device/<id>/...
+  (ADMISSION_DEVICE_RATE requisições/s, rajadas de ADMISSION_DEVICE_BURST);
+- cliente inundando as demais rotas (frontend, gateways): token bucket
+  por endereço de origem (ADMISSION_CLIENT_RATE / ADMISSION_CLIENT_BURST).
+  Atrás de um proxy, ADMISSION_CLIENT_HEADER indica o header com o
+  endereço real (ex.: X-Forwarded-For);
+- excesso geral: no máximo ADMISSION_MAX_CONCURRENT requisições ao mesmo
+  tempo no processo;
+- esperas: long-polls e streams passam a maior parte do tempo esperando,
+  não no banco, mas cada um prende uma thread do servidor (gthread ou
+  Werkzeug) até terminar. Eles têm um limite próprio, ADMISSION_MAX_WAITING,
+  abaixo da quantidade de threads, para sempre sobrar thread para as
+  demais rotas. Sem vaga de espera, o long-poll é respondido na hora, como
+  um poll comum, e o stream recebe 429.
+
+Cada bucket ocupa uma entrada [tokens, último acesso] em um OrderedDict
+na ordem de uso. Buckets parados há mais de ADMISSION_IDLE_TTL segundos
+(já estariam cheios de novo) saem pela frente a cada acesso, e o total
+de entradas fica limitado a ADMISSION_MAX_BUCKETS: a memória não cresce
+com a quantidade de devices que já passaram pela API.
+
+Os limites valem por processo; com vários workers, divida as taxas.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+
+ADMISSION_CONTROL = os.environ.get('ADMISSION_CONTROL', '1') == '1'
+
+ADMISSION_DEVICE_RATE = float(os.environ.get('ADMISSION_DEVICE_RATE', '5'))
+ADMISSION_DEVICE_BURST = float(os.environ.get('ADMISSION_DEVICE_BURST', '20'))
+
+ADMISSION_CLIENT_RATE = float(os.environ.get('ADMISSION_CLIENT_RATE', '100'))
+ADMISSION_CLIENT_BURST = float(os.environ.get('ADMISSION_CLIENT_BURST', '200'))
+ADMISSION_CLIENT_HEADER = os.environ.get('ADMISSION_CLIENT_HEADER', '')
+
+# Requisições simultâneas no processo (0 = sem limite)
+ADMISSION_MAX_CONCURRENT = int(os.environ.get('ADMISSION_MAX_CONCURRENT', '64'))
+# Long-polls e streams simultâneos no processo (0 = sem limite); o padrão
+# é metade das threads de cada worker do serve.py (API_THREADS)
+ADMISSION_MAX_WAITING = int(os.environ.get(
+    'ADMISSION_MAX_WAITING', str(max(int(os.environ.get('API_THREADS', '32')) // 2, 1))
+))
+# Retry-After sugerido quando um limite de concorrência estoura (segundos)
+ADMISSION_BUSY_RETRY_AFTER = float(os.environ.get('ADMISSION_BUSY_RETRY_AFTER', '1'))
+
+# Entradas por conjunto de buckets e tempo parado até o descarte
+ADMISSION_MAX_BUCKETS = int(os.environ.get('ADMISSION_MAX_BUCKETS', '100000'))
+ADMISSION_IDLE_TTL = float(os.environ.get('ADMISSION_IDLE_TTL', '60'))
+
+REJECTION_MESSAGES = {
+    'device': 'Device excedeu o limite de requisições',
+    'client': 'Cliente excedeu o limite de requisições',
+    'concurrency': 'Servidor ocupado, tente novamente',
+    'waiting': 'Limite de conexões em espera atingido, tente novamente'
+}
+
+
+class TokenBuckets:
+    """Token buckets por chave, em LRU limitada e com descarte dos parados"""
+
+    def __init__(self, rate, burst, max_entries=None, idle_ttl=None):
+        self.rate = rate
+        self.burst = burst
+        self.max_entries = ADMISSION_MAX_BUCKETS if max_entries is None else max_entries
+        # Um bucket só é descartado depois de ter tido tempo de encher
+        idle_ttl = ADMISSION_IDLE_TTL if idle_ttl is None else idle_ttl
+        self.idle_ttl = max(idle_ttl, burst / rate if rate > 0 else 0)
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def take(self, key):
+        """0 se a requisição entra; senão segundos até o próximo token"""
+        if self.rate <= 0:
+            return 0.0
+
+        now = time.monotonic()
+        with self._lock:
+            self._evict(now)
+
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [self.burst, now]
+            else:
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+                self._buckets.move_to_end(key)
+
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0.0
+            return (1 - bucket[0]) / self.rate
+
+    def _evict(self, now):
+        buckets = self._buckets
+        idle_before = now - self.idle_ttl
+        while buckets:
+            key, bucket = next(iter(buckets.items()))
+            if bucket[1] > idle_before and len(buckets) < self.max_entries:
+                return
+            del buckets[key]
+            self.evictions += 1
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class ConcurrencyLimit:
+    """Contador de requisições em andamento com teto (sem fila de espera)"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self.limit > 0 and self.in_flight >= self.limit:
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+
+
+class AdmissionControl:
+    """Buckets por device e por cliente e limite global de concorrência"""
+
+    def __init__(self):
+        self.enabled = ADMISSION_CONTROL
+        self.devices = TokenBuckets(ADMISSION_DEVICE_RATE, ADMISSION_DEVICE_BURST)
+        self.clients = TokenBuckets(ADMISSION_CLIENT_RATE, ADMISSION_CLIENT_BURST)
+        self.concurrency = ConcurrencyLimit(ADMISSION_MAX_CONCURRENT)
+        self.waiting = ConcurrencyLimit(ADMISSION_MAX_WAITING)
+        self._slots = {'request': self.concurrency, 'waiting': self.waiting}
+
+    @staticmethod
+    def client_key(remote_addr, get_header):
+        """Endereço do cliente (primeiro do ADMISSION_CLIENT_HEADER, se configurado)"""
+        if ADMISSION_CLIENT_HEADER:
+            forwarded = get_header(ADMISSION_CLIENT_HEADER)
+            if forwarded:
+                return forwarded.split(',')[0].strip()
+        return remote_addr or '-'
+
+    def admit(self, device_id, client, slot='request', fallback=False):
+        """
+        Retorna (recusa, vaga ocupada)
+
+        recusa é None se a requisição entra; senão (mensagem, segundos para
+        tentar de novo). Rotas de um device contam no bucket do device; as
+        demais no do cliente.
+
+        slot é a vaga pedida: 'request' (limite de concorrência), 'waiting'
+        (limite de esperas) ou None. Com fallback=True, sem vaga de espera a
+        requisição entra com uma vaga comum e não deve esperar. A vaga
+        ocupada é devolvida com leave(vaga).
+        """
+        if device_id is not None:
+            reason, wait = 'device', self.devices.take(device_id)
+        else:
+            reason, wait = 'client', self.clients.take(client)
+
+        if not wait and slot == 'waiting' and not self.waiting.acquire():
+            if fallback:
+                slot = 'request'
+            else:
+                reason, wait = 'waiting', ADMISSION_BUSY_RETRY_AFTER
+        if not wait and slot == 'request' and not self.concurrency.acquire():
+            reason, wait = 'concurrency', ADMISSION_BUSY_RETRY_AFTER
+
+        if wait:
+            metrics.inc('device_api_admission_rejected_total', (('reason', reason),))
+            return (REJECTION_MESSAGES[reason], wait), None
+        return None, slot
+
+    def leave(self, slot):
+        if slot is not None:
+            self._slots[slot].release()
+
+    def gauges(self):
+        return [
+            ('device_api_admission_buckets', (('kind', 'device'),), len(self.devices)),
+            ('device_api_admission_buckets', (('kind', 'client'),), len(self.clients)),
+            ('device_api_admission_in_flight', (), self.concurrency.in_flight),
+            ('device_api_admission_waiting', (), self.waiting.in_flight)
+        ]
+
+
+admission = AdmissionControl()
+
+metrics.describe('device_api_admission_rejected_total', 'counter',
+                 'Requisições recusadas com 429 pelo controle de admissão')
+metrics.describe('device_api_admission_buckets', 'gauge', 'Token buckets em memória')
+metrics.describe('device_api_admission_in_flight', 'gauge', 'Requisições em andamento contadas no limite de concorrência')
+metrics.describe('device_api_admission_waiting', 'gauge', 'Long-polls e streams em andamento')
@@ -1,7 +1,56 @@
 
-from flask import Flask
+import atexit
+import os
+import time
+import zlib
+from datetime import datetime, timezone
+
+from flask import Flask, Response, g, request
 from flask_restx import Api, Resource, fields
-from models import init_db, DeviceCommand, License
+from werkzeug.http import http_date, quote_etag
+from database import close_pool
+from models import (
+    init_db, DeviceCommand, License, license_cache,
+    COMMAND_STATUSES, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+)
+import metrics
+from admission import admission
+from health import readiness
+from leases import CLAIM_LEASE_SECONDS, LEASE_MAX_SECONDS, sweeper as lease_sweeper
+from notifications import notifier
+from polling import hints as poll_hints, retry_after
+from presence import presence
+import responses
+from retention import scheduler as retention_scheduler
+from storage import (
+    ShardedStorage, close_storage, configure_storage, create_storage,
+    get_storage, sqlite_backends
+)
+
+# Engine de armazenamento: sqlite (padrão) ou memory (filas em memória
+# com write-behind para o SQLite; usar com um único processo)
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'sqlite')
+
+# Tempo máximo que uma requisição pode ficar aguardando em long-poll
+LONG_POLL_MAX_WAIT = float(os.environ.get('LONG_POLL_MAX_WAIT', '30'))
+
+# Intervalo entre heartbeats enviados nos streams SSE ociosos
+STREAM_HEARTBEAT = float(os.environ.get('STREAM_HEARTBEAT', '15'))
+
+# Reenvio ao reconectar com Last-Event-ID: só os comandos executados nos
+# últimos STREAM_REPLAY_WINDOW segundos, no máximo STREAM_REPLAY_LIMIT
+STREAM_REPLAY_WINDOW = float(os.environ.get('STREAM_REPLAY_WINDOW', '300'))
+STREAM_REPLAY_LIMIT = int(os.environ.get('STREAM_REPLAY_LIMIT', '100'))
+
+# Quantidade máxima de comandos aceitos em um único lote
+BATCH_MAX_SIZE = int(os.environ.get('BATCH_MAX_SIZE', '50000'))
+
+# Máximo de comandos por device em um claim em lote
+CLAIM_MAX_PER_DEVICE = int(os.environ.get('CLAIM_MAX_PER_DEVICE', '100'))
+
+# Por quantos segundos a contagem de comandos por status é reaproveitada
+# entre scrapes de /api/metrics
+METRICS_QUEUE_DEPTH_TTL = float(os.environ.get('METRICS_QUEUE_DEPTH_TTL', '15'))
 
 # Inicializar Flask app
 app = Flask(__name__)
@@ -15,6 +64,9 @@ api = Api(
     doc='/swagger/'  # Swagger UI estará em /swagger/
 )
 
+# Serialização JSON com o encoder rápido (orjson quando instalado)
+api.representation('application/json')(responses.output_json)
+
 # Namespace para organizar as rotas
 ns = api.namespace('api', description='Operações de comando para dispositivos')
 
@@ -24,61 +76,495 @@ command_model = api.model('Command', {
     'command': fields.String(required=True, description='Comando a ser executado')
 })
 
+batch_command_model = api.model('BatchCommand', {
+    'commands': fields.List(fields.Nested(command_model), description='Lista de pares device_id/comando'),
+    'command': fields.String(description='Comando único enviado para todos os device_ids'),
+    'device_ids': fields.List(fields.String, description='Dispositivos que recebem o comando único')
+})
+
+pending_batch_model = api.model('PendingBatch', {
+    'device_ids': fields.List(fields.String, required=True, description='Dispositivos consultados pelo gateway'),
+    'max_per_device': fields.Integer(description='Máximo de comandos por device (padrão 1)', default=1),
+    'lease': fields.Float(description='Segundos de lease: os comandos ficam in_flight até o ack')
+})
+
+ack_model = api.model('Ack', {
+    'ids': fields.List(fields.Integer, required=True, description='Ids dos comandos executados pelo device')
+})
+
 command_response = api.model('CommandResponse', {
     'id': fields.Integer(description='ID do comando'),
     'command': fields.String(description='Comando a ser executado'),
     'created_at': fields.String(description='Data de criação')
 })
 
+# Parâmetros de paginação/filtro das listagens de comandos
+list_params = {
+    'after_id': 'Cursor: next_cursor retornado pela página anterior',
+    'limit': f'Itens por página (padrão {DEFAULT_PAGE_SIZE}, máx. {MAX_PAGE_SIZE})',
+    'order': 'Ordenação por id: desc (padrão) ou asc',
+    'status': f"Filtra por status ({', '.join(COMMAND_STATUSES)})",
+    'created_from': 'Criados a partir de (ISO 8601, ex.: 2024-01-15T10:00:00; sem offset é UTC)',
+    'created_to': 'Criados até (ISO 8601)'
+}
+
+def parse_lease(value):
+    """
+    Valida o lease pedido (segundos); None usa CLAIM_LEASE_SECONDS
+
+    Retorna None para entrega imediata (sem ack).
+    """
+    if value is None:
+        return CLAIM_LEASE_SECONDS or None
+    try:
+        lease = float(value)
+    except (TypeError, ValueError):
+        api.abort(400, 'Parâmetro lease deve ser numérico')
+    if not 0 <= lease <= LEASE_MAX_SECONDS:
+        api.abort(400, f'lease deve estar entre 0 e {LEASE_MAX_SECONDS:g} segundos')
+    return lease or None
+
+def parse_list_args():
+    """Lê e valida os parâmetros de paginação/filtro da query string"""
+    args = request.args
+    filters = {}
+
+    try:
+        filters['limit'] = int(args.get('limit', DEFAULT_PAGE_SIZE))
+        if args.get('after_id') is not None:
+            filters['after_id'] = int(args['after_id'])
+    except ValueError:
+        api.abort(400, 'Parâmetros limit e after_id devem ser inteiros')
+
+    if not 1 <= filters['limit'] <= MAX_PAGE_SIZE:
+        api.abort(400, f'limit deve estar entre 1 e {MAX_PAGE_SIZE}')
+
+    filters['order'] = args.get('order', 'desc')
+    if filters['order'] not in ('asc', 'desc'):
+        api.abort(400, 'order deve ser asc ou desc')
+
+    if args.get('status') is not None:
+        if args['status'] not in COMMAND_STATUSES:
+            api.abort(400, f"status deve ser um de: {', '.join(COMMAND_STATUSES)}")
+        filters['status'] = args['status']
+
+    for name in ('created_from', 'created_to'):
+        if args.get(name) is not None:
+            try:
+                value = datetime.fromisoformat(args[name])
+            except ValueError:
+                api.abort(400, f'{name} deve estar no formato ISO 8601')
+            # CURRENT_TIMESTAMP do SQLite é UTC: converte offsets e trata
+            # valores sem offset como UTC, no mesmo formato
+            if value.tzinfo is None:
+                value = value.replace(tzinfo=timezone.utc)
+            filters[name] = value.astimezone(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+    return filters
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+# Linhas agrupadas em cada escrita da resposta em streaming
+NDJSON_CHUNK_ROWS = 500
+
+def wants_ndjson():
+    """Cliente pediu exportação em streaming (?format=ndjson ou Accept)"""
+    return (request.args.get('format') == 'ndjson'
+            or request.accept_mimetypes.best == NDJSON_MIMETYPE)
+
+def ndjson_response(rows):
+    """Resposta que escreve as linhas conforme são lidas do banco"""
+    def generate():
+        lines = []
+        for row in rows:
+            lines.append(responses.dumps(row))
+            if len(lines) >= NDJSON_CHUNK_ROWS:
+                yield b'\n'.join(lines) + b'\n'
+                lines = []
+        if lines:
+            yield b'\n'.join(lines) + b'\n'
+
+    return Response(generate(), mimetype=NDJSON_MIMETYPE)
+
+def conditional_headers(etag, last_modified):
+    """
+    Headers de cache (ETag/Last-Modified) de uma resposta
+
+    last_modified vem do banco no formato do CURRENT_TIMESTAMP (UTC).
+    """
+    headers = {'ETag': quote_etag(etag)}
+    if last_modified:
+        modified = datetime.strptime(last_modified, '%Y-%m-%d %H:%M:%S')
+        headers['Last-Modified'] = http_date(modified.replace(tzinfo=timezone.utc))
+    return headers
+
+def not_modified(etag, last_modified):
+    """Verifica If-None-Match / If-Modified-Since contra a versão atual"""
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+
+    if request.if_modified_since and last_modified:
+        modified = datetime.strptime(last_modified, '%Y-%m-%d %H:%M:%S')
+        return modified.replace(tzinfo=timezone.utc) <= request.if_modified_since
+
+    return False
+
+def not_modified_response(headers):
+    """Resposta 304 sem corpo"""
+    return Response(status=304, headers=headers)
+
 # Inicializar banco de dados
+configure_storage(create_storage(STORAGE_BACKEND))
 init_db()
 
+# No encerramento grava o write-behind pendente e fecha as conexões
+# (atexit executa na ordem inversa do registro)
+atexit.register(close_pool)
+atexit.register(close_storage)
+
+# Índice de devices com pendentes: polls vazios não acessam o banco
+presence.start()
+atexit.register(presence.stop)
+
+# Devolve à fila os comandos com lease vencido e roda a retenção automática
+# (RETENTION_INTERVAL > 0). As threads sobem em todo worker, mas só o
+# processo líder (leader.py) executa as tarefas
+lease_sweeper.start()
+atexit.register(lease_sweeper.stop)
+
+retention_scheduler.start()
+atexit.register(retention_scheduler.stop)
+
+# Snapshot periódico das métricas com vários workers (METRICS_MULTIPROC_DIR)
+metrics.snapshot_writer.start()
+atexit.register(metrics.snapshot_writer.stop)
+
+@app.before_request
+def start_request_metrics():
+    g.request_start = time.perf_counter()
+    metrics.reset_db_time()
+
+@app.after_request
+def record_request_metrics(response):
+    # Rota pelo padrão (/api/device/<string:device_id>/pending), não pela
+    # URL, para não criar uma série por device
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    labels = (('route', route), ('method', request.method))
+
+    metrics.inc('device_api_requests_total', labels + (('status', str(response.status_code)),))
+    if 'request_start' in g:
+        metrics.observe('device_api_request_duration_seconds', labels,
+                        time.perf_counter() - g.request_start)
+        metrics.observe('device_api_request_db_seconds', labels, metrics.db_time())
+    return response
+
+# Rotas fora do controle de admissão (monitoramento)
+ADMISSION_EXEMPT_ROUTES = {'/api/health', '/api/health/live', '/api/health/ready', '/api/metrics'}
+
+def is_stream():
+    return request.path.endswith('/stream')
+
+def is_long_poll():
+    return request.args.get('wait', '0') not in ('', '0')
+
+@app.before_request
+def admit_request():
+    """Recusa com 429 (token buckets / concorrência) antes de qualquer acesso ao banco"""
+    rule = request.url_rule
+    if not admission.enabled or rule is None or rule.rule in ADMISSION_EXEMPT_ROUTES \
+            or not rule.rule.startswith('/api/'):
+        return None
+
+    # Long-poll e stream prendem uma thread enquanto esperam: vaga de
+    # espera. Sem vaga, o long-poll responde na hora; o stream recebe 429
+    waits = is_stream() or is_long_poll()
+    client = admission.client_key(request.remote_addr, request.headers.get)
+    rejected, slot = admission.admit(request.view_args.get('device_id'), client,
+                                     slot='waiting' if waits else 'request',
+                                     fallback=not is_stream())
+    if rejected:
+        message, wait = rejected
+        return responses.json_response(responses.too_many_requests(message, wait), 429,
+                                       headers={'Retry-After': retry_after(wait)})
+    g.admission_slot = slot
+    g.admission_no_wait = waits and slot != 'waiting'
+    return None
+
+@app.teardown_request
+def release_admission(exc):
+    admission.leave(g.pop('admission_slot', None))
+
+def release_when_closed(events, slot):
+    """Devolve a vaga de admissão do stream só quando a conexão termina"""
+    try:
+        yield from events
+    finally:
+        admission.leave(slot)
+
+def runtime_gauges():
+    """Pool de conexões, group commit, cache de licenças e long-polls do processo"""
+    storage = get_storage()
+    backends = sqlite_backends(storage, flush=False)
+    if isinstance(storage, ShardedStorage):
+        backends.append(storage.main)
+
+    gauges = []
+    for backend in backends:
+        db = (('db', backend.pool.db_path),)
+        pool = backend.pool.stats()
+        gauges.append(('device_api_db_pool_size', db, pool['size']))
+        gauges.append(('device_api_db_pool_connections', db + (('state', 'in_use'),), pool['in_use']))
+        gauges.append(('device_api_db_pool_connections', db + (('state', 'idle'),), pool['idle']))
+
+        if backend.writer is not None:
+            writer = backend.writer.stats()
+            gauges.append(('device_api_group_commit_queued', db, writer['queued']))
+            gauges.append(('device_api_group_commit_batches_total', db, writer['batches']))
+            gauges.append(('device_api_group_commit_operations_total', db, writer['operations']))
+
+    cache = license_cache.stats()
+    gauges.append(('device_api_license_cache_entries', (), cache['size']))
+    for counter in ('hits', 'misses', 'evictions', 'expirations'):
+        gauges.append((f'device_api_license_cache_{counter}_total', (), cache[counter]))
+
+    gauges.append(('device_api_long_poll_waiters', (), notifier.waiting_count()))
+    if presence.enabled:
+        gauges.append(('device_api_presence_devices', (), len(presence)))
+    gauges.append(('device_api_poll_load', (), poll_hints.load()))
+    if admission.enabled:
+        gauges.extend(admission.gauges())
+    return gauges
+
+_queue_depth = {'expires_at': 0.0, 'gauges': []}
+
+def queue_depth_gauges():
+    """Comandos por status (lido do banco, reaproveitado por METRICS_QUEUE_DEPTH_TTL)"""
+    now = time.monotonic()
+    if now >= _queue_depth['expires_at']:
+        counts = DeviceCommand.count_by_status()
+        _queue_depth['gauges'] = [
+            ('device_api_commands', (('status', status),), count) for status, count in counts.items()
+        ]
+        _queue_depth['expires_at'] = now + METRICS_QUEUE_DEPTH_TTL
+    return _queue_depth['gauges']
+
+metrics.register_collector(runtime_gauges)
+metrics.register_collector(queue_depth_gauges, per_process=False)
+metrics.describe('device_api_db_pool_size', 'gauge', 'Tamanho máximo do pool de conexões')
+metrics.describe('device_api_db_pool_connections', 'gauge', 'Conexões do pool por estado')
+metrics.describe('device_api_group_commit_queued', 'gauge', 'Operações aguardando a thread escritora')
+metrics.describe('device_api_group_commit_batches_total', 'counter', 'Lotes gravados pelo group commit')
+metrics.describe('device_api_group_commit_operations_total', 'counter', 'Operações gravadas pelo group commit')
+metrics.describe('device_api_license_cache_entries', 'gauge', 'Entradas no cache de licenças')
+for _counter in ('hits', 'misses', 'evictions', 'expirations'):
+    metrics.describe(f'device_api_license_cache_{_counter}_total', 'counter', f'Cache de licenças: {_counter}')
+metrics.describe('device_api_long_poll_waiters', 'gauge', 'Requisições aguardando em long-poll')
+metrics.describe('device_api_presence_devices', 'gauge', 'Devices marcados no índice de presença')
+metrics.describe('device_api_poll_load', 'gauge', 'Carga usada no cálculo do next_poll (0 a 1)')
+metrics.describe('device_api_commands', 'gauge', 'Comandos por status (profundidade da fila)')
+
 @ns.route('/device/<string:device_id>/command')
 class DeviceCommandResource(Resource):
-    @api.doc('get_device_commands')
+    @api.doc('get_device_commands', params=list_params)
     def get(self, device_id):
         """
-        Lista todos os comandos de um dispositivo específico
+        Lista os comandos de um dispositivo específico
         
-        Retorna o histórico completo de comandos para o dispositivo.
+        Retorna o histórico de comandos do dispositivo, paginado por cursor:
+        use o next_cursor da resposta como after_id da próxima página.
         """
+        filters = parse_list_args()
+
         try:
-            commands = DeviceCommand.get_commands_by_device(device_id)
+            etag, last_modified = DeviceCommand.get_history_validators(device_id)
+            # Páginas e filtros diferentes são representações diferentes
+            etag = f'{etag}-{zlib.crc32(request.query_string):08x}'
+            headers = conditional_headers(etag, last_modified)
+
+            if not_modified(etag, last_modified):
+                return not_modified_response(headers)
+
+            commands, next_cursor = DeviceCommand.list_commands(device_id=device_id, **filters)
             
             return {
                 'status': 'success',
                 'data': commands,
-                'total': len(commands)
-            }
+                'total': len(commands),
+                'next_cursor': next_cursor
+            }, 200, headers
                 
         except Exception as e:
             api.abort(500, f'Erro interno: {str(e)}')
 
 @ns.route('/device/<string:device_id>/pending')
 class DevicePendingCommandResource(Resource):
-    @api.doc('get_pending_command')
+    @api.doc('get_pending_command', params={
+        'wait': f'Segundos para aguardar um comando (long-poll, máx. {LONG_POLL_MAX_WAIT:g})',
+        'lease': f'Segundos de lease (máx. {LEASE_MAX_SECONDS:g}): o comando fica in_flight até o ack'
+    })
     def get(self, device_id):
         """
         Consulta se existe comando pendente para o device
         
         Esta é a rota que cada device deve consultar periodicamente.
         Retorna o próximo comando pendente e o marca como executado.
+        Com ?wait=<segundos> a requisição aguarda a chegada de um comando
+        antes de responder vazio. Com ?lease=<segundos> o comando fica
+        in_flight e volta para a fila se o ack não chegar no prazo.
+        A resposta sugere quando consultar de novo: header Retry-After e
+        campo next_poll (segundos).
+        """
+        try:
+            wait = float(request.args.get('wait', 0))
+        except ValueError:
+            api.abort(400, 'Parâmetro wait deve ser numérico')
+
+        wait = min(max(wait, 0), LONG_POLL_MAX_WAIT)
+        if g.get('admission_no_wait'):
+            # Sem vaga de espera: responde na hora, como um poll comum
+            wait = 0
+        lease = parse_lease(request.args.get('lease'))
+
+        try:
+            if wait > 0:
+                row = DeviceCommand.wait_for_pending_row(device_id, wait, lease)
+            else:
+                row = DeviceCommand.get_pending_row(device_id, lease)
+
+            next_poll = poll_hints.next_poll(device_id, bool(row), long_poll=wait > 0)
+            headers = {'Retry-After': retry_after(next_poll)}
+
+            # Rota mais acessada: corpo montado direto da linha, sem marshalling
+            if row:
+                return responses.json_response(responses.pending_command(row, next_poll), headers=headers)
+            return responses.json_response(responses.no_pending_command(next_poll), headers=headers)
+                
+        except Exception as e:
+            api.abort(500, f'Erro interno: {str(e)}')
+
+@ns.route('/device/<string:device_id>/ack')
+class DeviceAckResource(Resource):
+    @api.doc('ack_commands')
+    @api.expect(ack_model, validate=True)
+    def post(self, device_id):
+        """
+        Device confirma a execução de comandos recebidos com lease
+        
+        Os comandos confirmados passam para executed. Ids desconhecidos, de
+        outro device ou já confirmados voltam em ignored.
         """
+        command_ids = api.payload['ids']
+        if len(command_ids) > BATCH_MAX_SIZE:
+            api.abort(400, f'Lote excede o máximo de {BATCH_MAX_SIZE} ids')
+
         try:
+            acked = DeviceCommand.ack(device_id, command_ids)
+            ignored = sorted(set(command_ids) - set(acked))
+
+            return {
+                'status': 'success',
+                'data': {'acked': acked, 'ignored': ignored},
+                'message': f'{len(acked)} comando(s) confirmado(s)'
+            }
+                
+        except Exception as e:
+            api.abort(500, f'Erro interno: {str(e)}')
+
+def _sse_event(command):
+    """Formata um comando como evento Server-Sent Events (bytes, já codificado)"""
+    return b'id: %d\nevent: command\ndata: %s\n\n' % (command['id'], responses.dumps(command))
+
+def stream_device_commands(device_id, last_event_id=None):
+    """
+    Gera os eventos SSE de um device
+
+    Reenvia o que foi entregue depois de last_event_id, esvazia a fila de
+    pendentes e então aguarda novos comandos pelo notifier, mandando
+    heartbeats para manter a conexão viva.
+    """
+    with notifier.subscribe(device_id) as event:
+        yield f"retry: {int(STREAM_HEARTBEAT * 1000)}\n\n"
+
+        if last_event_id is not None:
+            replay = DeviceCommand.get_delivered_commands_since(
+                device_id, last_event_id, STREAM_REPLAY_WINDOW, STREAM_REPLAY_LIMIT)
+            for command in replay:
+                yield _sse_event(command)
+
+        while True:
             command = DeviceCommand.get_pending_command(device_id)
-            
             if command:
-                return {
-                    'status': 'success',
-                    'data': command,
-                    'message': 'Comando encontrado'
-                }
-            else:
-                return {
-                    'status': 'success', 
-                    'data': None,
-                    'message': 'Nenhum comando pendente'
-                }
+                yield _sse_event(command)
+                continue
+
+            if not event.wait(STREAM_HEARTBEAT):
+                yield ": keep-alive\n\n"
+            event.clear()
+
+@ns.route('/device/<string:device_id>/stream')
+class DeviceStreamResource(Resource):
+    @api.doc('stream_device_commands')
+    def get(self, device_id):
+        """
+        Stream de comandos do device (Server-Sent Events)
+        
+        Mantém a conexão aberta e envia cada comando assim que ele é
+        enfileirado. Ao reconectar, o header Last-Event-ID faz o servidor
+        reenviar os comandos entregues depois daquele id.
+        """
+        last_event_id = request.headers.get('Last-Event-ID')
+        if last_event_id is not None:
+            try:
+                last_event_id = int(last_event_id)
+            except ValueError:
+                api.abort(400, 'Header Last-Event-ID deve ser o id de um comando')
+
+        events = stream_device_commands(device_id, last_event_id)
+        # A resposta sai antes do stream terminar: a vaga passa para o gerador
+        slot = g.pop('admission_slot', None)
+        if slot is not None:
+            events = release_when_closed(events, slot)
+
+        return Response(
+            events,
+            mimetype='text/event-stream',
+            headers={
+                'Cache-Control': 'no-cache',
+                'X-Accel-Buffering': 'no'
+            }
+        )
+
+@ns.route('/devices/pending')
+class DevicesPendingBatchResource(Resource):
+    @api.doc('claim_pending_commands_batch')
+    @api.expect(pending_batch_model, validate=True)
+    def post(self):
+        """
+        Consulta comandos pendentes de vários devices (usado por gateways)
+        
+        Retorna até max_per_device comandos por device, agrupados por
+        device_id, e os marca como executados em uma única transação.
+        Com lease os comandos ficam in_flight até o ack de cada device.
+        """
+        data = api.payload
+        device_ids = data['device_ids']
+        max_per_device = data.get('max_per_device', 1)
+        lease = parse_lease(data.get('lease'))
+
+        if len(device_ids) > BATCH_MAX_SIZE:
+            api.abort(400, f'Lote excede o máximo de {BATCH_MAX_SIZE} devices')
+
+        if not 1 <= max_per_device <= CLAIM_MAX_PER_DEVICE:
+            api.abort(400, f'max_per_device deve estar entre 1 e {CLAIM_MAX_PER_DEVICE}')
+
+        try:
+            commands = DeviceCommand.claim_pending_commands(device_ids, max_per_device, lease)
+            
+            return {
+                'status': 'success',
+                'data': commands,
+                'total': sum(len(items) for items in commands.values())
+            }
                 
         except Exception as e:
             api.abort(500, f'Erro interno: {str(e)}')
@@ -110,23 +596,93 @@ class CommandResource(Resource):
         except Exception as e:
             api.abort(500, f'Erro ao enviar comando: {str(e)}')
 
+@ns.route('/commands/batch')
+class BatchCommandResource(Resource):
+    @api.doc('send_commands_batch')
+    @api.expect(batch_command_model, validate=True)
+    def post(self):
+        """
+        Envia vários comandos de uma vez (usado pelo frontend)
+        
+        Aceita uma lista de pares {device_id, command} ou um único command
+        com a lista de device_ids. Tudo é gravado em uma única transação.
+        """
+        data = api.payload
+
+        if data.get('commands') is not None:
+            commands = [(item['device_id'], item['command']) for item in data['commands']]
+        elif data.get('command') and data.get('device_ids') is not None:
+            commands = [(device_id, data['command']) for device_id in data['device_ids']]
+        else:
+            api.abort(400, 'Informe commands ou command + device_ids')
+
+        if len(commands) > BATCH_MAX_SIZE:
+            api.abort(400, f'Lote excede o máximo de {BATCH_MAX_SIZE} comandos')
+
+        try:
+            command_ids = DeviceCommand.add_commands(commands)
+            
+            return {
+                'status': 'success',
+                'message': f'{len(command_ids)} comandos enviados',
+                'command_ids': command_ids
+            }
+            
+        except Exception as e:
+            api.abort(500, f'Erro ao enviar comandos: {str(e)}')
+
 @ns.route('/commands')
 class AllCommandsResource(Resource):
-    @api.doc('get_all_commands')
+    @api.doc('get_all_commands', params=dict(list_params, device_id='Filtra por dispositivo'))
     def get(self):
         """
         Lista todos os comandos (para debug/admin)
+        
+        Paginado por cursor: use o next_cursor da resposta como after_id da
+        próxima página. Com ?format=ndjson (ou Accept: application/x-ndjson)
+        exporta todo o log filtrado em streaming, uma linha JSON por comando.
         """
+        filters = parse_list_args()
+        device_id = request.args.get('device_id')
+
+        if wants_ndjson():
+            filters.pop('limit')
+            return ndjson_response(DeviceCommand.iter_commands(device_id=device_id, **filters))
+
         try:
-            commands = DeviceCommand.get_all_commands()
+            commands, next_cursor = DeviceCommand.list_commands(device_id=device_id, **filters)
             return {
                 'status': 'success',
                 'data': commands,
-                'total': len(commands)
+                'total': len(commands),
+                'next_cursor': next_cursor
             }
         except Exception as e:
             api.abort(500, f'Erro ao buscar comandos: {str(e)}')
 
+@ns.route('/licenses')
+class AllLicensesResource(Resource):
+    @api.doc('get_all_licenses', params={'format': 'ndjson para exportar em streaming'})
+    def get(self):
+        """
+        Lista todas as licenças (para debug/admin)
+        
+        Com ?format=ndjson (ou Accept: application/x-ndjson) exporta em
+        streaming, uma linha JSON por licença.
+        """
+        if wants_ndjson():
+            return ndjson_response(License.iter_licenses())
+
+        try:
+            licenses = License.get_all_licenses()
+            return {
+                'status': 'success',
+                'data': licenses,
+                'total': len(licenses)
+            }
+        except Exception as e:
+            api.abort(500, f'Erro ao buscar licenças: {str(e)}')
+
 @ns.route('/license/<string:uuid>')
 class LicenseResource(Resource):
     @api.doc('get_license_by_uuid')
@@ -140,11 +696,17 @@ class LicenseResource(Resource):
             license_data = License.get_license_by_uuid(uuid)
             
             if license_data:
+                etag, last_modified = License.get_license_validators(license_data)
+                headers = conditional_headers(etag, last_modified)
+
+                if not_modified(etag, last_modified):
+                    return not_modified_response(headers)
+
                 return {
                     'status': 'success',
                     'data': license_data,
                     'message': 'Licença encontrada'
-                }
+                }, 200, headers
             else:
                 return {
                     'status': 'error',
@@ -155,26 +717,62 @@ class LicenseResource(Resource):
         except Exception as e:
             api.abort(500, f'Erro interno: {str(e)}')
 
-@ns.route('/health')
-class HealthResource(Resource):
-    @api.doc('health_check')
+@ns.route('/cache/licenses')
+class LicenseCacheResource(Resource):
+    @api.doc('get_license_cache_stats')
     def get(self):
-        """Verifica se a API está funcionando"""
+        """Estatísticas do cache de licenças (hits, misses, evictions)"""
         return {
             'status': 'success',
-            'message': 'API funcionando normalmente',
-            'version': '1.0'
+            'data': License.cache_stats()
         }
 
+@ns.route('/metrics')
+class MetricsResource(Resource):
+    @api.doc('get_metrics')
+    def get(self):
+        """Métricas no formato de texto do Prometheus"""
+        return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+@ns.route('/health', '/health/live')
+class HealthResource(Resource):
+    @api.doc('health_check')
+    def get(self):
+        """Liveness: o processo está respondendo (não consulta o banco)"""
+        return responses.json_response(responses.HEALTH)
+
+@ns.route('/health/ready')
+class ReadinessResource(Resource):
+    @api.doc('readiness_check', responses={200: 'Pronta', 503: 'Banco lento ou indisponível'})
+    def get(self):
+        """
+        Readiness: sonda o banco (leitura do índice de pendentes e escrita
+        com rollback) dentro dos orçamentos de latência
+
+        Retorna 503 quando algum passo falha, excede o orçamento ou não
+        termina em READINESS_TIMEOUT segundos.
+        """
+        result = readiness.check()
+        return responses.json_response(responses.readiness(result), 200 if result['ready'] else 503)
+
 if __name__ == '__main__':
     print(">>> Iniciando Device Command API...")
     print(">>> Swagger UI disponivel em: http://localhost:5000/swagger/")
     print(">>> Rotas principais:")
     print("   GET  /api/device/{device_id}/command - Lista historico de comandos do device")
     print("   GET  /api/device/{device_id}/pending - Device consulta comandos pendentes")
+    print("   GET  /api/device/{device_id}/stream - Stream SSE de comandos do device")
+    print("   POST /api/device/{device_id}/ack - Device confirma comandos recebidos com lease")
+    print("   POST /api/devices/pending - Gateway consulta pendentes de varios devices")
     print("   POST /api/command - Frontend envia comandos")
+    print("   POST /api/commands/batch - Frontend envia comandos em lote")
     print("   GET  /api/commands - Lista todos comandos (admin)")
+    print("   GET  /api/licenses - Lista todas licencas (admin)")
     print("   GET  /api/license/{uuid} - Consulta numero de licenca por UUID")
-    print("   GET  /api/health - Health check")
+    print("   GET  /api/metrics - Metricas (Prometheus)")
+    print("   GET  /api/health - Health check (liveness)")
+    print("   GET  /api/health/ready - Readiness (sonda o banco)")
+    
+    print(">>> Servidor de desenvolvimento; em producao use: python serve.py")
     
-    app.run(debug=True, host='0.0.0.0', port=5000) 
\ No newline at end of file
+    app.run(debug=os.environ.get('FLASK_DEBUG') == '1', host='0.0.0.0', port=5000, threaded=True) 
\ No newline at end of file
@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+"""
+Variante ASGI (asyncio) das rotas de polling da Device Command API
+
+Expõe as mesmas rotas do app Flask usadas pelos devices e pelo frontend:
+
+    GET  /api/device/{device_id}/pending[?wait=<segundos>][&lease=<segundos>]
+    POST /api/device/{device_id}/ack
+    POST /api/command
+    GET  /api/license/{uuid}
+    GET  /api/health
+    GET  /api/health/live
+    GET  /api/health/ready
+
+O acesso ao SQLite roda em um executor pequeno (ASGI_DB_THREADS) e as
+esperas de long-poll ficam em asyncio.Event no event loop, sem prender
+uma thread por conexão. Rodar com: python asgi.py (requer uvicorn) ou
+qualquer servidor ASGI apontando para asgi:app.
+"""
+
+import asyncio
+import json
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+from admission import admission
+from database import close_pool
+from health import readiness
+from leases import CLAIM_LEASE_SECONDS, LEASE_MAX_SECONDS, sweeper as lease_sweeper
+from models import init_db, DeviceCommand, License
+from notifications import notifier
+from polling import hints as poll_hints, retry_after
+from presence import presence
+import responses
+from retention import scheduler as retention_scheduler
+from storage import close_storage, configure_storage, create_storage
+
+try:
+    import uvicorn
+except ImportError:
+    uvicorn = None
+
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'sqlite')
+LONG_POLL_MAX_WAIT = float(os.environ.get('LONG_POLL_MAX_WAIT', '30'))
+
+# Threads que executam as consultas ao SQLite
+ASGI_DB_THREADS = int(os.environ.get('ASGI_DB_THREADS', '8'))
+
+HOST = os.environ.get('API_HOST', '0.0.0.0')
+PORT = int(os.environ.get('API_PORT', '5000'))
+
+
+class AsyncDeviceWaiters:
+    """
+    Esperas de long-poll no event loop
+
+    Registrado como listener do notifier: add_command roda no executor e
+    acorda os eventos do device com call_soon_threadsafe.
+    """
+
+    def __init__(self):
+        self.loop = None
+        self._waiters = {}
+
+    def start(self, loop):
+        self.loop = loop
+        notifier.add_listener(self.notify_threadsafe)
+
+    def stop(self):
+        notifier.remove_listener(self.notify_threadsafe)
+
+    def notify_threadsafe(self, device_id):
+        # Leitura sem lock: só agenda o callback se houver alguém esperando
+        if device_id in self._waiters:
+            self.loop.call_soon_threadsafe(self._wake, device_id)
+
+    def _wake(self, device_id):
+        for event in self._waiters.get(device_id, ()):
+            event.set()
+
+    def subscribe(self, device_id):
+        event = asyncio.Event()
+        self._waiters.setdefault(device_id, set()).add(event)
+        return event
+
+    def unsubscribe(self, device_id, event):
+        waiters = self._waiters.get(device_id)
+        if waiters is not None:
+            waiters.discard(event)
+            if not waiters:
+                del self._waiters[device_id]
+
+    def waiting_count(self):
+        return sum(len(waiters) for waiters in self._waiters.values())
+
+
+class DeviceCommandASGI:
+    """Aplicação ASGI com as rotas de polling"""
+
+    routes = [
+        ('GET', re.compile(r'^/api/device/(?P<device_id>[^/]+)/pending$'), 'pending'),
+        ('POST', re.compile(r'^/api/device/(?P<device_id>[^/]+)/ack$'), 'ack'),
+        ('POST', re.compile(r'^/api/command$'), 'send_command'),
+        ('GET', re.compile(r'^/api/license/(?P<uuid>[^/]+)$'), 'license'),
+        ('GET', re.compile(r'^/api/health(/live)?$'), 'health'),
+        ('GET', re.compile(r'^/api/health/ready$'), 'ready'),
+    ]
+
+    # Rotas fora do controle de admissão (monitoramento)
+    admission_exempt = {'health', 'ready'}
+
+    def __init__(self):
+        self.executor = None
+        self.waiters = AsyncDeviceWaiters()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.handle(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.startup()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def startup(self):
+        self.executor = ThreadPoolExecutor(max_workers=ASGI_DB_THREADS, thread_name_prefix='asgi-db')
+        configure_storage(create_storage(STORAGE_BACKEND))
+        init_db()
+        presence.start()
+        lease_sweeper.start()
+        self.waiters.start(asyncio.get_running_loop())
+        retention_scheduler.start()
+
+    def shutdown(self):
+        retention_scheduler.stop()
+        lease_sweeper.stop()
+        presence.stop()
+        self.waiters.stop()
+        self.executor.shutdown(wait=True)
+        close_storage()
+        close_pool()
+
+    async def run_db(self, func, *args):
+        """Executa uma chamada bloqueante de models.py no executor"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    async def handle(self, scope, receive, send):
+        method = scope['method']
+        path = scope['path']
+
+        for route_method, pattern, handler in self.routes:
+            match = pattern.match(path)
+            if match:
+                if method != route_method:
+                    return await self.respond(send, 405, {'message': 'Método não permitido'})
+                slot = None
+                if admission.enabled and handler not in self.admission_exempt:
+                    # Long-polls esperam no event loop, sem prender thread:
+                    # não ocupam vaga de concorrência nem de espera
+                    rejected, slot = self.admit(scope, match.groupdict().get('device_id'),
+                                                None if self.holds_connection(scope) else 'request')
+                    if rejected:
+                        return await self.respond(send, *rejected)
+                try:
+                    status, body, headers = await getattr(self, handler)(scope, receive, **match.groupdict())
+                except Exception as e:
+                    status, body, headers = 500, {'message': f'Erro interno: {str(e)}'}, {}
+                finally:
+                    admission.leave(slot)
+                return await self.respond(send, status, body, headers)
+
+        await self.respond(send, 404, {'message': 'Rota não encontrada'})
+
+    async def respond(self, send, status, body, headers=None):
+        # Corpos já serializados (bytes) são enviados como estão
+        if body is None:
+            payload = b''
+        elif isinstance(body, bytes):
+            payload = body
+        else:
+            payload = responses.dumps(body)
+        raw_headers = [(b'content-type', b'application/json')]
+        raw_headers += [(name.lower().encode(), value.encode()) for name, value in (headers or {}).items()]
+        raw_headers.append((b'content-length', str(len(payload)).encode()))
+
+        await send({'type': 'http.response.start', 'status': status, 'headers': raw_headers})
+        await send({'type': 'http.response.body', 'body': payload})
+
+    @staticmethod
+    async def read_body(receive):
+        chunks = []
+        while True:
+            message = await receive()
+            chunks.append(message.get('body', b''))
+            if not message.get('more_body'):
+                return b''.join(chunks)
+
+    @staticmethod
+    def header(scope, name):
+        name = name.lower().encode()
+        for key, value in scope['headers']:
+            if key == name:
+                return value.decode('latin-1')
+        return None
+
+    @staticmethod
+    def holds_connection(scope):
+        """Long-poll passa a maior parte do tempo esperando, não no banco"""
+        query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+        return query.get('wait', ['0'])[0] not in ('', '0')
+
+    def admit(self, scope, device_id, slot):
+        """(None, vaga) se a requisição entra; senão (resposta 429, None)"""
+        client = scope.get('client')
+        remote_addr = client[0] if client else None
+        rejected, slot = admission.admit(
+            device_id, admission.client_key(remote_addr, lambda name: self.header(scope, name)), slot
+        )
+        if rejected is None:
+            return None, slot
+        message, wait = rejected
+        return (429, responses.too_many_requests(message, wait), {'Retry-After': retry_after(wait)}), None
+
+    async def claim_row(self, device_id, lease=None):
+        """Claim no executor; devices fora do índice de presença nem chegam lá"""
+        if DeviceCommand.has_no_pending(device_id):
+            return None
+        return await self.run_db(DeviceCommand.get_pending_row, device_id, lease)
+
+    async def wait_for_pending_row(self, device_id, timeout, lease=None):
+        """Long-poll no event loop: acorda pelo notifier, não por polling"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+
+        # Inscreve antes de consultar para não perder notificações
+        event = self.waiters.subscribe(device_id)
+        try:
+            while True:
+                row = await self.claim_row(device_id, lease)
+                if row:
+                    return row
+
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    return None
+                try:
+                    await asyncio.wait_for(event.wait(), remaining)
+                except asyncio.TimeoutError:
+                    return None
+                event.clear()
+        finally:
+            self.waiters.unsubscribe(device_id, event)
+
+    async def pending(self, scope, receive, device_id):
+        query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+        try:
+            wait = float(query.get('wait', ['0'])[0])
+        except ValueError:
+            return 400, {'message': 'Parâmetro wait deve ser numérico'}, {}
+
+        wait = min(max(wait, 0), LONG_POLL_MAX_WAIT)
+
+        lease = CLAIM_LEASE_SECONDS
+        if 'lease' in query:
+            try:
+                lease = float(query['lease'][0])
+            except ValueError:
+                return 400, {'message': 'Parâmetro lease deve ser numérico'}, {}
+            if not 0 <= lease <= LEASE_MAX_SECONDS:
+                return 400, {'message': f'lease deve estar entre 0 e {LEASE_MAX_SECONDS:g} segundos'}, {}
+
+        if wait > 0:
+            row = await self.wait_for_pending_row(device_id, wait, lease or None)
+        else:
+            row = await self.claim_row(device_id, lease or None)
+
+        next_poll = poll_hints.next_poll(device_id, bool(row), long_poll=wait > 0)
+        headers = {'Retry-After': retry_after(next_poll)}
+
+        if row:
+            return 200, responses.pending_command(row, next_poll), headers
+        return 200, responses.no_pending_command(next_poll), headers
+
+    async def ack(self, scope, receive, device_id):
+        try:
+            data = json.loads(await self.read_body(receive) or b'null')
+        except ValueError:
+            return 400, {'message': 'JSON inválido'}, {}
+
+        command_ids = data.get('ids') if isinstance(data, dict) else None
+        if (not isinstance(command_ids, list)
+                or not all(isinstance(command_id, int) for command_id in command_ids)):
+            return 400, {'message': 'Informe ids (lista de inteiros)'}, {}
+
+        acked = await self.run_db(DeviceCommand.ack, device_id, command_ids)
+        return 200, {
+            'status': 'success',
+            'data': {'acked': acked, 'ignored': sorted(set(command_ids) - set(acked))},
+            'message': f'{len(acked)} comando(s) confirmado(s)'
+        }, {}
+
+    async def send_command(self, scope, receive):
+        try:
+            data = json.loads(await self.read_body(receive) or b'null')
+        except ValueError:
+            return 400, {'message': 'JSON inválido'}, {}
+
+        if (not isinstance(data, dict)
+                or not isinstance(data.get('device_id'), str)
+                or not isinstance(data.get('command'), str)):
+            return 400, {'message': 'Informe device_id e command (strings)'}, {}
+
+        device_id = data['device_id']
+        command_id = await self.run_db(DeviceCommand.add_command, device_id, data['command'])
+
+        return 200, {
+            'status': 'success',
+            'message': f'Comando enviado para device {device_id}',
+            'command_id': command_id
+        }, {}
+
+    async def license(self, scope, receive, uuid):
+        license_data = await self.run_db(License.get_license_by_uuid, uuid)
+
+        if not license_data:
+            return 404, {
+                'status': 'error',
+                'data': None,
+                'message': 'Licença não encontrada para este UUID'
+            }, {}
+
+        etag, _ = License.get_license_validators(license_data)
+        headers = {'ETag': f'"{etag}"'}
+
+        if_none_match = self.header(scope, 'If-None-Match')
+        if if_none_match and f'"{etag}"' in [tag.strip() for tag in if_none_match.split(',')]:
+            return 304, None, headers
+
+        return 200, {
+            'status': 'success',
+            'data': license_data,
+            'message': 'Licença encontrada'
+        }, headers
+
+    async def health(self, scope, receive):
+        return 200, responses.HEALTH, {}
+
+    async def ready(self, scope, receive):
+        # Fora do executor do banco: a sonda tem tempo limitado mesmo com
+        # todas as threads do executor presas no SQLite
+        result = await asyncio.get_running_loop().run_in_executor(None, readiness.check)
+        return 200 if result['ready'] else 503, responses.readiness(result), {}
+
+
+app = DeviceCommandASGI()
+
+if __name__ == '__main__':
+    if uvicorn is None:
+        print("❌ uvicorn não está instalado (pip install uvicorn)")
+        raise SystemExit(1)
+
+    print(f">>> Device Command API (ASGI) em http://{HOST}:{PORT}")
+    uvicorn.run(app, host=HOST, port=PORT, lifespan='on',
+                timeout_keep_alive=int(os.environ.get('API_KEEPALIVE', '75')))
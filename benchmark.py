@@ -0,0 +1,502 @@
+#!/usr/bin/env python3
+"""
+Benchmark local da Device Command API
+
+Roda tudo no próprio processo, contra um banco temporário (nenhum
+servidor precisa estar no ar):
+
+- load:  milhares de devices simulados fazendo polling + um frontend
+         enviando comandos, pelo cliente de teste do Flask; latência
+         p50/p95/p99 e throughput por rota
+- claim: correção do claim concorrente (nenhum comando entregue duas
+         vezes, nenhum perdido)
+- micro: tempo de cada método de DeviceCommand/License com 10k, 1M ou
+         10M linhas no banco
+
+    python benchmark.py
+    python benchmark.py --suites micro --rows 10000,1000000
+    python benchmark.py --output atual.json --compare anterior.json
+
+O engine usado é o de STORAGE_BACKEND (sqlite, memory ou sharded).
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid as uuidlib
+from datetime import datetime, timezone
+
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'sqlite')
+
+SUITES = ('load', 'claim', 'micro')
+
+# Linhas inseridas por lote ao popular o banco do micro-benchmark
+SEED_CHUNK = 50000
+
+
+def percentile(sorted_values, fraction):
+    """Percentil por vizinho mais próximo de uma lista já ordenada"""
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(latencies, elapsed=None):
+    """Contagem, throughput e percentis (em ms) de uma lista de latências em segundos"""
+    values = sorted(latencies)
+    summary = {
+        'count': len(values),
+        'mean_ms': round(sum(values) / len(values) * 1000, 4) if values else None,
+        'p50_ms': None, 'p95_ms': None, 'p99_ms': None, 'max_ms': None,
+    }
+    for key, fraction in (('p50_ms', 0.50), ('p95_ms', 0.95), ('p99_ms', 0.99), ('max_ms', 1.0)):
+        value = percentile(values, fraction)
+        summary[key] = round(value * 1000, 4) if value is not None else None
+    if elapsed:
+        summary['throughput_rps'] = round(len(values) / elapsed, 1)
+    return summary
+
+
+def use_database(path):
+    """Troca o banco em uso pelo arquivo `path` com o engine configurado"""
+    import database
+    import storage
+    from models import init_db, license_cache
+    from presence import presence
+
+    # O índice de presença (iniciado pelo app) é reconstruído no banco novo
+    restart_presence = presence.enabled
+    presence.stop()
+    storage.close_storage()
+    database.close_pool()
+    database.DB_NAME = path
+    storage.DB_NAME = path
+    license_cache.clear()
+    storage.configure_storage(storage.create_storage(STORAGE_BACKEND))
+    init_db()
+    if restart_presence:
+        presence.start()
+
+
+class LoadTest:
+    """Devices simulados + frontend contra o app Flask"""
+
+    def __init__(self, devices, threads, producers, duration, command_rate, poll_interval):
+        self.devices = [f'bench-device-{i:05d}' for i in range(devices)]
+        self.threads = threads
+        self.poll_interval = poll_interval
+        self.producers = producers
+        self.duration = duration
+        self.command_rate = command_rate
+        self.latencies = {}
+        self.errors = {}
+        self.delivered = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def record(self, route, elapsed, ok):
+        with self._lock:
+            self.latencies.setdefault(route, []).append(elapsed)
+            if not ok:
+                self.errors[route] = self.errors.get(route, 0) + 1
+
+    def request(self, client, route, method, url, **kwargs):
+        start = time.perf_counter()
+        response = getattr(client, method)(url, **kwargs)
+        self.record(route, time.perf_counter() - start, response.status_code < 400)
+        return response
+
+    def device_loop(self, app, offset):
+        """
+        Cada thread consulta uma fatia dos devices em rodízio
+
+        Cada device consulta uma vez a cada poll_interval segundos; se a
+        API não der conta, a thread segue sem pausa.
+        """
+        client = app.test_client()
+        devices = self.devices[offset::self.threads]
+        delivered = []
+
+        while not self._stop.is_set():
+            cycle_end = time.perf_counter() + self.poll_interval
+            for device_id in devices:
+                if self._stop.is_set():
+                    break
+                response = self.request(client, 'GET /device/<id>/pending', 'get',
+                                        f'/api/device/{device_id}/pending')
+                data = response.get_json()['data']
+                if data:
+                    delivered.append(data['id'])
+
+            self._stop.wait(cycle_end - time.perf_counter())
+
+        with self._lock:
+            self.delivered.extend(delivered)
+
+    def frontend_loop(self, app, licenses):
+        """Envia comandos no ritmo configurado e faz consultas de admin"""
+        client = app.test_client()
+        interval = self.producers / self.command_rate if self.command_rate else 0
+        sent = 0
+
+        while not self._stop.is_set():
+            device_id = random.choice(self.devices)
+            self.request(client, 'POST /command', 'post', '/api/command',
+                         json={'device_id': device_id, 'command': 'bench'})
+            sent += 1
+
+            # A cada 20 comandos: uma listagem, um histórico e uma licença
+            if sent % 20 == 0:
+                self.request(client, 'GET /commands', 'get', '/api/commands?limit=100')
+                self.request(client, 'GET /device/<id>/command', 'get',
+                             f'/api/device/{device_id}/command?limit=50')
+                self.request(client, 'GET /license/<uuid>', 'get',
+                             f'/api/license/{random.choice(licenses)}')
+
+            if interval:
+                self._stop.wait(interval)
+
+    def run(self):
+        from app import app
+        from models import License
+
+        licenses = [str(uuidlib.uuid4()) for _ in range(100)]
+        for number, license_uuid in enumerate(licenses):
+            License.add_license(license_uuid, f'BENCH-{number:04d}')
+
+        workers = [threading.Thread(target=self.device_loop, args=(app, offset))
+                   for offset in range(self.threads)]
+        workers += [threading.Thread(target=self.frontend_loop, args=(app, licenses))
+                    for _ in range(self.producers)]
+
+        start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        time.sleep(self.duration)
+        self._stop.set()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - start
+
+        routes = {route: summarize(values, elapsed) for route, values in sorted(self.latencies.items())}
+        for route, summary in routes.items():
+            summary['errors'] = self.errors.get(route, 0)
+
+        total = sum(len(values) for values in self.latencies.values())
+        return {
+            'devices': len(self.devices),
+            'threads': self.threads,
+            'producers': self.producers,
+            'duration_s': round(elapsed, 2),
+            'total_requests': total,
+            'throughput_rps': round(total / elapsed, 1),
+            'delivered': len(self.delivered),
+            'duplicate_deliveries': len(self.delivered) - len(set(self.delivered)),
+            'routes': routes,
+        }
+
+
+def run_claim_check(devices, commands_per_device, threads):
+    """
+    Vários consumidores disputando os mesmos devices
+
+    Metade das threads usa o poll individual e metade o claim em lote de
+    gateway; todo comando enviado precisa ser entregue exatamente uma vez.
+    """
+    from models import DeviceCommand
+
+    device_ids = [f'claim-device-{i:04d}' for i in range(devices)]
+    sent = DeviceCommand.add_commands([
+        (device_id, f'cmd-{n}') for n in range(commands_per_device) for device_id in device_ids
+    ])
+
+    delivered = []
+    lock = threading.Lock()
+    barrier = threading.Barrier(threads)
+
+    def consumer(index):
+        mine = []
+        barrier.wait()
+        idle_rounds = 0
+        while idle_rounds < 2:
+            got = 0
+            if index % 2 == 0:
+                for device_id in random.sample(device_ids, len(device_ids)):
+                    command = DeviceCommand.get_pending_command(device_id)
+                    if command:
+                        mine.append(command['id'])
+                        got += 1
+            else:
+                claimed = DeviceCommand.claim_pending_commands(device_ids, max_per_device=3)
+                for commands in claimed.values():
+                    mine.extend(command['id'] for command in commands)
+                    got += len(commands)
+            idle_rounds = idle_rounds + 1 if got == 0 else 0
+        with lock:
+            delivered.extend(mine)
+
+    start = time.perf_counter()
+    workers = [threading.Thread(target=consumer, args=(index,)) for index in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+
+    duplicates = len(delivered) - len(set(delivered))
+    lost = len(set(sent) - set(delivered))
+    return {
+        'devices': devices,
+        'threads': threads,
+        'sent': len(sent),
+        'delivered': len(delivered),
+        'duplicates': duplicates,
+        'lost': lost,
+        'duration_s': round(elapsed, 2),
+        'claims_per_s': round(len(delivered) / elapsed, 1),
+        'ok': duplicates == 0 and lost == 0,
+    }
+
+
+def seed(rows, per_device=100):
+    """Popula o banco: `rows` comandos, metade já executada, e 1000 licenças"""
+    from models import DeviceCommand, License
+
+    devices = max(1, rows // per_device)
+    device_ids = [f'micro-device-{i:07d}' for i in range(devices)]
+
+    inserted = 0
+    while inserted < rows:
+        count = min(SEED_CHUNK, rows - inserted)
+        DeviceCommand.add_commands([
+            (device_ids[(inserted + n) % devices], f'seed-{inserted + n}') for n in range(count)
+        ])
+        inserted += count
+
+    # Entrega metade dos comandos de cada device
+    for start in range(0, devices, 1000):
+        DeviceCommand.claim_pending_commands(device_ids[start:start + 1000], max_per_device=per_device // 2)
+
+    licenses = [str(uuidlib.uuid4()) for _ in range(1000)]
+    for number, license_uuid in enumerate(licenses):
+        License.add_license(license_uuid, f'MICRO-{number:06d}')
+
+    return device_ids, licenses
+
+
+def time_calls(func, iterations):
+    latencies = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - start)
+    return summarize(latencies)
+
+
+def run_micro(rows, iterations):
+    """Tempo de cada método com `rows` linhas no banco"""
+    from models import DeviceCommand, License, license_cache
+
+    seed_start = time.perf_counter()
+    device_ids, licenses = seed(rows)
+    seed_elapsed = time.perf_counter() - seed_start
+
+    devices = iter(device_ids * (iterations // len(device_ids) + 2))
+    empty_devices = iter(f'micro-empty-{i}' for i in range(10 ** 9))
+    new_licenses = iter(str(uuidlib.uuid4()) for _ in range(10 ** 9))
+    sample = device_ids[:50]
+
+    # Operações que varrem a tabela inteira rodam poucas vezes
+    full_scan = max(1, min(3, 1000000 // rows))
+
+    def uncached_license():
+        license_cache.clear()
+        License.get_license_by_uuid(random.choice(licenses))
+
+    methods = [
+        ('DeviceCommand.add_command', iterations,
+         lambda: DeviceCommand.add_command(random.choice(device_ids), 'micro')),
+        ('DeviceCommand.add_commands[100]', max(1, iterations // 10),
+         lambda: DeviceCommand.add_commands([(random.choice(device_ids), 'micro')] * 100)),
+        ('DeviceCommand.get_pending_command (hit)', iterations,
+         lambda: DeviceCommand.get_pending_command(next(devices))),
+        ('DeviceCommand.get_pending_command (vazio)', iterations,
+         lambda: DeviceCommand.get_pending_command(next(empty_devices))),
+        ('DeviceCommand.claim_pending_commands[50]', max(1, iterations // 10),
+         lambda: DeviceCommand.claim_pending_commands(sample, 1)),
+        ('DeviceCommand.get_delivered_commands_since', iterations,
+         lambda: DeviceCommand.get_delivered_commands_since(random.choice(device_ids), 0, 300, 100)),
+        ('DeviceCommand.get_history_validators', iterations,
+         lambda: DeviceCommand.get_history_validators(random.choice(device_ids))),
+        ('DeviceCommand.list_commands (device)', iterations,
+         lambda: DeviceCommand.list_commands(device_id=random.choice(device_ids), limit=50)),
+        ('DeviceCommand.list_commands (todos)', iterations,
+         lambda: DeviceCommand.list_commands(limit=100)),
+        ('DeviceCommand.list_commands (status)', max(1, iterations // 10),
+         lambda: DeviceCommand.list_commands(status='pending', limit=100)),
+        ('DeviceCommand.get_commands_by_device', iterations,
+         lambda: DeviceCommand.get_commands_by_device(random.choice(device_ids))),
+        ('DeviceCommand.get_all_commands', full_scan,
+         DeviceCommand.get_all_commands),
+        ('License.get_license_by_uuid (cache)', iterations,
+         lambda: License.get_license_by_uuid(random.choice(licenses))),
+        ('License.get_license_by_uuid (banco)', iterations, uncached_license),
+        ('License.add_license', max(1, iterations // 10),
+         lambda: License.add_license(next(new_licenses), 'MICRO')),
+        ('License.get_all_licenses', max(1, iterations // 10),
+         License.get_all_licenses),
+    ]
+
+    results = {}
+    for name, count, func in methods:
+        results[name] = time_calls(func, count)
+        print(f"   {name:<45} p50 {results[name]['p50_ms']:>9.3f} ms   "
+              f"p99 {results[name]['p99_ms']:>9.3f} ms   ({count}x)")
+
+    return {'rows': rows, 'seed_s': round(seed_elapsed, 2), 'methods': results}
+
+
+def git_revision():
+    try:
+        result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                                text=True, timeout=5, cwd=os.path.dirname(os.path.abspath(__file__)))
+        return result.stdout.strip() or None
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+
+
+def compare(current, previous_path):
+    """Mostra a variação de p50/p99 em relação a um resultado anterior"""
+    with open(previous_path) as previous_file:
+        previous = json.load(previous_file)
+
+    def rows(result):
+        for route, summary in result.get('load', {}).get('routes', {}).items():
+            yield f'load {route}', summary
+        for size in result.get('micro', []):
+            for method, summary in size['methods'].items():
+                yield f"micro {size['rows']} {method}", summary
+
+    before = dict(rows(previous))
+    print(f"\n📈 Comparação com {previous_path} ({previous['meta'].get('git_revision')})")
+    for name, summary in rows(current):
+        old = before.get(name)
+        if not old:
+            continue
+        changes = []
+        for key in ('p50_ms', 'p99_ms'):
+            if old[key] and summary[key] is not None:
+                change = (summary[key] - old[key]) / old[key] * 100
+                marker = '🔺' if change > 10 else '🔻' if change < -10 else '  '
+                changes.append(f"{key[:3]} {old[key]:.3f} → {summary[key]:.3f} ms {marker}{change:+.0f}%")
+        print(f"   {name:<60} {'   '.join(changes)}")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Benchmark local da Device Command API')
+    parser.add_argument('--suites', default=','.join(SUITES), help=f"Suítes a rodar ({', '.join(SUITES)})")
+    parser.add_argument('--devices', type=int, default=2000, help='Devices simulados no teste de carga')
+    parser.add_argument('--threads', type=int, default=16, help='Threads de polling no teste de carga')
+    parser.add_argument('--poll-interval', type=float, default=1.0, help='Intervalo de polling de cada device (s)')
+    parser.add_argument('--producers', type=int, default=2, help='Threads de frontend enviando comandos')
+    parser.add_argument('--command-rate', type=float, default=200, help='Comandos/s enviados pelo frontend (0 = sem limite)')
+    parser.add_argument('--duration', type=float, default=10, help='Duração do teste de carga (s)')
+    parser.add_argument('--claim-devices', type=int, default=20, help='Devices disputados no teste de claim')
+    parser.add_argument('--claim-commands', type=int, default=50, help='Comandos por device no teste de claim')
+    parser.add_argument('--claim-threads', type=int, default=16, help='Consumidores concorrentes no teste de claim')
+    parser.add_argument('--rows', default='10000', help='Tamanhos do banco do micro-benchmark (ex.: 10000,1000000,10000000)')
+    parser.add_argument('--iterations', type=int, default=1000, help='Chamadas por método no micro-benchmark')
+    parser.add_argument('--output', default=None, help='Arquivo JSON de resultado (padrão: benchmark-<data>.json)')
+    parser.add_argument('--compare', default=None, help='Resultado anterior para comparar')
+    parser.add_argument('--keep-db', action='store_true', help='Não apaga o diretório dos bancos temporários')
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    suites = [suite.strip() for suite in args.suites.split(',') if suite.strip()]
+    unknown = set(suites) - set(SUITES)
+    if unknown:
+        print(f"❌ Suítes desconhecidas: {', '.join(sorted(unknown))}")
+        return 1
+
+    workdir = tempfile.mkdtemp(prefix='device-bench-')
+    # O app lê DEVICE_DB_PATH na importação
+    os.environ['DEVICE_DB_PATH'] = os.path.join(workdir, 'load.db')
+    # Mede a capacidade da API, não os limites do controle de admissão
+    os.environ.setdefault('ADMISSION_CONTROL', '0')
+
+    result = {
+        'meta': {
+            'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'git_revision': git_revision(),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'storage_backend': STORAGE_BACKEND,
+            'args': vars(args),
+        }
+    }
+
+    print(f"🏁 Benchmark ({STORAGE_BACKEND}) em {workdir}")
+    ok = True
+    try:
+        if 'load' in suites:
+            print(f"\n📡 Carga: {args.devices} devices (poll a cada {args.poll_interval:g}s), "
+                  f"{args.threads} threads, {args.duration:g}s")
+            use_database(os.path.join(workdir, 'load.db'))
+            result['load'] = LoadTest(args.devices, args.threads, args.producers,
+                                      args.duration, args.command_rate, args.poll_interval).run()
+            for route, summary in result['load']['routes'].items():
+                print(f"   {route:<28} {summary['throughput_rps']:>9.1f} req/s   p50 {summary['p50_ms']:.2f}   "
+                      f"p95 {summary['p95_ms']:.2f}   p99 {summary['p99_ms']:.2f} ms   erros {summary['errors']}")
+            ok = ok and result['load']['duplicate_deliveries'] == 0
+
+        if 'claim' in suites:
+            print(f"\n🔒 Claim concorrente: {args.claim_threads} consumidores")
+            use_database(os.path.join(workdir, 'claim.db'))
+            result['claim'] = run_claim_check(args.claim_devices, args.claim_commands, args.claim_threads)
+            claim = result['claim']
+            print(f"   {'✅' if claim['ok'] else '❌'} {claim['delivered']}/{claim['sent']} entregues, "
+                  f"{claim['duplicates']} duplicados, {claim['lost']} perdidos "
+                  f"({claim['claims_per_s']:.0f} claims/s)")
+            ok = ok and claim['ok']
+
+        if 'micro' in suites:
+            result['micro'] = []
+            for rows in [int(value) for value in args.rows.split(',') if value.strip()]:
+                print(f"\n🔬 Micro-benchmark com {rows} linhas")
+                use_database(os.path.join(workdir, f'micro-{rows}.db'))
+                result['micro'].append(run_micro(rows, args.iterations))
+    finally:
+        from database import close_pool
+        from storage import close_storage
+        close_storage()
+        close_pool()
+        if not args.keep_db:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = args.output or f"benchmark-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    with open(output, 'w') as output_file:
+        json.dump(result, output_file, indent=2, ensure_ascii=False)
+    print(f"\n💾 Resultado salvo em {output}")
+
+    if args.compare:
+        compare(result, args.compare)
+
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,93 @@
+"""
+Cache LRU em memória com expiração (TTL)
+
+Usado na frente de consultas quase imutáveis, como a de licenças por UUID.
+Aceita cache negativo: guardar None registra que a chave não existe no
+banco, com um TTL próprio (normalmente menor).
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+# Retornado por get() quando a chave não está no cache
+MISSING = object()
+
+
+class TTLCache:
+    """Cache LRU limitado por tamanho, com TTL por entrada"""
+
+    def __init__(self, maxsize, ttl, negative_ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        """Retorna o valor em cache ou MISSING"""
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._data.get(key)
+
+            if entry is None:
+                self.misses += 1
+                return MISSING
+
+            value, expires_at = entry
+            if expires_at <= now:
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return MISSING
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """Guarda um valor; None é tratado como resultado negativo"""
+        if self.maxsize <= 0:
+            return
+
+        ttl = self.negative_ttl if value is None else self.ttl
+        expires_at = time.monotonic() + ttl
+
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        """Remove uma chave do cache"""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """Esvazia o cache"""
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        """Contadores de uso do cache"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'negative_ttl': self.negative_ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0
+            }
@@ -0,0 +1,43 @@
+"""
+Fixtures dos testes automatizados (pytest)
+
+Os módulos leem DEVICE_DB_PATH na importação: o banco padrão dos testes
+fica em um diretório temporário, nunca no device_commands.db do repositório.
+"""
+
+import os
+import tempfile
+
+os.environ.setdefault('DEVICE_DB_PATH', os.path.join(tempfile.mkdtemp(prefix='device-tests-'), 'api.db'))
+
+import pytest
+
+
+@pytest.fixture
+def storage(tmp_path):
+    """SQLiteStorage em um arquivo próprio do teste, configurado como backend em uso"""
+    # A importação do app configura o backend padrão e inicia o índice de
+    # presença: importa antes de trocar o backend pelo do teste
+    import app  # noqa: F401
+    from models import init_db, license_cache
+    from presence import presence
+    from storage import SQLiteStorage, close_storage, configure_storage
+
+    presence.stop()
+    backend = SQLiteStorage(str(tmp_path / 'commands.db'), group_commit='off')
+    configure_storage(backend)
+    init_db()
+    license_cache.clear()
+    presence.start()
+
+    yield backend
+
+    presence.stop()
+    close_storage()
+
+
+@pytest.fixture
+def client(storage):
+    """Cliente de teste do app Flask sobre o banco do teste"""
+    from app import app
+    return app.test_client()
@@ -0,0 +1,167 @@
+"""
+Camada de conexões SQLite
+
+Mantém um pool de conexões de longa duração para evitar abrir o arquivo,
+ler o schema e reaplicar pragmas a cada requisição. Cada conexão é
+configurada uma única vez (WAL, synchronous, cache_size, mmap_size) e
+guarda seu próprio cache de statements preparados.
+"""
+
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+DB_NAME = os.environ.get('DEVICE_DB_PATH', 'device_commands.db')
+
+# Configurações do pool (podem ser sobrescritas por variáveis de ambiente)
+POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '8'))
+POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '5'))
+BUSY_TIMEOUT_MS = int(os.environ.get('DB_BUSY_TIMEOUT_MS', '5000'))
+STATEMENT_CACHE_SIZE = int(os.environ.get('DB_STATEMENT_CACHE_SIZE', '256'))
+
+# Pragmas aplicados em cada conexão nova
+JOURNAL_MODE = os.environ.get('DB_JOURNAL_MODE', 'WAL')
+SYNCHRONOUS = os.environ.get('DB_SYNCHRONOUS', 'NORMAL')
+CACHE_SIZE_KB = int(os.environ.get('DB_CACHE_SIZE_KB', '16384'))
+MMAP_SIZE = int(os.environ.get('DB_MMAP_SIZE', str(256 * 1024 * 1024)))
+
+
+class PoolTimeoutError(Exception):
+    """Nenhuma conexão livre dentro do tempo limite"""
+
+
+class ConnectionPool:
+    """Pool de conexões SQLite compartilhado entre threads"""
+
+    def __init__(self, db_path=None, size=None, timeout=None):
+        self.db_path = db_path or DB_NAME
+        self.size = size or POOL_SIZE
+        self.timeout = POOL_TIMEOUT if timeout is None else timeout
+        # LIFO mantém as conexões mais "quentes" em uso
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._in_use = 0
+        self._closed = False
+
+    def _connect(self):
+        """Abre e configura uma nova conexão"""
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=BUSY_TIMEOUT_MS / 1000,
+            check_same_thread=False,
+            cached_statements=STATEMENT_CACHE_SIZE
+        )
+        conn.execute(f'PRAGMA journal_mode = {JOURNAL_MODE}')
+        conn.execute(f'PRAGMA synchronous = {SYNCHRONOUS}')
+        conn.execute(f'PRAGMA cache_size = -{CACHE_SIZE_KB}')
+        conn.execute(f'PRAGMA mmap_size = {MMAP_SIZE}')
+        conn.execute('PRAGMA temp_store = MEMORY')
+        return conn
+
+    def acquire(self):
+        """Retira uma conexão do pool, criando uma nova se houver espaço"""
+        if self._closed:
+            raise RuntimeError("Pool de conexões já foi encerrado")
+
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = None
+            with self._lock:
+                create = self._created < self.size
+                if create:
+                    self._created += 1
+            if create:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+            else:
+                try:
+                    conn = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    raise PoolTimeoutError(
+                        f"Nenhuma conexão disponível após {self.timeout}s"
+                    )
+
+        with self._lock:
+            self._in_use += 1
+        return conn
+
+    def release(self, conn):
+        """Devolve a conexão ao pool"""
+        with self._lock:
+            self._in_use -= 1
+
+        if conn.in_transaction:
+            conn.rollback()
+
+        if self._closed:
+            conn.close()
+            with self._lock:
+                self._created -= 1
+        else:
+            self._idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        """Context manager que garante a devolução da conexão"""
+        conn = self.acquire()
+        try:
+            yield conn
+        except Exception:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+        finally:
+            self.release(conn)
+
+    def close(self):
+        """Fecha todas as conexões ociosas; as em uso fecham ao serem devolvidas"""
+        self._closed = True
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+    def stats(self):
+        """Retorna a utilização atual do pool"""
+        with self._lock:
+            return {
+                'size': self.size,
+                'created': self._created,
+                'in_use': self._in_use,
+                'idle': self._idle.qsize()
+            }
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Retorna o pool global, criando-o na primeira chamada"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool()
+    return _pool
+
+
+def close_pool():
+    """Encerra o pool global (chamado no desligamento da aplicação)"""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
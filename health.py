@@ -0,0 +1,215 @@
+"""
+Liveness e readiness da API
+
+- liveness (/api/health, /api/health/live): o processo responde; não toca
+  no banco.
+- readiness (/api/health/ready): sonda cada arquivo SQLite do backend com
+  uma leitura do índice de pendentes e uma escrita desfeita com rollback
+  (BEGIN IMMEDIATE pega o lock de escrita), mede a latência de cada passo
+  e confere o espaço livre em disco. Fica "não pronto" se algum passo
+  falhar ou passar do orçamento (READINESS_READ_BUDGET_MS e
+  READINESS_WRITE_BUDGET_MS).
+
+A sonda usa uma conexão própria por arquivo (fora do pool), com busy
+timeout igual ao orçamento de escrita, e roda em uma thread: a requisição
+espera no máximo READINESS_TIMEOUT segundos, mesmo com o SQLite travado.
+Uma única sonda roda por vez e o resultado é reaproveitado por
+READINESS_CACHE_TTL segundos, então checagens frequentes não geram carga.
+"""
+
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+import metrics
+from database import DB_NAME
+from storage import ShardedStorage, get_storage, sqlite_backends
+
+# Orçamentos de latência de cada passo da sonda (milissegundos)
+READINESS_READ_BUDGET_MS = float(os.environ.get('READINESS_READ_BUDGET_MS', '250'))
+READINESS_WRITE_BUDGET_MS = float(os.environ.get('READINESS_WRITE_BUDGET_MS', '1000'))
+
+# Tempo máximo que a requisição de readiness espera pela sonda (segundos)
+READINESS_TIMEOUT = float(os.environ.get('READINESS_TIMEOUT', '2'))
+
+# Por quantos segundos o resultado da sonda é reaproveitado
+READINESS_CACHE_TTL = float(os.environ.get('READINESS_CACHE_TTL', '1'))
+
+# Espaço livre mínimo no disco de cada arquivo (MB)
+READINESS_MIN_FREE_MB = float(os.environ.get('READINESS_MIN_FREE_MB', '64'))
+
+PROBE_DEVICE_ID = '__readiness_probe__'
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 2)
+
+
+class ReadinessProbe:
+    """Sonda de readiness com uma execução por vez e resultado em cache"""
+
+    def __init__(self, read_budget_ms=None, write_budget_ms=None, timeout=None,
+                 cache_ttl=None, min_free_mb=None):
+        self.read_budget_ms = READINESS_READ_BUDGET_MS if read_budget_ms is None else read_budget_ms
+        self.write_budget_ms = READINESS_WRITE_BUDGET_MS if write_budget_ms is None else write_budget_ms
+        self.timeout = READINESS_TIMEOUT if timeout is None else timeout
+        self.cache_ttl = READINESS_CACHE_TTL if cache_ttl is None else cache_ttl
+        self.min_free_mb = READINESS_MIN_FREE_MB if min_free_mb is None else min_free_mb
+
+        self._lock = threading.Lock()
+        self._connections = {}
+        self._thread = None
+        self._started_at = None
+        self._done = None
+        self._result = None
+        self._expires_at = 0.0
+
+    def budgets(self):
+        return {
+            'read_ms': self.read_budget_ms,
+            'write_ms': self.write_budget_ms,
+            'timeout_s': self.timeout,
+            'min_free_mb': self.min_free_mb
+        }
+
+    def check(self):
+        """Resultado da sonda: {'ready': bool, 'components': {...}, ...}"""
+        with self._lock:
+            now = time.monotonic()
+            if self._result is not None and now < self._expires_at:
+                return self._result
+
+            if self._thread is None:
+                self._started_at = now
+                self._done = threading.Event()
+                self._thread = threading.Thread(target=self._run, name='readiness-probe', daemon=True)
+                self._thread.start()
+            done, started_at = self._done, self._started_at
+
+        if done.wait(self.timeout):
+            return self._result
+
+        # A sonda continua rodando em segundo plano; a próxima checagem
+        # aproveita o resultado quando ela terminar
+        return {
+            'ready': False,
+            'checked_at': time.time(),
+            'duration_ms': _ms(time.monotonic() - started_at),
+            'budgets': self.budgets(),
+            'components': {},
+            'error': f'Sonda do banco não terminou em {self.timeout}s'
+        }
+
+    def _run(self):
+        start = time.monotonic()
+        try:
+            components = self.probe_storage()
+        except Exception as e:
+            components = {'storage': {'ready': False, 'error': str(e)}}
+
+        result = {
+            'ready': all(component['ready'] for component in components.values()),
+            'checked_at': time.time(),
+            'duration_ms': _ms(time.monotonic() - start),
+            'budgets': self.budgets(),
+            'components': components
+        }
+
+        with self._lock:
+            self._result = result
+            self._expires_at = time.monotonic() + self.cache_ttl
+            self._thread = None
+            self._done.set()
+
+    def probe_storage(self):
+        """Sonda os arquivos SQLite do backend em uso"""
+        storage = get_storage()
+        targets = sqlite_backends(storage, flush=False)
+        if isinstance(storage, ShardedStorage):
+            targets.append(storage.main)
+
+        if not targets:
+            # MemoryStorage sem persistência: nada a sondar
+            return {storage.name: {'ready': True}}
+
+        components = {}
+        for target in targets:
+            db_path = target.pool.db_path or DB_NAME
+            component = self.probe_file(db_path)
+            if target.writer is not None:
+                component['group_commit_queued'] = target.writer.stats()['queued']
+            components[db_path] = component
+        return components
+
+    def _connection(self, db_path):
+        conn = self._connections.get(db_path)
+        if conn is None:
+            conn = sqlite3.connect(
+                db_path,
+                timeout=self.write_budget_ms / 1000,
+                isolation_level=None,
+                check_same_thread=False
+            )
+            self._connections[db_path] = conn
+        return conn
+
+    def probe_file(self, db_path):
+        """Leitura do índice de pendentes, escrita com rollback e espaço em disco"""
+        component = {'ready': True}
+        labels = (('db', db_path),)
+
+        try:
+            conn = self._connection(db_path)
+
+            start = time.perf_counter()
+            conn.execute('''
+                SELECT id FROM device_commands INDEXED BY idx_device_commands_pending
+                WHERE status = 'pending'
+                LIMIT 1
+            ''').fetchall()
+            elapsed = time.perf_counter() - start
+            component['read_ms'] = _ms(elapsed)
+            metrics.observe('device_api_readiness_probe_seconds', labels + (('step', 'read'),), elapsed)
+
+            start = time.perf_counter()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.execute('''
+                    INSERT INTO device_commands (device_id, command, status)
+                    VALUES (?, 'probe', 'probe')
+                ''', (PROBE_DEVICE_ID,))
+            finally:
+                conn.execute('ROLLBACK')
+            elapsed = time.perf_counter() - start
+            component['write_ms'] = _ms(elapsed)
+            metrics.observe('device_api_readiness_probe_seconds', labels + (('step', 'write'),), elapsed)
+        except sqlite3.Error as e:
+            # Conexão descartada: a próxima sonda abre outra
+            conn = self._connections.pop(db_path, None)
+            if conn is not None:
+                conn.close()
+            component['ready'] = False
+            component['error'] = str(e)
+            return component
+
+        if component['read_ms'] > self.read_budget_ms:
+            component['ready'] = False
+            component['error'] = f"Leitura levou {component['read_ms']}ms (orçamento {self.read_budget_ms}ms)"
+        elif component['write_ms'] > self.write_budget_ms:
+            component['ready'] = False
+            component['error'] = f"Escrita levou {component['write_ms']}ms (orçamento {self.write_budget_ms}ms)"
+
+        free_mb = shutil.disk_usage(os.path.dirname(os.path.abspath(db_path))).free / 1024 / 1024
+        component['disk_free_mb'] = round(free_mb, 1)
+        if free_mb < self.min_free_mb and component['ready']:
+            component['ready'] = False
+            component['error'] = f"Disco com {component['disk_free_mb']}MB livres (mínimo {self.min_free_mb}MB)"
+
+        return component
+
+
+readiness = ReadinessProbe()
+
+metrics.describe('device_api_readiness_probe_seconds', 'histogram', 'Latência dos passos da sonda de readiness')
@@ -0,0 +1,62 @@
+"""
+Processo líder das tarefas de fundo
+
+Com vários workers (gunicorn) cada processo importa o app e inicia as
+mesmas threads de fundo. A retenção e o sweeper de leases só devem rodar
+em um deles: o processo que obtém o lock exclusivo (flock) do arquivo
+BACKGROUND_LOCK_PATH é o líder e o mantém até terminar. Quando ele sai
+(max_requests, reload, queda) o sistema libera o lock e o próximo worker
+que tentar assume.
+
+Sem fcntl (Windows) ou com BACKGROUND_LOCK_PATH vazio todo processo é
+líder: o modo threaded roda em um único processo.
+"""
+
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from database import DB_NAME
+
+BACKGROUND_LOCK_PATH = os.environ.get('BACKGROUND_LOCK_PATH', f'{DB_NAME}.leader')
+
+
+class LeaderLock:
+    """Lock de arquivo que elege um único processo para as tarefas de fundo"""
+
+    def __init__(self, path=None):
+        self.path = BACKGROUND_LOCK_PATH if path is None else path
+        self._lock = threading.Lock()
+        self._file = None
+
+    def is_leader(self):
+        """True se este processo é (ou acabou de se tornar) o líder"""
+        if fcntl is None or not self.path:
+            return True
+
+        with self._lock:
+            if self._file is not None:
+                return True
+
+            lock_file = open(self.path, 'a')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                return False
+
+            self._file = lock_file
+            return True
+
+    def release(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+leader = LeaderLock()
@@ -0,0 +1,125 @@
+"""
+Leases de comandos entregues
+
+No modo com lease o claim não marca o comando como executado: ele passa
+para in_flight com um prazo (lease_expires_at) e o device confirma a
+execução em POST /api/device/<device_id>/ack. Sem confirmação até o prazo
+o comando volta para pending e é entregue de novo, antes dos mais novos.
+
+O LeaseSweeper encontra os leases vencidos pelo índice parcial ordenado
+por prazo (idx_device_commands_lease) ou pelo heap do MemoryStorage: cada
+passo custa proporcional aos leases vencidos, nunca ao tamanho da tabela.
+Entre passos a thread dorme até o próximo prazo (no máximo
+LEASE_SWEEP_INTERVAL segundos, para ver leases criados por outros
+processos). Com vários workers só o processo líder (leader.py) devolve.
+"""
+
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+
+import metrics
+from leader import leader
+from notifications import notifier
+from presence import presence
+from storage import get_storage
+
+# Lease das consultas que não informam ?lease= (0: entrega imediata,
+# o comando já sai como executado)
+CLAIM_LEASE_SECONDS = float(os.environ.get('CLAIM_LEASE_SECONDS', '0'))
+LEASE_MAX_SECONDS = float(os.environ.get('LEASE_MAX_SECONDS', '3600'))
+
+# Espera máxima entre passos do sweeper e leases devolvidos por transação
+LEASE_SWEEP_INTERVAL = float(os.environ.get('LEASE_SWEEP_INTERVAL', '1'))
+LEASE_SWEEP_BATCH = int(os.environ.get('LEASE_SWEEP_BATCH', '500'))
+
+# Prazos com microssegundos; comparáveis como texto com o CURRENT_TIMESTAMP
+LEASE_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+
+def lease_now():
+    return datetime.now(timezone.utc).strftime(LEASE_FORMAT)
+
+
+def lease_deadline(seconds):
+    """Prazo de um lease de `seconds` segundos a partir de agora"""
+    return (datetime.now(timezone.utc) + timedelta(seconds=seconds)).strftime(LEASE_FORMAT)
+
+
+def seconds_until(deadline):
+    expires_at = datetime.strptime(deadline, LEASE_FORMAT).replace(tzinfo=timezone.utc)
+    return (expires_at - datetime.now(timezone.utc)).total_seconds()
+
+
+def requeue_expired(storage=None, batch_size=None):
+    """
+    Devolve para pending os leases vencidos, em lotes
+
+    Marca os devices no índice de presença e acorda seus long-polls.
+    Retorna quantos comandos voltaram para a fila.
+    """
+    storage = storage or get_storage()
+    batch_size = batch_size or LEASE_SWEEP_BATCH
+    total = 0
+
+    while True:
+        device_ids = storage.requeue_expired(lease_now(), batch_size)
+        if device_ids:
+            total += len(device_ids)
+            metrics.inc('device_api_leases_expired_total', value=len(device_ids))
+            presence.mark_many(device_ids)
+            for device_id in set(device_ids):
+                notifier.notify(device_id)
+        if len(device_ids) < batch_size:
+            return total
+
+
+class LeaseSweeper:
+    """Thread que devolve os leases vencidos à fila"""
+
+    def __init__(self, interval=None, batch_size=None):
+        self.interval = LEASE_SWEEP_INTERVAL if interval is None else interval
+        self.batch_size = batch_size or LEASE_SWEEP_BATCH
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='lease-sweeper', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def next_wait(self, storage=None):
+        """Segundos até o próximo prazo, limitado a `interval`"""
+        deadline = (storage or get_storage()).next_lease_expiry()
+        if deadline is None:
+            return self.interval
+        return min(max(seconds_until(deadline), 0.01), self.interval)
+
+    def _run(self):
+        wait = 0.0
+        while not self._stop.wait(wait):
+            # Com vários workers só o líder devolve (os demais tentam assumir
+            # a cada intervalo)
+            if not leader.is_leader():
+                wait = self.interval
+                continue
+            try:
+                requeue_expired(batch_size=self.batch_size)
+                wait = self.next_wait()
+            except Exception as e:
+                print(f"❌ Erro ao devolver leases vencidos: {e}")
+                wait = self.interval
+
+
+sweeper = LeaseSweeper()
+
+metrics.describe('device_api_leases_expired_total', 'counter', 'Comandos com lease vencido devolvidos à fila')
+metrics.describe('device_api_commands_acked_total', 'counter', 'Comandos confirmados pelos devices (ack)')
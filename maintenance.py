@@ -0,0 +1,391 @@
+#!/usr/bin/env python3
+"""
+Ferramentas administrativas do banco da Device Command API
+
+    python maintenance.py stats
+    python maintenance.py archive [--days N] [--keep-per-device M] [--delete]
+    python maintenance.py vacuum [--max-pages N] [--enable]
+    python maintenance.py reshard --shards N [--template T]
+    python maintenance.py import-licenses ARQUIVO [--format csv|ndjson] [--staged]
+
+Roda contra os arquivos SQLite (DEVICE_DB_PATH, ou os shards com
+STORAGE_BACKEND=sharded). archive, vacuum e import-licenses (sem
+--staged) podem rodar com a API no ar: trabalham em transações curtas.
+reshard deve rodar com a API parada.
+"""
+
+import argparse
+import csv
+import io
+import itertools
+import json
+import os
+import sys
+import time
+
+from database import DB_NAME, close_pool
+from models import init_db
+from retention import (
+    RetentionPolicy, archive_commands, enable_incremental_vacuum,
+    incremental_vacuum
+)
+from storage import (
+    ShardedStorage, SQLiteStorage, close_storage, configure_storage,
+    get_storage, shard_for, sqlite_backends
+)
+
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'sqlite')
+
+# Linhas lidas da origem por vez no reshard
+RESHARD_CHUNK_SIZE = int(os.environ.get('RESHARD_CHUNK_SIZE', '5000'))
+
+# Licenças inseridas por transação no import-licenses
+LICENSE_IMPORT_CHUNK_SIZE = int(os.environ.get('LICENSE_IMPORT_CHUNK_SIZE', '50000'))
+
+
+def cmd_stats(args):
+    """Tamanho das tabelas e dos arquivos"""
+    storage = get_storage()
+    totals = {'pending': 0, 'in_flight': 0, 'executed': 0, 'archived': 0}
+
+    for target in sqlite_backends(storage):
+        with target.connection() as conn:
+            def scalar(sql):
+                return conn.execute(sql).fetchone()[0]
+
+            counts = {
+                'pending': scalar('''
+                    SELECT COUNT(*) FROM device_commands INDEXED BY idx_device_commands_pending
+                    WHERE status = 'pending'
+                '''),
+                'in_flight': scalar('''
+                    SELECT COUNT(*) FROM device_commands INDEXED BY idx_device_commands_in_flight
+                    WHERE status = 'in_flight'
+                '''),
+                'executed': scalar('''
+                    SELECT COUNT(*) FROM device_commands INDEXED BY idx_device_commands_executed
+                    WHERE status = 'executed'
+                '''),
+                'archived': scalar('SELECT COUNT(*) FROM device_commands_archive'),
+            }
+            page_size = scalar('PRAGMA page_size')
+            page_count = scalar('PRAGMA page_count')
+            free_pages = scalar('PRAGMA freelist_count')
+            auto_vacuum = {0: 'none', 1: 'full', 2: 'incremental'}[scalar('PRAGMA auto_vacuum')]
+
+        for key, value in counts.items():
+            totals[key] += value
+
+        print(f"💾 {target.db_path or DB_NAME}")
+        print(f"   pendentes:   {counts['pending']}")
+        print(f"   in_flight:   {counts['in_flight']}")
+        print(f"   executados:  {counts['executed']}")
+        print(f"   arquivados:  {counts['archived']}")
+        print(f"   tamanho:     {page_count * page_size / 1024 / 1024:.1f} MB ({page_count} páginas)")
+        print(f"   livre:       {free_pages * page_size / 1024 / 1024:.1f} MB ({free_pages} páginas)")
+        print(f"   auto_vacuum: {auto_vacuum}")
+
+    licenses = storage.main if isinstance(storage, ShardedStorage) else storage
+    with licenses.connection() as conn:
+        license_count = conn.execute('SELECT COUNT(*) FROM licenses').fetchone()[0]
+
+    print("📊 Total")
+    print(f"   pendentes:   {totals['pending']}")
+    print(f"   in_flight:   {totals['in_flight']}")
+    print(f"   executados:  {totals['executed']}")
+    print(f"   arquivados:  {totals['archived']}")
+    print(f"   licenças:    {license_count}")
+    return 0
+
+
+def cmd_archive(args):
+    """Aplica a política de retenção"""
+    policy = RetentionPolicy(
+        days=args.days,
+        keep_per_device=args.keep_per_device,
+        mode='delete' if args.delete else None,
+        archive_db=args.archive_db,
+        batch_size=args.batch_size
+    )
+
+    if not policy.enabled:
+        print("❌ Nenhuma política configurada (use --days, --keep-per-device ou RETENTION_*)")
+        return 1
+
+    start = time.perf_counter()
+    result = archive_commands(policy=policy)
+    elapsed = time.perf_counter() - start
+
+    action = 'removidos' if policy.mode == 'delete' else 'arquivados'
+    print(f"✅ {result['by_age'] + result['by_device_limit']} comandos {action} em {elapsed:.1f}s")
+    print(f"   por idade:            {result['by_age']}")
+    print(f"   por limite do device: {result['by_device_limit']}")
+    return 0
+
+
+def cmd_vacuum(args):
+    """Devolve ao disco o espaço livre"""
+    if args.enable:
+        print("🔄 Convertendo para auto_vacuum=INCREMENTAL (VACUUM completo)...")
+        enable_incremental_vacuum()
+
+    result = incremental_vacuum(max_pages=args.max_pages)
+    if result['auto_vacuum'] != 2:
+        print("⚠️  Banco sem auto_vacuum incremental: rode 'vacuum --enable' uma vez")
+        return 1
+
+    print(f"✅ {result['freed_pages']} páginas liberadas "
+          f"({result['free_pages']} livres, {result['page_count']} no arquivo)")
+    return 0
+
+
+def cmd_reshard(args):
+    """
+    Copia os comandos para um novo conjunto de shards
+
+    Rodar com a API parada. Os ids são preservados; os arquivos de origem
+    (e o arquivo morto) não são alterados.
+    """
+    source = get_storage()
+    target = ShardedStorage(count=args.shards, template=args.template, group_commit='off')
+
+    existing = [shard.db_path for shard in target.shards
+                if os.path.exists(shard.db_path) and os.path.getsize(shard.db_path) > 0]
+    if existing:
+        print(f"❌ Arquivos de destino já existem: {', '.join(existing)}")
+        return 1
+
+    target.init()
+    print(f"🔄 Copiando comandos para {args.shards} shards...")
+
+    start = time.perf_counter()
+    copied = [0] * target.count
+    last_id = 0
+    try:
+        # Linhas completas: sem lease_expires_at um comando in_flight nunca
+        # voltaria para a fila e um devolvido não aceitaria mais o ack
+        rows = source.iter_command_rows()
+        while True:
+            chunk = list(itertools.islice(rows, RESHARD_CHUNK_SIZE))
+            if not chunk:
+                break
+
+            by_shard = {}
+            for row in chunk:
+                by_shard.setdefault(shard_for(row[1], target.count), []).append(('command', row))
+            for shard, writes in by_shard.items():
+                target.shards[shard].apply_writes(writes)
+                copied[shard] += len(writes)
+
+            last_id = chunk[-1][0]
+
+        # Ids novos de todos os shards começam depois do maior id copiado
+        for shard in target.shards:
+            with shard.connection() as conn:
+                conn.execute("DELETE FROM sqlite_sequence WHERE name = 'device_commands'")
+                conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('device_commands', ?)", (last_id,))
+                conn.commit()
+    finally:
+        target.close()
+
+    elapsed = time.perf_counter() - start
+    total = sum(copied)
+    print(f"✅ {total} comandos copiados em {elapsed:.1f}s ({total / max(elapsed, 1e-9):.0f} linhas/s)")
+    for shard, count in zip(target.shards, copied):
+        print(f"   {shard.db_path}: {count}")
+    print(f"➡️  Para usar: STORAGE_BACKEND=sharded SHARD_COUNT={args.shards}"
+          + (f" SHARD_DB_TEMPLATE='{args.template}'" if args.template else ''))
+    return 0
+
+
+def read_licenses(stream, fmt, rejected):
+    """
+    Gera (uuid, license_number) de um CSV (com cabeçalho) ou NDJSON
+
+    Linhas inválidas não interrompem a leitura: são contadas em
+    rejected[motivo].
+    """
+    def reject(reason):
+        rejected[reason] = rejected.get(reason, 0) + 1
+
+    if fmt == 'csv':
+        records = csv.DictReader(stream)
+        if records.fieldnames is None or not {'uuid', 'license_number'} <= set(records.fieldnames):
+            raise ValueError('O CSV precisa das colunas uuid e license_number no cabeçalho')
+    else:
+        def parse(lines):
+            for line in lines:
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    record = None
+                if not isinstance(record, dict):
+                    reject('json inválido')
+                    continue
+                yield record
+        records = parse(stream)
+
+    for record in records:
+        license_uuid = record.get('uuid')
+        license_number = record.get('license_number')
+        if isinstance(license_number, int) and not isinstance(license_number, bool):
+            license_number = str(license_number)
+
+        if not isinstance(license_uuid, str) or not license_uuid.strip():
+            reject('sem uuid')
+        elif not isinstance(license_number, str) or not license_number.strip():
+            reject('sem license_number')
+        else:
+            yield license_uuid.strip(), license_number.strip()
+
+
+def cmd_import_licenses(args):
+    """
+    Importa licenças em massa de um CSV ou NDJSON
+
+    Lê a entrada em blocos de --chunk-size linhas e grava cada bloco com
+    executemany em uma transação, com ON CONFLICT(uuid) DO NOTHING: UUIDs
+    que já existem (no banco ou repetidos no arquivo) contam como
+    duplicados, sem uma exceção por linha.
+
+    Com --staged os blocos vão para uma tabela temporária sem índice e
+    entram em licenses de uma vez, ordenados por uuid: o índice único é
+    preenchido em ordem, em vez de receber UUIDs aleatórios espalhados
+    pela árvore. É o mais rápido para cargas muito grandes, mas a inserção
+    final é uma única transação (rodar fora do pico) e os ids seguem a
+    ordem dos UUIDs, não a do arquivo.
+    """
+    fmt = args.format or ('csv' if args.path.lower().endswith('.csv') else 'ndjson')
+
+    storage = get_storage()
+    target = storage.main if isinstance(storage, ShardedStorage) else storage
+
+    if args.path == '-':
+        stream = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8', newline='')
+    else:
+        stream = open(args.path, encoding='utf-8', newline='')
+
+    print(f"🔄 Importando licenças de {args.path} ({fmt}{', staged' if args.staged else ''})...")
+    rejected = {}
+    valid = 0
+    start = time.perf_counter()
+
+    try:
+        rows = read_licenses(stream, fmt, rejected)
+        with target.connection() as conn:
+            if args.staged:
+                conn.execute('DROP TABLE IF EXISTS temp.license_import')
+                conn.execute('CREATE TEMP TABLE license_import (uuid TEXT, license_number TEXT)')
+                sql = 'INSERT INTO temp.license_import (uuid, license_number) VALUES (?, ?)'
+            else:
+                sql = '''
+                    INSERT INTO licenses (uuid, license_number) VALUES (?, ?)
+                    ON CONFLICT(uuid) DO NOTHING
+                '''
+
+            changes = conn.total_changes
+            while True:
+                chunk = list(itertools.islice(rows, args.chunk_size))
+                if not chunk:
+                    break
+                conn.executemany(sql, chunk)
+                conn.commit()
+                valid += len(chunk)
+                print(f"   {valid} linhas ({valid / (time.perf_counter() - start):.0f} linhas/s)")
+
+            if args.staged:
+                print("🔄 Inserindo em licenses, ordenado por uuid...")
+                changes = conn.total_changes
+                # WHERE true: sem ele o SQLite lê o ON CONFLICT como parte do SELECT
+                conn.execute('''
+                    INSERT INTO licenses (uuid, license_number)
+                    SELECT uuid, license_number FROM temp.license_import
+                    WHERE true
+                    ORDER BY uuid
+                    ON CONFLICT(uuid) DO NOTHING
+                ''')
+                conn.commit()
+                inserted = conn.total_changes - changes
+                conn.execute('DROP TABLE temp.license_import')
+            else:
+                inserted = conn.total_changes - changes
+    except ValueError as e:
+        print(f"❌ {e}")
+        return 1
+    finally:
+        if args.path != '-':
+            stream.close()
+
+    elapsed = time.perf_counter() - start
+    total = valid + sum(rejected.values())
+    print(f"✅ {inserted} licenças importadas em {elapsed:.1f}s ({total / max(elapsed, 1e-9):.0f} linhas/s)")
+    print(f"   lidas:       {total}")
+    print(f"   duplicadas:  {valid - inserted}")
+    print(f"   rejeitadas:  {sum(rejected.values())}")
+    for reason, count in sorted(rejected.items()):
+        print(f"      {reason}: {count}")
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Manutenção do banco da Device Command API')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    stats = commands.add_parser('stats', help='Tamanho das tabelas e do arquivo')
+    stats.set_defaults(func=cmd_stats)
+
+    archive = commands.add_parser('archive', help='Arquiva comandos executados antigos')
+    archive.add_argument('--days', type=float, help='Arquiva executados há mais de N dias')
+    archive.add_argument('--keep-per-device', type=int, help='Mantém os M executados mais recentes por device')
+    archive.add_argument('--delete', action='store_true', help='Remove sem copiar para o arquivo morto')
+    archive.add_argument('--archive-db', help='Arquivo SQLite separado para o arquivo morto')
+    archive.add_argument('--batch-size', type=int, help='Linhas movidas por transação')
+    archive.set_defaults(func=cmd_archive)
+
+    vacuum = commands.add_parser('vacuum', help='Incremental vacuum em passos curtos')
+    vacuum.add_argument('--max-pages', type=int, help='Limite de páginas liberadas nesta execução')
+    vacuum.add_argument('--enable', action='store_true',
+                        help='Converte o banco para auto_vacuum incremental (VACUUM completo)')
+    vacuum.set_defaults(func=cmd_vacuum)
+
+    reshard = commands.add_parser('reshard', help='Redistribui os comandos em N shards (API parada)')
+    reshard.add_argument('--shards', type=int, required=True, help='Quantidade de shards de destino')
+    reshard.add_argument('--template', help='Template dos arquivos de destino (padrão: SHARD_DB_TEMPLATE)')
+    reshard.set_defaults(func=cmd_reshard)
+
+    licenses = commands.add_parser('import-licenses', help='Importa licenças em massa (CSV ou NDJSON)')
+    licenses.add_argument('path', help="Arquivo de entrada ('-' para stdin)")
+    licenses.add_argument('--format', choices=('csv', 'ndjson'),
+                          help='Formato da entrada (padrão: pela extensão; .csv ou NDJSON)')
+    licenses.add_argument('--chunk-size', type=int, default=LICENSE_IMPORT_CHUNK_SIZE,
+                          help='Linhas por transação')
+    licenses.add_argument('--staged', action='store_true',
+                          help='Carrega em tabela temporária e insere ordenado por uuid (cargas muito grandes)')
+    licenses.set_defaults(func=cmd_import_licenses)
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    print(f"🗄️  Banco: {os.path.abspath(DB_NAME)}")
+
+    # O CLI trabalha direto nos arquivos: o engine em memória é lido pelo
+    # seu SQLite de persistência e nenhuma thread de group commit é criada
+    if STORAGE_BACKEND == 'sharded':
+        configure_storage(ShardedStorage(group_commit='off'))
+    else:
+        configure_storage(SQLiteStorage(group_commit='off'))
+
+    init_db()
+    try:
+        return args.func(args)
+    finally:
+        close_storage()
+        close_pool()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,361 @@
+"""
+Métricas no formato de exposição de texto do Prometheus
+
+Contadores e histogramas ficam em dicts por thread: cada thread só escreve
+no seu próprio dict, então registrar uma métrica não usa lock. A leitura
+(scrape) copia e soma os dicts de todas as threads. Os dicts de threads
+encerradas (servidores com uma thread por conexão criam threads o tempo
+todo) são somados a um total acumulado e descartados, no scrape ou quando
+o registro dobra de tamanho.
+
+Gauges (pool, cache, fila) são coletados no momento do scrape por
+funções registradas com register_collector.
+
+Com vários workers (gunicorn), defina METRICS_MULTIPROC_DIR: cada processo
+grava periodicamente um snapshot em <dir>/metrics-<pid>.json e o scrape
+soma os snapshots de todos os processos. Contadores de workers encerrados
+continuam somando; gauges só entram enquanto o processo existe.
+"""
+
+import bisect
+import functools
+import glob
+import json
+import os
+import threading
+import time
+
+METRICS_MULTIPROC_DIR = os.environ.get('METRICS_MULTIPROC_DIR', '')
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', '5'))
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Limites dos buckets dos histogramas, em segundos
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+           0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# nome -> (tipo, descrição)
+_metadata = {}
+
+# Dicts por thread e o registro de todos eles
+_local = threading.local()
+_shards = []
+_shards_lock = threading.Lock()
+# Quantidade de dicts que dispara a limpeza das threads encerradas
+_prune_at = 64
+
+# Funções que retornam gauges no momento do scrape
+_collectors = []
+
+
+class _Shard:
+    """Contadores e histogramas escritos por uma única thread"""
+
+    def __init__(self, thread=None):
+        self.thread = thread
+        self.counters = {}
+        self.histograms = {}
+
+    def merge(self, other):
+        """Soma os valores de outro shard neste"""
+        # dict.copy e list() são atômicos no CPython
+        for key, value in other.counters.copy().items():
+            self.counters[key] = self.counters.get(key, 0) + value
+        for key, values in other.histograms.copy().items():
+            values = list(values)
+            total = self.histograms.get(key)
+            self.histograms[key] = values if total is None else [a + b for a, b in zip(total, values)]
+
+
+# Valores das threads já encerradas (só alterado com _shards_lock)
+_retired = _Shard()
+
+
+def _prune():
+    """Soma os shards de threads encerradas em _retired e os descarta (com _shards_lock)"""
+    global _prune_at
+    alive = []
+    for shard in _shards:
+        if shard.thread.is_alive():
+            alive.append(shard)
+        else:
+            _retired.merge(shard)
+    _shards[:] = alive
+    _prune_at = max(64, 2 * len(alive))
+
+
+def _shard():
+    try:
+        return _local.shard
+    except AttributeError:
+        shard = _local.shard = _Shard(threading.current_thread())
+        with _shards_lock:
+            _shards.append(shard)
+            if len(_shards) >= _prune_at:
+                _prune()
+        return shard
+
+
+def describe(name, kind, help_text):
+    """Registra tipo e descrição de uma métrica"""
+    _metadata[name] = (kind, help_text)
+
+
+def inc(name, labels=(), value=1):
+    """Incrementa um contador; labels é uma tupla de pares (nome, valor)"""
+    counters = _shard().counters
+    key = (name, labels)
+    counters[key] = counters.get(key, 0) + value
+
+
+def observe(name, labels, seconds):
+    """Registra uma observação (em segundos) em um histograma"""
+    histograms = _shard().histograms
+    key = (name, labels)
+    values = histograms.get(key)
+    if values is None:
+        # Um contador por bucket (+Inf no fim), soma e quantidade
+        values = histograms[key] = [0] * (len(BUCKETS) + 1) + [0.0, 0]
+    values[bisect.bisect_left(BUCKETS, seconds)] += 1
+    values[-2] += seconds
+    values[-1] += 1
+
+
+# Tempo de banco acumulado na requisição atual da thread
+def reset_db_time():
+    _local.db_time = 0.0
+
+
+def db_time():
+    return getattr(_local, 'db_time', 0.0)
+
+
+def timed(method):
+    """
+    Decorator para métodos de models.py que acessam o banco
+
+    Registra a duração em device_api_db_query_duration_seconds e soma no
+    tempo de banco da requisição atual.
+    """
+    labels = (('method', method),)
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                observe('device_api_db_query_duration_seconds', labels, elapsed)
+                _local.db_time = getattr(_local, 'db_time', 0.0) + elapsed
+        return wrapper
+
+    return decorator
+
+
+def register_collector(func, per_process=True):
+    """
+    Registra func() -> [(nome, labels, valor)] chamada a cada scrape
+
+    per_process=False indica valores globais (lidos do banco): não entram
+    no snapshot dos processos e não são somados entre workers.
+    """
+    _collectors.append((func, per_process))
+
+
+def _collect(per_process):
+    gauges = {}
+    for func, collector_per_process in _collectors:
+        if collector_per_process != per_process:
+            continue
+        try:
+            for name, labels, value in func():
+                gauges[(name, labels)] = gauges.get((name, labels), 0) + value
+        except Exception as e:
+            print(f"❌ Erro no coletor de métricas {func.__name__}: {e}")
+    return gauges
+
+
+def snapshot():
+    """Soma dos contadores e histogramas de todas as threads do processo"""
+    total = _Shard()
+    with _shards_lock:
+        _prune()
+        total.merge(_retired)
+        shards = list(_shards)
+
+    for shard in shards:
+        total.merge(shard)
+
+    return total.counters, total.histograms
+
+
+# Snapshots entre processos
+
+def _encode(entries):
+    return [[name, [list(pair) for pair in labels], value] for (name, labels), value in entries.items()]
+
+
+def _decode(entries):
+    return {(name, tuple(tuple(pair) for pair in labels)): value for name, labels, value in entries}
+
+
+def write_snapshot():
+    """Grava o snapshot deste processo em METRICS_MULTIPROC_DIR"""
+    if not METRICS_MULTIPROC_DIR:
+        return
+
+    counters, histograms = snapshot()
+    data = {
+        'pid': os.getpid(),
+        'counters': _encode(counters),
+        'histograms': _encode(histograms),
+        'gauges': _encode(_collect(per_process=True)),
+    }
+
+    path = os.path.join(METRICS_MULTIPROC_DIR, f'metrics-{os.getpid()}.json')
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as snapshot_file:
+        json.dump(data, snapshot_file)
+    os.replace(tmp_path, path)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _merge_processes():
+    """Soma os snapshots de todos os processos"""
+    counters, histograms, gauges = {}, {}, {}
+
+    for path in glob.glob(os.path.join(METRICS_MULTIPROC_DIR, 'metrics-*.json')):
+        try:
+            with open(path) as snapshot_file:
+                data = json.load(snapshot_file)
+        except (OSError, ValueError):
+            continue
+
+        for key, value in _decode(data['counters']).items():
+            counters[key] = counters.get(key, 0) + value
+        for key, values in _decode(data['histograms']).items():
+            total = histograms.get(key)
+            histograms[key] = values if total is None else [a + b for a, b in zip(total, values)]
+        if _alive(data['pid']):
+            for key, value in _decode(data['gauges']).items():
+                gauges[key] = gauges.get(key, 0) + value
+
+    return counters, histograms, gauges
+
+
+def clear_multiproc_dir():
+    """Remove snapshots de execuções anteriores (chamar antes de subir os workers)"""
+    if METRICS_MULTIPROC_DIR:
+        os.makedirs(METRICS_MULTIPROC_DIR, exist_ok=True)
+        for path in glob.glob(os.path.join(METRICS_MULTIPROC_DIR, 'metrics-*.json')):
+            os.remove(path)
+
+
+class SnapshotWriter:
+    """Thread que grava o snapshot do processo a cada METRICS_FLUSH_INTERVAL"""
+
+    def __init__(self, interval=None):
+        self.interval = METRICS_FLUSH_INTERVAL if interval is None else interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if not METRICS_MULTIPROC_DIR or self._thread is not None:
+            return
+        os.makedirs(METRICS_MULTIPROC_DIR, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name='metrics-snapshot', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+            write_snapshot()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                write_snapshot()
+            except Exception as e:
+                print(f"❌ Erro ao gravar snapshot de métricas: {e}")
+
+
+snapshot_writer = SnapshotWriter()
+
+
+# Formato de exposição
+
+def _format_labels(labels, extra=()):
+    pairs = tuple(labels) + tuple(extra)
+    if not pairs:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"'))
+        for name, value in pairs
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def render():
+    """Todas as métricas no formato de texto do Prometheus"""
+    if METRICS_MULTIPROC_DIR:
+        write_snapshot()
+        counters, histograms, gauges = _merge_processes()
+    else:
+        counters, histograms = snapshot()
+        gauges = _collect(per_process=True)
+    gauges.update(_collect(per_process=False))
+
+    by_name = {}
+    for source in (counters, gauges):
+        for (name, labels), value in source.items():
+            by_name.setdefault(name, []).append((labels, value))
+    for (name, labels), values in histograms.items():
+        by_name.setdefault(name, []).append((labels, values))
+
+    lines = []
+    for name in sorted(by_name):
+        kind, help_text = _metadata.get(name, ('untyped', ''))
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+
+        for labels, value in sorted(by_name[name], key=lambda entry: entry[0]):
+            if kind != 'histogram':
+                lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+                continue
+
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ('+Inf',), value):
+                cumulative += count
+                lines.append(f'{name}_bucket{_format_labels(labels, (("le", bound),))} {cumulative}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {_format_value(float(value[-2]))}')
+            lines.append(f'{name}_count{_format_labels(labels)} {value[-1]}')
+
+    return '\n'.join(lines) + '\n'
+
+
+describe('device_api_requests_total', 'counter', 'Requisições HTTP por rota, método e status')
+describe('device_api_request_duration_seconds', 'histogram', 'Duração das requisições HTTP por rota')
+describe('device_api_request_db_seconds', 'histogram', 'Tempo de banco por requisição HTTP, por rota')
+describe('device_api_db_query_duration_seconds', 'histogram', 'Duração dos métodos de models.py que acessam o banco')
+describe('device_api_claims_total', 'counter', 'Consultas de pendentes por resultado (hit: havia comando)')
+describe('device_api_commands_delivered_total', 'counter', 'Comandos entregues aos devices')
+describe('device_api_commands_created_total', 'counter', 'Comandos criados')
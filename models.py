@@ -1,272 +1,379 @@
-import sqlite3
-from datetime import datetime
+import os
+import time
+from datetime import datetime, timedelta, timezone
 
-DB_NAME = 'device_commands.db'
+import metrics
+from cache import MISSING, TTLCache
+from leases import lease_deadline
+from notifications import notifier
+from presence import presence
+from storage import get_storage
+
+# Status possíveis de um comando (in_flight: entregue com lease, aguardando ack)
+COMMAND_STATUSES = ('pending', 'in_flight', 'executed')
+
+# Tamanho de página padrão e máximo das listagens paginadas
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Cache de licenças por UUID (o cache negativo guarda UUIDs inexistentes)
+LICENSE_CACHE_SIZE = int(os.environ.get('LICENSE_CACHE_SIZE', '10000'))
+LICENSE_CACHE_TTL = float(os.environ.get('LICENSE_CACHE_TTL', '300'))
+LICENSE_CACHE_NEGATIVE_TTL = float(os.environ.get('LICENSE_CACHE_NEGATIVE_TTL', '30'))
+
+license_cache = TTLCache(LICENSE_CACHE_SIZE, LICENSE_CACHE_TTL, LICENSE_CACHE_NEGATIVE_TTL)
 
 def init_db():
     """Inicializa o banco de dados simplificado"""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    
-    # Tabela única para comandos por device
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS device_commands (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            device_id TEXT NOT NULL,
-            command TEXT NOT NULL,
-            status TEXT DEFAULT 'pending',
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            executed_at TIMESTAMP NULL
-        )
-    ''')
-    
-    # Tabela para licenças por UUID
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS licenses (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            uuid TEXT UNIQUE NOT NULL,
-            license_number TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    conn.commit()
-    conn.close()
+    get_storage().init()
+
+def _pending_dict(row):
+    """Linha (id, command, created_at) no formato entregue ao device"""
+    return {
+        'id': row[0],
+        'command': row[1],
+        'created_at': row[2]
+    }
+
+def _command_dict(row):
+    """Linha completa de device_commands como dict"""
+    return {
+        'id': row[0],
+        'device_id': row[1],
+        'command': row[2],
+        'status': row[3],
+        'created_at': row[4],
+        'executed_at': row[5]
+    }
 
 class DeviceCommand:
     @staticmethod
+    @metrics.timed('DeviceCommand.add_command')
     def add_command(device_id, command):
         """Adiciona comando para um device"""
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT INTO device_commands (device_id, command)
-            VALUES (?, ?)
-        ''', (device_id, command))
-        
-        conn.commit()
-        command_id = cursor.lastrowid
-        conn.close()
-        
+        command_id = get_storage().add_command(device_id, command)
+        metrics.inc('device_api_commands_created_total')
+        presence.mark(device_id)
+
+        # Acorda requisições em long-poll aguardando este device
+        notifier.notify(device_id)
+
         return command_id
-    
+
     @staticmethod
-    def get_pending_command(device_id):
+    @metrics.timed('DeviceCommand.add_commands')
+    def add_commands(commands):
+        """
+        Adiciona vários comandos em uma única transação
+
+        Recebe uma lista de tuplas (device_id, command) e retorna os ids
+        atribuídos, na mesma ordem.
+        """
+        command_ids = get_storage().add_commands(commands)
+        metrics.inc('device_api_commands_created_total', value=len(command_ids))
+
+        device_ids = {device_id for device_id, _ in commands}
+        presence.mark_many(device_ids)
+        for device_id in device_ids:
+            notifier.notify(device_id)
+
+        return command_ids
+
+    @staticmethod
+    @metrics.timed('DeviceCommand.get_pending_row')
+    def get_pending_row(device_id, lease=None):
+        """
+        Claim do próximo comando pendente como linha (id, command, created_at)
+
+        O claim é atômico: localizar e marcar o comando mais antigo como
+        executado acontece em um único passo, então dois workers nunca
+        entregam o mesmo comando. Com lease (segundos) o comando fica
+        in_flight até o ack e volta para a fila se o lease vencer.
+        Devices fora do índice de presença são respondidos sem consultar
+        o banco.
+        """
+        token = presence.token(device_id)
+        if token is None:
+            DeviceCommand.record_presence_skip()
+            return None
+
+        storage = get_storage()
+        rows = storage.claim(device_id, 1, lease_deadline(lease) if lease else None)
+
+        if rows:
+            metrics.inc('device_api_claims_total', (('result', 'hit'),))
+            metrics.inc('device_api_commands_delivered_total')
+            return rows[0]
+
+        # Com comandos in_flight o device continua marcado: um lease
+        # vencido (devolvido por qualquer processo) volta a ser entregue
+        if presence.enabled and not storage.in_flight_devices([device_id]):
+            presence.discard(device_id, token)
+        metrics.inc('device_api_claims_total', (('result', 'miss'),))
+        return None
+
+    @staticmethod
+    def has_no_pending(device_id):
+        """
+        True se o índice de presença garante que o device não tem pendentes
+
+        Permite ao servidor ASGI responder sem passar pelo executor do banco.
+        """
+        if presence.token(device_id) is None:
+            DeviceCommand.record_presence_skip()
+            return True
+        return False
+
+    @staticmethod
+    def record_presence_skip():
+        metrics.inc('device_api_claims_total', (('result', 'miss'),))
+        metrics.inc('device_api_presence_skips_total')
+
+    @staticmethod
+    def get_pending_command(device_id, lease=None):
         """Busca próximo comando pendente para o device"""
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT id, command, created_at
-            FROM device_commands
-            WHERE device_id = ? AND status = 'pending'
-            ORDER BY created_at ASC
-            LIMIT 1
-        ''', (device_id,))
-        
-        result = cursor.fetchone()
-        
-        if result:
-            # Marca como executado
-            cursor.execute('''
-                UPDATE device_commands 
-                SET status = 'executed', executed_at = CURRENT_TIMESTAMP
-                WHERE id = ?
-            ''', (result[0],))
-            
-            conn.commit()
-            
-            command = {
-                'id': result[0],
-                'command': result[1],
-                'created_at': result[2]
-            }
-        else:
-            command = None
-            
-        conn.close()
-        return command
-    
+        row = DeviceCommand.get_pending_row(device_id, lease)
+        return _pending_dict(row) if row else None
+
     @staticmethod
-    def get_all_commands():
-        """Retorna todos os comandos (para debug/admin)"""
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT id, device_id, command, status, created_at, executed_at
-            FROM device_commands
-            ORDER BY created_at DESC
-        ''')
-        
-        results = cursor.fetchall()
-        conn.close()
-        
-        return [{
-            'id': row[0],
-            'device_id': row[1],
-            'command': row[2],
-            'status': row[3],
-            'created_at': row[4],
-            'executed_at': row[5]
-        } for row in results]
+    def wait_for_pending_row(device_id, timeout, lease=None):
+        """
+        Aguarda até `timeout` segundos por um comando pendente do device
+
+        A espera é acordada por add_command através do notifier; o banco só
+        é consultado de novo quando chega uma notificação.
+        """
+        deadline = time.monotonic() + timeout
+
+        # Inscreve antes de consultar para não perder notificações
+        with notifier.subscribe(device_id) as event:
+            while True:
+                row = DeviceCommand.get_pending_row(device_id, lease)
+                if row:
+                    return row
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not event.wait(remaining):
+                    return None
+
+                event.clear()
 
-class License:
     @staticmethod
-    def get_license_by_uuid(uuid):
-        """Retorna número de licença pelo UUID"""
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT license_number, created_at
-            FROM licenses
-            WHERE uuid = ?
-        ''', (uuid,))
-        
-        result = cursor.fetchone()
-        conn.close()
-        
-        if result:
-            return {
-                'uuid': uuid,
-                'license_number': result[0],
-                'created_at': result[1]
-            }
-        return None
-    
+    @metrics.timed('DeviceCommand.ack')
+    def ack(device_id, command_ids):
+        """
+        Confirma a execução de comandos entregues com lease
+
+        Retorna os ids confirmados; ids de outro device, não entregues com
+        lease ou já confirmados são ignorados.
+        """
+        acked = get_storage().ack(device_id, command_ids)
+        metrics.inc('device_api_commands_acked_total', value=len(acked))
+        return acked
+
     @staticmethod
-    def add_license(uuid, license_number):
-        """Adiciona uma nova licença"""
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        
-        try:
-            cursor.execute('''
-                INSERT INTO licenses (uuid, license_number)
-                VALUES (?, ?)
-            ''', (uuid, license_number))
-            
-            conn.commit()
-            license_id = cursor.lastrowid
-            conn.close()
-            return license_id
-            
-        except sqlite3.IntegrityError:
-            conn.close()
-            raise ValueError("UUID já existe no banco de dados")
-    
+    @metrics.timed('DeviceCommand.get_delivered_commands_since')
+    def get_delivered_commands_since(device_id, last_id, window, limit):
+        """
+        Comandos já entregues ao device com id maior que last_id (reenvio)
+
+        Só os executados nos últimos `window` segundos, no máximo `limit`:
+        um Last-Event-ID antigo não reenvia o histórico inteiro.
+        """
+        executed_from = (datetime.now(timezone.utc) - timedelta(seconds=window)).strftime('%Y-%m-%d %H:%M:%S')
+        rows = get_storage().delivered_since(device_id, last_id, executed_from, limit)
+        return [_pending_dict(row) for row in rows]
+
     @staticmethod
-    def get_all_licenses():
-        """Retorna todas as licenças (para debug/admin)"""
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT id, uuid, license_number, created_at
-            FROM licenses
-            ORDER BY created_at DESC
-        ''')
-        
-        results = cursor.fetchall()
-        conn.close()
-        
-        return [{
-            'id': row[0],
-            'uuid': row[1],
-            'license_number': row[2],
-            'created_at': row[3]
-        } for row in results]
-    
+    @metrics.timed('DeviceCommand.claim_pending_commands')
+    def claim_pending_commands(device_ids, max_per_device=1, lease=None):
+        """
+        Claim em lote para gateways que consultam vários devices
+
+        Marca até max_per_device comandos pendentes de cada device como
+        executados (ou in_flight, com lease), tudo em uma única transação,
+        e retorna um dict {device_id: [comandos]} apenas com os devices
+        que tinham comandos.
+        """
+        storage = get_storage()
+        tokens = {device_id: presence.token(device_id) for device_id in device_ids}
+        candidates = [device_id for device_id, token in tokens.items() if token is not None]
+
+        lease_until = lease_deadline(lease) if lease else None
+        claimed = storage.claim_many(candidates, max_per_device, lease_until) if candidates else {}
+
+        # Quem recebeu menos que o pedido esvaziou a fila (e sem in_flight
+        # não tem lease para voltar)
+        drained = [device_id for device_id in candidates
+                   if len(claimed.get(device_id, ())) < max_per_device]
+        if presence.enabled and drained:
+            in_flight = storage.in_flight_devices(drained)
+            for device_id in drained:
+                if device_id not in in_flight:
+                    presence.discard(device_id, tokens[device_id])
+        metrics.inc('device_api_presence_skips_total', value=len(tokens) - len(candidates))
+
+        metrics.inc('device_api_claims_total', (('result', 'hit'),), len(claimed))
+        metrics.inc('device_api_claims_total', (('result', 'miss'),), len(device_ids) - len(claimed))
+        metrics.inc('device_api_commands_delivered_total', value=sum(len(rows) for rows in claimed.values()))
+
+        return {
+            device_id: [_pending_dict(row) for row in rows]
+            for device_id, rows in claimed.items()
+        }
+
+    @staticmethod
+    @metrics.timed('DeviceCommand.list_commands')
+    def list_commands(device_id=None, status=None, created_from=None,
+                      created_to=None, after_id=None, limit=DEFAULT_PAGE_SIZE,
+                      order='desc'):
+        """
+        Lista comandos com filtros e paginação por cursor (keyset)
+
+        Ordena por id (desc por padrão, os mais novos primeiro). Retorna a
+        tupla (comandos, next_cursor); next_cursor é o after_id da próxima
+        página ou None quando não há mais resultados.
+        """
+        filters = {
+            'device_id': device_id,
+            'status': status,
+            'created_from': created_from,
+            'created_to': created_to,
+            'after_id': after_id,
+            'order': order
+        }
+        commands = [_command_dict(row) for row in get_storage().list_commands(filters, limit)]
+
+        next_cursor = commands[-1]['id'] if len(commands) == limit else None
+        return commands, next_cursor
+
+    @staticmethod
+    @metrics.timed('DeviceCommand.get_history_validators')
+    def get_history_validators(device_id):
+        """
+        Validadores (etag, last_modified) do histórico de um device
+
+        O histórico muda quando um comando é inserido (maior id), arquivado
+        (total), entregue ou confirmado (contagens de pendentes e in_flight)
+        e a cada lease ou devolução (lease_expires_at), então esses valores
+        bastam como versão, sem ler as linhas do histórico. Leases in_flight
+        vencem no futuro: Last-Modified fica limitado a agora.
+        """
+        (max_id, total, pending, in_flight,
+         last_created, last_executed, last_lease) = get_storage().history_validators(device_id)
+
+        lease_version = ''.join(filter(str.isdigit, last_lease or '')) or '0'
+        etag = f'{max_id or 0}-{total}-{pending}-{in_flight}-{lease_version}'
+
+        # Mesmo formato do CURRENT_TIMESTAMP do SQLite (lease tem microssegundos)
+        last_lease = last_lease[:19] if last_lease else None
+        last_modified = max(filter(None, (last_created, last_executed, last_lease)), default=None)
+        if last_modified is not None:
+            last_modified = min(last_modified, datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S'))
+        return etag, last_modified
+
+    @staticmethod
+    @metrics.timed('DeviceCommand.count_by_status')
+    def count_by_status():
+        """Quantidade de comandos por status (profundidade da fila)"""
+        counts = get_storage().count_by_status()
+        return {status: counts.get(status, 0) for status in COMMAND_STATUSES}
+
     @staticmethod
+    def iter_commands(device_id=None, status=None, created_from=None,
+                      created_to=None, after_id=None, order='desc'):
+        """
+        Percorre os comandos filtrados sem carregar tudo em memória
+
+        O backend lê o cursor em blocos; a conexão fica reservada até o
+        gerador terminar ou ser fechado.
+        """
+        filters = {
+            'device_id': device_id,
+            'status': status,
+            'created_from': created_from,
+            'created_to': created_to,
+            'after_id': after_id,
+            'order': order
+        }
+        for row in get_storage().iter_commands(filters):
+            yield _command_dict(row)
+
+    @staticmethod
+    @metrics.timed('DeviceCommand.get_all_commands')
+    def get_all_commands():
+        """Retorna todos os comandos (para debug/admin)"""
+        return list(DeviceCommand.iter_commands())
+
+    @staticmethod
+    @metrics.timed('DeviceCommand.get_commands_by_device')
     def get_commands_by_device(device_id):
         """Retorna todos os comandos de um dispositivo específico"""
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT id, device_id, command, status, created_at, executed_at
-            FROM device_commands
-            WHERE device_id = ?
-            ORDER BY created_at DESC
-        ''', (device_id,))
-        
-        results = cursor.fetchall()
-        conn.close()
-        
-        return [{
-            'id': row[0],
-            'device_id': row[1],
-            'command': row[2],
-            'status': row[3],
-            'created_at': row[4],
-            'executed_at': row[5]
-        } for row in results]
+        return list(DeviceCommand.iter_commands(device_id=device_id))
 
 class License:
     @staticmethod
+    @metrics.timed('License.get_license_by_uuid')
     def get_license_by_uuid(uuid):
-        """Retorna número de licença pelo UUID"""
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT license_number, created_at
-            FROM licenses
-            WHERE uuid = ?
-        ''', (uuid,))
-        
-        result = cursor.fetchone()
-        conn.close()
-        
+        """Retorna número de licença pelo UUID (com cache em memória)"""
+        cached = license_cache.get(uuid)
+        if cached is not MISSING:
+            return cached
+
+        result = get_storage().get_license(uuid)
+
+        license_data = None
         if result:
-            return {
+            license_data = {
                 'uuid': uuid,
                 'license_number': result[0],
                 'created_at': result[1]
             }
-        return None
-    
+
+        # Guarda também o "não encontrado" para não repetir a consulta
+        license_cache.set(uuid, license_data)
+        return license_data
+
     @staticmethod
+    @metrics.timed('License.add_license')
     def add_license(uuid, license_number):
         """Adiciona uma nova licença"""
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        
-        try:
-            cursor.execute('''
-                INSERT INTO licenses (uuid, license_number)
-                VALUES (?, ?)
-            ''', (uuid, license_number))
-            
-            conn.commit()
-            license_id = cursor.lastrowid
-            conn.close()
-            return license_id
-            
-        except sqlite3.IntegrityError:
-            conn.close()
-            raise ValueError("UUID já existe no banco de dados")
-    
+        license_id = get_storage().add_license(uuid, license_number)
+
+        # Remove um possível "não encontrado" guardado no cache
+        license_cache.invalidate(uuid)
+        return license_id
+
+    @staticmethod
+    def get_license_validators(license_data):
+        """
+        Validadores (etag, last_modified) de uma licença
+
+        Licenças não são alteradas depois de criadas, então UUID e data de
+        criação identificam a versão.
+        """
+        created_at = license_data['created_at']
+        etag = f"{license_data['uuid']}-{created_at.replace(' ', 'T')}"
+        return etag, created_at
+
+    @staticmethod
+    def cache_stats():
+        """Estatísticas do cache de licenças"""
+        return license_cache.stats()
+
+    @staticmethod
+    def iter_licenses():
+        """Percorre todas as licenças sem carregar tudo em memória"""
+        for row in get_storage().iter_licenses():
+            yield {
+                'id': row[0],
+                'uuid': row[1],
+                'license_number': row[2],
+                'created_at': row[3]
+            }
+
     @staticmethod
+    @metrics.timed('License.get_all_licenses')
     def get_all_licenses():
         """Retorna todas as licenças (para debug/admin)"""
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT id, uuid, license_number, created_at
-            FROM licenses
-            ORDER BY created_at DESC
-        ''')
-        
-        results = cursor.fetchall()
-        conn.close()
-        
-        return [{
-            'id': row[0],
-            'uuid': row[1],
-            'license_number': row[2],
-            'created_at': row[3]
-        } for row in results] 
\ No newline at end of file
+        return list(License.iter_licenses())
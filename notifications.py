@@ -0,0 +1,67 @@
+"""
+Registro de notificações por device
+
+Permite que requisições fiquem aguardando (long-poll) até que um novo
+comando seja enfileirado para o device, sem consultar o banco em loop.
+O registro vale apenas dentro do processo atual.
+
+Além dos eventos de threads, aceita listeners (callbacks chamados com o
+device_id), usados pelo servidor ASGI para acordar o event loop.
+"""
+
+import threading
+from contextlib import contextmanager
+
+
+class DeviceNotifier:
+    """Acorda quem está aguardando comandos de um device"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waiters = {}
+        self._listeners = []
+
+    def add_listener(self, callback):
+        """Registra callback(device_id) chamado a cada notificação"""
+        self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        if callback in self._listeners:
+            self._listeners.remove(callback)
+
+    @contextmanager
+    def subscribe(self, device_id):
+        """Registra um evento que será sinalizado a cada novo comando do device"""
+        event = threading.Event()
+
+        with self._lock:
+            self._waiters.setdefault(device_id, set()).add(event)
+
+        try:
+            yield event
+        finally:
+            with self._lock:
+                waiters = self._waiters.get(device_id)
+                if waiters is not None:
+                    waiters.discard(event)
+                    if not waiters:
+                        del self._waiters[device_id]
+
+    def notify(self, device_id):
+        """Sinaliza todos os que aguardam comandos do device"""
+        with self._lock:
+            waiters = list(self._waiters.get(device_id, ()))
+
+        for event in waiters:
+            event.set()
+
+        for callback in self._listeners:
+            callback(device_id)
+
+    def waiting_count(self):
+        """Quantidade de requisições aguardando no momento"""
+        with self._lock:
+            return sum(len(waiters) for waiters in self._waiters.values())
+
+
+notifier = DeviceNotifier()
@@ -0,0 +1,134 @@
+"""
+Intervalo sugerido para o próximo poll dos devices
+
+As respostas de /api/device/<device_id>/pending trazem o header
+Retry-After (segundos inteiros) e o campo next_poll no corpo. Assim o
+servidor controla o ritmo da frota sem regravar o firmware:
+
+- Device que acabou de receber um comando pode ter mais na fila: volta em
+  POLL_INTERVAL_MIN segundos, assim como o device que o índice de presença
+  sabe ter pendentes. Esses nunca são espaçados pela carga.
+- Long-poll que terminou vazio também volta em POLL_INTERVAL_MIN (a
+  espera já aconteceu no servidor).
+- Device sem comando usa POLL_INTERVAL; se recebeu algum comando nos
+  últimos POLL_ACTIVE_WINDOW segundos, o intervalo cai pela metade.
+- A carga do processo (ocupação do pool de conexões e fila do group
+  commit, a mais alta) acima de POLL_LOAD_THRESHOLD multiplica o
+  intervalo dos devices sem pendentes até POLL_LOAD_FACTOR vezes.
+  Opcionalmente (POLL_WARMUP > 0), nos primeiros POLL_WARMUP segundos
+  depois de subir a carga parte de 1 e cai linearmente, para quem sabe
+  que cada início do processo é a volta de uma queda. Fica desligado por
+  padrão: reciclagem de workers (max_requests) e reloads também reiniciam
+  o processo.
+- O intervalo fica entre POLL_INTERVAL_MIN e POLL_INTERVAL_MAX e recebe
+  jitter de ±POLL_JITTER para espalhar os devices.
+
+A carga é recalculada no máximo a cada POLL_LOAD_TTL segundos; o caminho
+quente só lê o valor em cache.
+"""
+
+import math
+import os
+import random
+import threading
+import time
+
+from cache import MISSING, TTLCache
+from presence import presence
+from storage import ShardedStorage, get_storage, sqlite_backends
+
+POLL_INTERVAL = float(os.environ.get('POLL_INTERVAL', '10'))
+POLL_INTERVAL_MIN = float(os.environ.get('POLL_INTERVAL_MIN', '1'))
+POLL_INTERVAL_MAX = float(os.environ.get('POLL_INTERVAL_MAX', '120'))
+
+# Variação aleatória relativa aplicada a cada sugestão
+POLL_JITTER = float(os.environ.get('POLL_JITTER', '0.2'))
+
+# Devices que receberam comandos recentemente (janela e quantidade lembrada)
+POLL_ACTIVE_WINDOW = float(os.environ.get('POLL_ACTIVE_WINDOW', '60'))
+POLL_ACTIVE_DEVICES = int(os.environ.get('POLL_ACTIVE_DEVICES', '100000'))
+
+# Carga (0 a 1) a partir da qual o intervalo cresce e multiplicador máximo
+POLL_LOAD_THRESHOLD = float(os.environ.get('POLL_LOAD_THRESHOLD', '0.5'))
+POLL_LOAD_FACTOR = float(os.environ.get('POLL_LOAD_FACTOR', '6'))
+
+# Operações na fila do group commit que contam como carga total
+POLL_LOAD_QUEUE = int(os.environ.get('POLL_LOAD_QUEUE', '1000'))
+
+POLL_LOAD_TTL = float(os.environ.get('POLL_LOAD_TTL', '0.5'))
+POLL_WARMUP = float(os.environ.get('POLL_WARMUP', '0'))
+
+
+class PollHints:
+    """Calcula o next_poll de cada resposta de pendentes"""
+
+    def __init__(self):
+        self._started_at = time.monotonic()
+        self._active = TTLCache(POLL_ACTIVE_DEVICES, POLL_ACTIVE_WINDOW)
+        self._lock = threading.Lock()
+        self._load = 0.0
+        self._load_expires_at = 0.0
+
+    def measure_load(self):
+        """Ocupação do pool e da fila do group commit (0 a 1, a mais alta)"""
+        storage = get_storage()
+        backends = sqlite_backends(storage, flush=False)
+        if isinstance(storage, ShardedStorage):
+            backends.append(storage.main)
+
+        load = 0.0
+        for backend in backends:
+            pool = backend.pool.stats()
+            if pool['size']:
+                load = max(load, pool['in_use'] / pool['size'])
+            if backend.writer is not None and POLL_LOAD_QUEUE > 0:
+                load = max(load, backend.writer.stats()['queued'] / POLL_LOAD_QUEUE)
+
+        if POLL_WARMUP > 0:
+            elapsed = time.monotonic() - self._started_at
+            load = max(load, 1 - elapsed / POLL_WARMUP)
+
+        return min(load, 1.0)
+
+    def load(self):
+        """Carga em cache, medida de novo a cada POLL_LOAD_TTL segundos"""
+        now = time.monotonic()
+        if now >= self._load_expires_at:
+            with self._lock:
+                if now >= self._load_expires_at:
+                    self._load = self.measure_load()
+                    self._load_expires_at = now + POLL_LOAD_TTL
+        return self._load
+
+    def next_poll(self, device_id, delivered, long_poll=False):
+        """Segundos até o próximo poll do device"""
+        if delivered:
+            self._active.set(device_id, True)
+
+        # Com trabalho na fila o device volta logo, com ou sem carga
+        if delivered or (presence.enabled and presence.token(device_id) is not None):
+            interval = POLL_INTERVAL_MIN * random.uniform(1, 1 + POLL_JITTER)
+            return round(min(interval, POLL_INTERVAL_MAX), 1)
+
+        if long_poll:
+            interval = POLL_INTERVAL_MIN
+        elif self._active.get(device_id) is not MISSING:
+            interval = POLL_INTERVAL / 2
+        else:
+            interval = POLL_INTERVAL
+
+        load = self.load()
+        if load > POLL_LOAD_THRESHOLD:
+            overload = (load - POLL_LOAD_THRESHOLD) / (1 - POLL_LOAD_THRESHOLD)
+            interval *= 1 + (POLL_LOAD_FACTOR - 1) * overload
+
+        interval *= random.uniform(1 - POLL_JITTER, 1 + POLL_JITTER)
+        return round(min(max(interval, POLL_INTERVAL_MIN), POLL_INTERVAL_MAX), 1)
+
+
+def retry_after(next_poll):
+    """Valor do header Retry-After (segundos inteiros)"""
+    return str(max(math.ceil(next_poll), 1))
+
+
+hints = PollHints()
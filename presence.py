@@ -0,0 +1,170 @@
+"""
+Índice em memória dos devices com comandos pendentes
+
+A maioria dos devices não tem nada na fila na maior parte do tempo. Com o
+índice, a consulta de pendentes de um device ausente é respondida da
+memória, sem acessar o SQLite; só os devices marcados chegam ao banco.
+
+- add_command/add_commands marcam o device.
+- Um claim que volta vazio (ou com menos que o pedido) desmarca o device,
+  desde que ele não tenha sido marcado de novo durante a consulta (cada
+  marcação recebe um número de sequência).
+- Devices com comandos in_flight continuam marcados: o lease pode vencer
+  e o comando voltar para a fila sem um id novo.
+- A reconciliação lê, a cada PRESENCE_RECONCILE_INTERVAL segundos, os
+  comandos criados depois do último id visto (varredura da chave
+  primária) e os devolvidos à fila desde a última passada (índice das
+  devoluções), trazendo o que outros processos criaram ou devolveram.
+  Devices que passam a ter pendentes acordam os long-polls deste processo.
+- A cada PRESENCE_REBUILD_INTERVAL segundos o índice é reconstruído dos
+  índices de pendentes e in_flight, descartando devices cujos comandos
+  foram entregues por outros processos.
+
+Marcações a mais só custam uma consulta ao banco; um device sem marcação
+com comando pendente só acontece com comandos criados em outro processo,
+e dura no máximo até a próxima reconciliação. Com o MemoryStorage as filas
+já ficam em memória e o índice não é usado.
+"""
+
+import os
+import threading
+import time
+
+import metrics
+from notifications import notifier
+from storage import get_storage
+
+PRESENCE_INDEX = os.environ.get('PRESENCE_INDEX', '1') == '1'
+PRESENCE_RECONCILE_INTERVAL = float(os.environ.get('PRESENCE_RECONCILE_INTERVAL', '1'))
+PRESENCE_REBUILD_INTERVAL = float(os.environ.get('PRESENCE_REBUILD_INTERVAL', '300'))
+
+
+class PresenceIndex:
+    """Devices com pendentes (device_id -> sequência da última marcação)"""
+
+    def __init__(self, reconcile_interval=None, rebuild_interval=None):
+        self.reconcile_interval = (PRESENCE_RECONCILE_INTERVAL if reconcile_interval is None
+                                   else reconcile_interval)
+        self.rebuild_interval = PRESENCE_REBUILD_INTERVAL if rebuild_interval is None else rebuild_interval
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._devices = {}
+        self._sequence = 0
+        self._storage = None
+        self._cursor = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self, storage=None):
+        """Constrói o índice a partir do banco e inicia a reconciliação"""
+        storage = storage or get_storage()
+        if not PRESENCE_INDEX or self.enabled or storage.name == 'memory':
+            return
+
+        self._storage = storage
+        self.rebuild()
+        self.enabled = True
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='presence-reconcile', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.enabled = False
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self._lock:
+            self._devices = {}
+
+    def token(self, device_id):
+        """
+        None se o device não tem pendentes; senão o token para discard()
+
+        Com o índice desativado todo device pode ter pendentes.
+        """
+        if not self.enabled:
+            return 0
+        # dict.get é atômico no CPython: o caminho quente não usa lock
+        return self._devices.get(device_id)
+
+    def mark(self, device_id):
+        if self.enabled:
+            with self._lock:
+                self._sequence += 1
+                self._devices[device_id] = self._sequence
+
+    def mark_many(self, device_ids):
+        if self.enabled:
+            with self._lock:
+                for device_id in device_ids:
+                    self._sequence += 1
+                    self._devices[device_id] = self._sequence
+
+    def discard(self, device_id, token):
+        """Desmarca o device se ele não foi marcado de novo desde token()"""
+        if self.enabled and token is not None:
+            with self._lock:
+                if self._devices.get(device_id) == token:
+                    del self._devices[device_id]
+
+    def __len__(self):
+        return len(self._devices)
+
+    def rebuild(self):
+        """Reconstrói o índice a partir do índice de pendentes do banco"""
+        with self._lock:
+            started_at = self._sequence
+
+        devices, cursor = self._storage.pending_devices()
+
+        with self._lock:
+            # Marcações feitas durante a leitura são preservadas
+            rebuilt = {device_id: sequence for device_id, sequence in self._devices.items()
+                       if sequence > started_at}
+            for device_id in devices:
+                if device_id not in rebuilt:
+                    self._sequence += 1
+                    rebuilt[device_id] = self._sequence
+            self._devices = rebuilt
+            self._cursor = cursor
+
+    def reconcile(self):
+        """Marca os devices com pendentes criados ou devolvidos desde a última passada"""
+        devices, requeued, self._cursor = self._storage.pending_since(self._cursor)
+        if not devices and not requeued:
+            return
+
+        # Devolvidos acordam mesmo marcados: com in_flight o device continua
+        # marcado e o long-poll dorme esperando a devolução
+        woken = set(requeued)
+        with self._lock:
+            for device_id in devices + requeued:
+                if device_id not in self._devices:
+                    woken.add(device_id)
+                # Sempre renova a sequência: um claim vazio que começou
+                # antes deste comando não pode mais desmarcar o device
+                self._sequence += 1
+                self._devices[device_id] = self._sequence
+
+        for device_id in woken:
+            notifier.notify(device_id)
+
+    def _run(self):
+        last_rebuild = time.monotonic()
+        while not self._stop.wait(self.reconcile_interval):
+            try:
+                if self.rebuild_interval > 0 and time.monotonic() - last_rebuild >= self.rebuild_interval:
+                    self.rebuild()
+                    last_rebuild = time.monotonic()
+                else:
+                    self.reconcile()
+            except Exception as e:
+                print(f"❌ Erro na reconciliação do índice de presença: {e}")
+
+
+presence = PresenceIndex()
+
+metrics.describe('device_api_presence_skips_total', 'counter',
+                 'Consultas de pendentes respondidas pelo índice de presença, sem acessar o banco')
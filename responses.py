@@ -0,0 +1,93 @@
+"""
+Camada de respostas JSON de baixo custo
+
+- Respostas constantes (health) são serializadas uma única vez, na
+  importação.
+- As respostas de pendentes (comando encontrado ou nenhum) vão direto da
+  linha do SQLite e do next_poll para bytes, sem montar dicts
+  intermediários.
+- As demais respostas usam o encoder mais rápido disponível: orjson, se
+  instalado, ou um json.JSONEncoder compacto reaproveitado.
+"""
+
+import json
+
+from flask import Response
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+JSON_MIMETYPE = 'application/json'
+
+_encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+
+
+def dumps(data):
+    """Serializa para bytes UTF-8"""
+    if orjson is not None:
+        return orjson.dumps(data)
+    return _encoder.encode(data).encode('utf-8')
+
+
+def _string(value):
+    """Escapa uma string JSON (com aspas)"""
+    return _encoder.encode(value).encode('utf-8')
+
+
+# Corpos constantes pré-serializados
+HEALTH = dumps({
+    'status': 'success',
+    'message': 'API funcionando normalmente',
+    'version': '1.0'
+})
+
+_PENDING_PREFIX = b'{"status":"success","data":{"id":'
+_PENDING_SUFFIX = b'},"message":"Comando encontrado","next_poll":'
+_NO_PENDING_PREFIX = b'{"status":"success","data":null,"message":"Nenhum comando pendente","next_poll":'
+
+
+def pending_command(row, next_poll):
+    """Corpo de 'Comando encontrado' direto da linha (id, command, created_at)"""
+    return b''.join((
+        _PENDING_PREFIX, str(row[0]).encode('ascii'),
+        b',"command":', _string(row[1]),
+        b',"created_at":', _string(row[2]),
+        _PENDING_SUFFIX, repr(next_poll).encode('ascii'), b'}'
+    ))
+
+
+def no_pending_command(next_poll):
+    """Corpo de 'Nenhum comando pendente' com o next_poll"""
+    return b''.join((_NO_PENDING_PREFIX, repr(next_poll).encode('ascii'), b'}'))
+
+
+def readiness(result):
+    """Corpo de /api/health/ready a partir do resultado da sonda"""
+    return dumps({
+        'status': 'success' if result['ready'] else 'error',
+        'data': result,
+        'message': 'API pronta' if result['ready'] else 'Banco lento ou indisponível'
+    })
+
+
+def too_many_requests(message, retry_after):
+    """Corpo do 429 do controle de admissão"""
+    return dumps({
+        'status': 'error',
+        'message': message,
+        'retry_after': round(retry_after, 1)
+    })
+
+
+def json_response(body, status=200, headers=None):
+    """Response Flask a partir de bytes já serializados"""
+    return Response(body, status=status, headers=headers, mimetype=JSON_MIMETYPE)
+
+
+def output_json(data, code, headers=None):
+    """Representação application/json do Flask-RESTX com o encoder rápido"""
+    response = json_response(dumps(data), code)
+    response.headers.extend(headers or {})
+    return response
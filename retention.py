@@ -0,0 +1,357 @@
+"""
+Retenção, arquivamento e compactação de comandos
+
+Comandos executados saem de device_commands para a tabela
+device_commands_archive (no mesmo arquivo ou em um banco de arquivo
+separado, RETENTION_ARCHIVE_DB) em lotes de RETENTION_BATCH_SIZE linhas.
+Cada lote é uma transação curta, então polls e claims nunca esperam por
+um arquivamento inteiro. Comandos pendentes nunca são arquivados.
+
+Políticas (RETENTION_DAYS e RETENTION_KEEP_PER_DEVICE, 0 desativa):
+- dias: arquiva executados há mais de N dias
+- últimos por device: mantém só os M executados mais recentes de cada device
+
+O espaço liberado volta ao sistema com incremental_vacuum, também em
+passos limitados. Pode rodar em uma thread de fundo (RETENTION_INTERVAL,
+só no processo líder quando há vários workers) ou pelo maintenance.py.
+"""
+
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from leader import leader
+from storage import get_storage, shard_db_path, sqlite_backends
+
+RETENTION_DAYS = float(os.environ.get('RETENTION_DAYS', '0'))
+RETENTION_KEEP_PER_DEVICE = int(os.environ.get('RETENTION_KEEP_PER_DEVICE', '0'))
+
+# archive (copia para o arquivo morto) ou delete (só remove)
+RETENTION_MODE = os.environ.get('RETENTION_MODE', 'archive')
+RETENTION_ARCHIVE_DB = os.environ.get('RETENTION_ARCHIVE_DB', '')
+
+# Linhas movidas por transação e pausa entre lotes (segundos)
+RETENTION_BATCH_SIZE = int(os.environ.get('RETENTION_BATCH_SIZE', '500'))
+RETENTION_BATCH_PAUSE = float(os.environ.get('RETENTION_BATCH_PAUSE', '0.01'))
+
+# Intervalo da retenção automática em segundos (0 desativa)
+RETENTION_INTERVAL = float(os.environ.get('RETENTION_INTERVAL', '0'))
+
+# Páginas liberadas por passo do incremental_vacuum
+VACUUM_STEP_PAGES = int(os.environ.get('VACUUM_STEP_PAGES', '1000'))
+
+ARCHIVE_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS {schema}device_commands_archive (
+        id INTEGER PRIMARY KEY,
+        device_id TEXT NOT NULL,
+        command TEXT NOT NULL,
+        status TEXT,
+        created_at TIMESTAMP,
+        executed_at TIMESTAMP,
+        archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+'''
+
+
+class RetentionPolicy:
+    """Configuração de uma rodada de retenção"""
+
+    def __init__(self, days=None, keep_per_device=None, mode=None,
+                 archive_db=None, batch_size=None, batch_pause=None):
+        self.days = RETENTION_DAYS if days is None else days
+        self.keep_per_device = RETENTION_KEEP_PER_DEVICE if keep_per_device is None else keep_per_device
+        self.mode = mode or RETENTION_MODE
+        self.archive_db = RETENTION_ARCHIVE_DB if archive_db is None else archive_db
+        self.batch_size = batch_size or RETENTION_BATCH_SIZE
+        self.batch_pause = RETENTION_BATCH_PAUSE if batch_pause is None else batch_pause
+
+        if self.mode not in ('archive', 'delete'):
+            raise ValueError(f"Modo de retenção inválido: {self.mode}")
+
+    @property
+    def enabled(self):
+        return self.days > 0 or self.keep_per_device > 0
+
+    def executed_before(self):
+        """Limite de executed_at da política por dias (formato do SQLite)"""
+        if self.days <= 0:
+            return None
+        cutoff = datetime.now(timezone.utc) - timedelta(days=self.days)
+        return cutoff.strftime('%Y-%m-%d %H:%M:%S')
+
+
+class _Archiver:
+    """Move lotes de comandos executados em uma conexão do pool"""
+
+    def __init__(self, conn, policy, archive_db=None):
+        self.conn = conn
+        self.policy = policy
+        self.archive_db = archive_db
+        self.table = 'device_commands_archive'
+        self.attached = False
+        self.moved = 0
+
+    def attach(self):
+        """Anexa o banco de arquivo separado, se configurado"""
+        if self.policy.mode == 'archive' and self.archive_db:
+            self.conn.execute('ATTACH DATABASE ? AS archive', (self.archive_db,))
+            self.attached = True
+            self.conn.execute(ARCHIVE_TABLE_SQL.format(schema='archive.'))
+            self.conn.commit()
+            self.table = 'archive.device_commands_archive'
+
+    def detach(self):
+        if self.attached:
+            self.conn.execute('DETACH DATABASE archive')
+            self.attached = False
+
+    def run_batches(self, select_sql, params):
+        """
+        Repete select (ids do próximo lote) + move até esgotar
+
+        O select roda dentro da transação do lote, então o lote não
+        disputa o lock de escrita com outra seleção desatualizada.
+        """
+        batch_size = self.policy.batch_size
+
+        while True:
+            cursor = self.conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                cursor.execute(select_sql, params + [batch_size])
+                ids = [row[0] for row in cursor.fetchall()]
+                if ids:
+                    self._move(cursor, ids)
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+
+            self.moved += len(ids)
+            if len(ids) < batch_size:
+                return
+
+            if self.policy.batch_pause:
+                time.sleep(self.policy.batch_pause)
+
+    def _move(self, cursor, ids):
+        placeholders = ', '.join('?' * len(ids))
+
+        if self.policy.mode == 'archive':
+            cursor.execute(f'''
+                INSERT OR IGNORE INTO {self.table}
+                    (id, device_id, command, status, created_at, executed_at)
+                SELECT id, device_id, command, status, created_at, executed_at
+                FROM device_commands
+                WHERE id IN ({placeholders}) AND status = 'executed'
+            ''', ids)
+
+        cursor.execute(f'''
+            DELETE FROM device_commands
+            WHERE id IN ({placeholders}) AND status = 'executed'
+        ''', ids)
+
+
+def archive_commands(storage=None, policy=None):
+    """
+    Aplica a política de retenção e retorna quantos comandos saíram
+
+    Com shards a política roda em cada arquivo (e cada shard tem seu
+    próprio arquivo morto). Com o MemoryStorage sem persistência os
+    executados são apenas descartados da memória.
+    """
+    storage = storage or get_storage()
+    policy = policy or RetentionPolicy()
+    result = {'by_age': 0, 'by_device_limit': 0}
+
+    if not policy.enabled:
+        return result
+
+    targets = sqlite_backends(storage)
+    if not targets:
+        result['by_age'], result['by_device_limit'] = storage.discard_executed(
+            policy.executed_before(), policy.keep_per_device
+        )
+        return result
+
+    for shard, target in enumerate(targets):
+        archive_db = policy.archive_db
+        if archive_db and len(targets) > 1:
+            # Ids de shards diferentes não podem dividir a mesma tabela
+            archive_db = shard_db_path(shard, len(targets), path=archive_db)
+
+        by_age, by_device_limit = _archive_target(target, policy, archive_db)
+        result['by_age'] += by_age
+        result['by_device_limit'] += by_device_limit
+
+    return result
+
+
+def _archive_target(target, policy, archive_db):
+    """Retenção em um arquivo; retorna (por idade, por limite do device)"""
+    by_age = by_device_limit = 0
+
+    with target.connection() as conn:
+        archiver = _Archiver(conn, policy, archive_db)
+        try:
+            archiver.attach()
+
+            executed_before = policy.executed_before()
+            if executed_before is not None:
+                archiver.run_batches('''
+                    SELECT id
+                    FROM device_commands INDEXED BY idx_device_commands_executed
+                    WHERE status = 'executed' AND executed_at < ?
+                    ORDER BY executed_at ASC
+                    LIMIT ?
+                ''', [executed_before])
+                by_age = archiver.moved
+
+            if policy.keep_per_device > 0:
+                for device_id in _devices(conn):
+                    threshold = _keep_threshold(conn, device_id, policy.keep_per_device)
+                    if threshold is None:
+                        continue
+                    archiver.run_batches('''
+                        SELECT id
+                        FROM device_commands
+                        WHERE device_id = ? AND status = 'executed' AND id <= ?
+                        ORDER BY id ASC
+                        LIMIT ?
+                    ''', [device_id, threshold])
+                by_device_limit = archiver.moved - by_age
+        finally:
+            archiver.detach()
+
+    return by_age, by_device_limit
+
+
+def _devices(conn):
+    """device_ids distintos, lidos do índice (device_id, id) sem lock"""
+    cursor = conn.execute('SELECT DISTINCT device_id FROM device_commands')
+    return [row[0] for row in cursor.fetchall()]
+
+
+def _keep_threshold(conn, device_id, keep):
+    """Maior id executado do device que fica fora dos `keep` mais recentes"""
+    row = conn.execute('''
+        SELECT id
+        FROM device_commands
+        WHERE device_id = ? AND status = 'executed'
+        ORDER BY id DESC
+        LIMIT 1 OFFSET ?
+    ''', (device_id, keep)).fetchone()
+    return row[0] if row else None
+
+
+def incremental_vacuum(storage=None, max_pages=None, step_pages=None, pause=None):
+    """
+    Devolve ao sistema as páginas livres dos arquivos em passos curtos
+
+    Só funciona com auto_vacuum=INCREMENTAL (bancos novos já nascem assim;
+    os antigos precisam de enable_incremental_vacuum uma vez). max_pages
+    limita cada arquivo.
+    """
+    result = {'auto_vacuum': None, 'freed_pages': 0, 'free_pages': 0, 'page_count': 0}
+
+    for target in sqlite_backends(storage or get_storage()):
+        target_result = _vacuum_target(target, max_pages, step_pages or VACUUM_STEP_PAGES,
+                                       RETENTION_BATCH_PAUSE if pause is None else pause)
+        if result['auto_vacuum'] in (None, 2):
+            result['auto_vacuum'] = target_result['auto_vacuum']
+        for key in ('freed_pages', 'free_pages', 'page_count'):
+            result[key] += target_result.get(key, 0)
+
+    return result
+
+
+def _vacuum_target(target, max_pages, step_pages, pause):
+    freed = 0
+
+    with target.connection() as conn:
+        auto_vacuum = conn.execute('PRAGMA auto_vacuum').fetchone()[0]
+        if auto_vacuum != 2:
+            return {'auto_vacuum': auto_vacuum}
+
+        while max_pages is None or freed < max_pages:
+            free_pages = conn.execute('PRAGMA freelist_count').fetchone()[0]
+            if free_pages == 0:
+                break
+
+            pages = min(step_pages, free_pages)
+            if max_pages is not None:
+                pages = min(pages, max_pages - freed)
+
+            # executescript roda o pragma até o fim (execute libera só uma página)
+            conn.executescript(f'PRAGMA incremental_vacuum({pages})')
+            freed += pages
+
+            if pause:
+                time.sleep(pause)
+
+        # Trunca o WAL para o espaço aparecer no disco
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+        return {
+            'auto_vacuum': auto_vacuum,
+            'freed_pages': freed,
+            'free_pages': conn.execute('PRAGMA freelist_count').fetchone()[0],
+            'page_count': conn.execute('PRAGMA page_count').fetchone()[0]
+        }
+
+
+def enable_incremental_vacuum(storage=None):
+    """
+    Converte bancos antigos para auto_vacuum=INCREMENTAL
+
+    Roda um VACUUM completo (reescreve o arquivo com lock exclusivo):
+    usar em janela de manutenção.
+    """
+    for target in sqlite_backends(storage or get_storage()):
+        with target.connection() as conn:
+            conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            conn.execute('VACUUM')
+
+
+def run_maintenance(storage=None, policy=None):
+    """Retenção seguida de incremental vacuum"""
+    archived = archive_commands(storage, policy)
+    vacuum = incremental_vacuum(storage)
+    return {'archived': archived, 'vacuum': vacuum}
+
+
+class RetentionScheduler:
+    """Thread que roda a manutenção a cada `interval` segundos"""
+
+    def __init__(self, interval=None, policy=None):
+        self.interval = RETENTION_INTERVAL if interval is None else interval
+        self.policy = policy
+        self._stop = threading.Event()
+        self._thread = None
+        self.last_result = None
+
+    def start(self):
+        if self.interval <= 0 or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='retention', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            # Com vários workers só o líder roda a manutenção
+            if not leader.is_leader():
+                continue
+            try:
+                self.last_result = run_maintenance(policy=self.policy)
+            except Exception as e:
+                print(f"❌ Erro na retenção de comandos: {e}")
+
+
+scheduler = RetentionScheduler()
@@ -1,9 +1,11 @@
 #!/usr/bin/env python3
 """
 Script para executar a API de forma resiliente
-Monitora o health check e reinicia automaticamente se necessário
+Monitora a readiness da API (que sonda o banco) e reinicia
+automaticamente se necessário
 """
 
+import os
 import subprocess
 import time
 import requests
@@ -16,12 +18,19 @@ class APIRunner:
     def __init__(self):
         self.api_process = None
         self.running = True
-        self.health_url = "http://localhost:5000/api/health"
+        # live: o processo responde; ready: o banco responde dentro dos orçamentos
+        self.live_url = "http://localhost:5000/api/health/live"
+        self.health_url = "http://localhost:5000/api/health/ready"
+        # production: servidor multi-worker (serve.py); dev: servidor do Flask (app.py)
+        self.mode = os.environ.get("API_RUNNER_MODE", "production")
+        entry_point = "serve.py" if self.mode == "production" else "app.py"
+        self.pidfile = os.environ.get("API_PIDFILE", "api.pid")
         # Comando para ativar ambiente e executar API
         if sys.platform == "win32":
-            self.start_command = ["cmd", "/c", "conda activate api && python app.py"]
+            self.start_command = ["cmd", "/c", f"conda activate api && python {entry_point}"]
         else:
-            self.start_command = ["bash", "-c", "conda activate api && python app.py"]
+            # exec: o processo supervisionado passa a ser o próprio servidor
+            self.start_command = ["bash", "-c", f"conda activate api && exec python {entry_point}"]
         self.check_interval = 10  # segundos
         self.startup_wait = 15    # segundos para aguardar após iniciar (aumentado)
         self.max_retries = 3      # tentativas antes de reiniciar
@@ -117,8 +126,31 @@ class APIRunner:
             except Exception as e:
                 self.log(f"❌ Erro ao parar API: {e}")
     
+    def reload_api(self):
+        """Reload gracioso: o master do gunicorn troca os workers sem derrubar conexões"""
+        if self.mode != "production" or sys.platform == "win32":
+            self.log("⚠️  Reload gracioso disponível apenas no modo production em Linux/Mac")
+            return False
+
+        try:
+            with open(self.pidfile) as f:
+                master_pid = int(f.read().strip())
+            os.kill(master_pid, signal.SIGHUP)
+            self.log(f"🔁 Reload gracioso solicitado (master PID: {master_pid})")
+            return True
+        except (OSError, ValueError) as e:
+            self.log(f"❌ Erro ao solicitar reload: {e}")
+            return False
+    
+    def check_live(self):
+        """Verifica se o processo da API responde (sem consultar o banco)"""
+        try:
+            return requests.get(self.live_url, timeout=5).status_code == 200
+        except requests.exceptions.RequestException:
+            return False
+    
     def check_health(self):
-        """Verifica se a API está saudável"""
+        """Verifica se a API está pronta (readiness: banco dentro dos orçamentos)"""
         try:
             response = requests.get(self.health_url, timeout=5)
             
@@ -129,6 +161,15 @@ class APIRunner:
                 else:
                     self.log(f"⚠️  Health check retornou status: {data.get('status')}")
                     return False
+            elif response.status_code == 503:
+                # Processo vivo, mas o banco está lento ou travado
+                result = response.json().get('data') or {}
+                self.log(f"⚠️  API não está pronta: {result.get('error', 'banco fora do orçamento')}")
+                for name, component in (result.get('components') or {}).items():
+                    if not component.get('ready'):
+                        self.log(f"   • {name}: {component.get('error')} "
+                                 f"(leitura {component.get('read_ms')}ms, escrita {component.get('write_ms')}ms)")
+                return False
             else:
                 self.log(f"⚠️  Health check retornou código: {response.status_code}")
                 return False
@@ -155,7 +196,8 @@ class APIRunner:
                     consecutive_failures = 0
                 else:
                     consecutive_failures += 1
-                    self.log(f"⚠️  Health check falhou ({consecutive_failures}/{self.max_retries})")
+                    state = "processo responde, banco não" if self.check_live() else "processo não responde"
+                    self.log(f"⚠️  Health check falhou ({consecutive_failures}/{self.max_retries}): {state}")
                 
                 # Se temos nosso próprio processo, verifica se ainda está rodando
                 if self.api_process is not None and self.api_process.poll() is not None:
@@ -198,16 +240,24 @@ class APIRunner:
         self.log("🛑 Recebido sinal de encerramento...")
         self.running = False
     
+    def reload_handler(self, signum, frame):
+        """SIGHUP no runner é repassado como reload gracioso da API"""
+        self.reload_api()
+    
     def run(self):
         """Executa o runner resiliente"""
         # Configura handlers de sinal
         signal.signal(signal.SIGINT, self.signal_handler)
         if hasattr(signal, 'SIGTERM'):
             signal.signal(signal.SIGTERM, self.signal_handler)
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, self.reload_handler)
         
         self.log("🎯 Iniciando API Runner Resiliente")
         self.log(f"📋 Configurações:")
-        self.log(f"   • Health Check URL: {self.health_url}")
+        self.log(f"   • Modo: {self.mode} ({self.start_command[-1]})")
+        self.log(f"   • Readiness URL: {self.health_url}")
+        self.log(f"   • Liveness URL: {self.live_url}")
         self.log(f"   • Intervalo de verificação: {self.check_interval}s")
         self.log(f"   • Máx. tentativas antes de restart: {self.max_retries}")
         self.log(f"   • Tempo de startup: {self.startup_wait}s")
@@ -217,6 +267,10 @@ class APIRunner:
             if self.check_health():
                 self.log("✅ API já está rodando e saudável")
                 self.log("🔍 Iniciando monitoramento da API existente...")
+            elif self.check_live():
+                # Outra instância ocupa a porta; subir uma nova só falharia
+                self.log("⚠️  API já está rodando, mas não está pronta (banco lento ou travado)")
+                self.log("🔍 Iniciando monitoramento da API existente...")
             else:
                 # Tenta iniciar API
                 if not self.start_api():
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Servidor de produção da Device Command API
+
+Substitui o servidor de desenvolvimento do Flask (app.run) por:
+- prefork: gunicorn com vários workers, cada um com um pool de threads
+  (padrão em Linux/Mac). Reload gracioso com SIGHUP no processo master.
+- threaded: servidor WSGI do Werkzeug com threads, sem debug nem reloader
+  (usado no Windows, onde o gunicorn não roda).
+
+Configuração por variáveis de ambiente: API_HOST, API_PORT, API_WORKERS,
+API_THREADS, API_KEEPALIVE, API_WORKER_CONNECTIONS, API_TIMEOUT,
+API_GRACEFUL_TIMEOUT, API_MAX_REQUESTS e API_PIDFILE.
+
+Com mais de um worker, defina METRICS_MULTIPROC_DIR para que /api/metrics
+some as métricas de todos os workers.
+"""
+
+import os
+import sys
+
+try:
+    from gunicorn.app.base import BaseApplication
+except ImportError:
+    BaseApplication = None
+
+SERVER_MODE = os.environ.get('SERVER_MODE', 'threaded' if sys.platform == 'win32' else 'prefork')
+
+HOST = os.environ.get('API_HOST', '0.0.0.0')
+PORT = int(os.environ.get('API_PORT', '5000'))
+
+# Workers concorrem pelo mesmo arquivo SQLite; mais threads por worker
+# rendem mais que muitos processos para uma carga de I/O como o polling
+WORKERS = int(os.environ.get('API_WORKERS', '4'))
+THREADS = int(os.environ.get('API_THREADS', '32'))
+
+# Devices fazem polling a cada poucos segundos: manter a conexão aberta
+# evita um handshake TCP por consulta
+KEEPALIVE = int(os.environ.get('API_KEEPALIVE', '75'))
+WORKER_CONNECTIONS = int(os.environ.get('API_WORKER_CONNECTIONS', '2000'))
+
+# O timeout precisa cobrir o long-poll mais longo (LONG_POLL_MAX_WAIT)
+TIMEOUT = int(os.environ.get('API_TIMEOUT', '90'))
+GRACEFUL_TIMEOUT = int(os.environ.get('API_GRACEFUL_TIMEOUT', '30'))
+
+# Recicla workers periodicamente (0 desativa)
+MAX_REQUESTS = int(os.environ.get('API_MAX_REQUESTS', '0'))
+
+PIDFILE = os.environ.get('API_PIDFILE', 'api.pid')
+
+
+def gunicorn_options():
+    """Opções do gunicorn a partir da configuração"""
+    workers = WORKERS
+
+    # O engine em memória só funciona com um único processo
+    if os.environ.get('STORAGE_BACKEND') == 'memory' and workers > 1:
+        print(">>> STORAGE_BACKEND=memory: usando 1 worker")
+        workers = 1
+
+    return {
+        'bind': f'{HOST}:{PORT}',
+        'workers': workers,
+        'worker_class': 'gthread',
+        'threads': THREADS,
+        'worker_connections': WORKER_CONNECTIONS,
+        'keepalive': KEEPALIVE,
+        'timeout': TIMEOUT,
+        'graceful_timeout': GRACEFUL_TIMEOUT,
+        'max_requests': MAX_REQUESTS,
+        'max_requests_jitter': MAX_REQUESTS // 10,
+        'pidfile': PIDFILE,
+        # Cada worker importa o app depois do fork: pools e threads não
+        # são compartilhados com o master
+        'preload_app': False,
+        'accesslog': os.environ.get('API_ACCESS_LOG'),
+        'errorlog': '-',
+    }
+
+
+if BaseApplication is not None:
+    class GunicornServer(BaseApplication):
+        """Aplicação gunicorn configurada por código (sem arquivo de config)"""
+
+        def __init__(self, options):
+            self.options = options
+            super().__init__()
+
+        def load_config(self):
+            for key, value in self.options.items():
+                if value is not None:
+                    self.cfg.set(key, value)
+
+        def load(self):
+            from app import app
+            return app
+
+
+def run_prefork():
+    """Inicia o gunicorn com workers gthread"""
+    if BaseApplication is None:
+        print("❌ gunicorn não está instalado (pip install -r requirements.txt)")
+        return 1
+
+    # Contadores de execuções anteriores não devem somar nesta
+    from metrics import clear_multiproc_dir
+    clear_multiproc_dir()
+
+    options = gunicorn_options()
+    print(f">>> Device Command API (prefork): {options['workers']} workers x "
+          f"{options['threads']} threads em http://{HOST}:{PORT}")
+    GunicornServer(options).run()
+    return 0
+
+
+def run_threaded():
+    """Inicia o servidor WSGI do Werkzeug com threads, sem debug"""
+    from werkzeug.serving import WSGIRequestHandler, run_simple
+    from app import app
+
+    # HTTP/1.1 habilita keep-alive no servidor do Werkzeug
+    WSGIRequestHandler.protocol_version = 'HTTP/1.1'
+
+    with open(PIDFILE, 'w') as pidfile:
+        pidfile.write(str(os.getpid()))
+
+    print(f">>> Device Command API (threaded) em http://{HOST}:{PORT}")
+    run_simple(HOST, PORT, app, threaded=True, use_reloader=False, use_debugger=False)
+    return 0
+
+
+def main():
+    if SERVER_MODE == 'prefork':
+        return run_prefork()
+    if SERVER_MODE == 'threaded':
+        return run_threaded()
+
+    print(f"❌ SERVER_MODE inválido: {SERVER_MODE} (use prefork ou threaded)")
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
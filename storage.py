@@ -0,0 +1,1584 @@
+"""
+Engines de armazenamento de comandos e licenças
+
+DeviceCommand e License (models.py) delegam todo o acesso a dados para o
+backend configurado aqui:
+
+- SQLiteStorage: engine padrão, grava direto no arquivo SQLite.
+- MemoryStorage: mantém as filas de pendentes por device (deques) e as
+  licenças em memória, com persistência opcional em SQLite por
+  write-behind. Deve ser usado com um único processo de API.
+- ShardedStorage: distribui os comandos por device_id entre vários
+  arquivos SQLite, cada um com seu pool e sua thread escritora.
+
+Os backends trabalham com tuplas; a montagem de dicts fica em models.py.
+"""
+
+import bisect
+import heapq
+import itertools
+import os
+import sqlite3
+import sys
+import threading
+import zlib
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from database import DB_NAME, ConnectionPool, get_pool
+from writer import GROUP_COMMIT, GroupCommitWriter
+
+# As consultas de pendentes usam INDEXED BY idx_device_commands_pending:
+# sem estatísticas (ANALYZE) o planner pode preferir o índice
+# (device_id, id), que percorre todo o histórico do device.
+
+# UPDATE ... RETURNING existe a partir do SQLite 3.35
+HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+# Linhas por página nas exportações em streaming. Cada página é uma
+# consulta própria (keyset pelo id): a conexão volta ao pool entre páginas
+# e nenhuma transação de leitura fica aberta enquanto o cliente baixa
+EXPORT_FETCH_SIZE = int(os.environ.get('EXPORT_FETCH_SIZE', '1000'))
+
+# Devices consultados por SELECT na checagem do claim em lote
+CLAIM_PROBE_CHUNK = 500
+
+# MemoryStorage: persiste em SQLite e a cada quantos segundos
+MEMORY_WRITE_BEHIND = os.environ.get('MEMORY_WRITE_BEHIND', '1') == '1'
+WRITE_BEHIND_INTERVAL = float(os.environ.get('WRITE_BEHIND_INTERVAL', '0.5'))
+
+# ShardedStorage: quantidade de arquivos e nome de cada um ({root} e {ext}
+# vêm de DEVICE_DB_PATH). O padrão inclui a contagem, então um reshard
+# grava arquivos novos sem sobrescrever os atuais.
+SHARD_COUNT = int(os.environ.get('SHARD_COUNT', '4'))
+SHARD_DB_TEMPLATE = os.environ.get('SHARD_DB_TEMPLATE', '{root}-{shard}of{count}{ext}')
+SHARD_POOL_SIZE = int(os.environ.get('SHARD_POOL_SIZE', '0')) or None
+
+def _add_column(table, column, definition):
+    """Migração que adiciona a coluna só se ela ainda não existe"""
+    def add(conn):
+        columns = [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+        if column not in columns:
+            conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+    return add
+
+
+# Migrações de schema, aplicadas em ordem. A versão atual do banco
+# fica guardada em PRAGMA user_version. Cada item é um SQL ou uma função
+# que recebe a conexão.
+MIGRATIONS = [
+    # 1 - índices do claim de pendentes e do histórico por device
+    [
+        '''
+        CREATE INDEX IF NOT EXISTS idx_device_commands_pending
+        ON device_commands (device_id, id)
+        WHERE status = 'pending'
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_device_commands_history
+        ON device_commands (device_id, created_at)
+        ''',
+    ],
+    # 2 - paginação por cursor (id) no histórico de cada device
+    [
+        '''
+        CREATE INDEX IF NOT EXISTS idx_device_commands_device_id
+        ON device_commands (device_id, id)
+        ''',
+    ],
+    # 3 - retenção: arquivo morto e índice dos executados por idade
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS device_commands_archive (
+            id INTEGER PRIMARY KEY,
+            device_id TEXT NOT NULL,
+            command TEXT NOT NULL,
+            status TEXT,
+            created_at TIMESTAMP,
+            executed_at TIMESTAMP,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_device_commands_executed
+        ON device_commands (executed_at)
+        WHERE status = 'executed'
+        ''',
+    ],
+    # 4 - claims com lease: prazo do lease, índice dos vencimentos (sweeper)
+    # e dos devices com comandos em andamento
+    [
+        _add_column('device_commands', 'lease_expires_at', 'TIMESTAMP NULL'),
+        '''
+        CREATE INDEX IF NOT EXISTS idx_device_commands_lease
+        ON device_commands (lease_expires_at)
+        WHERE status = 'in_flight'
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_device_commands_in_flight
+        ON device_commands (device_id)
+        WHERE status = 'in_flight'
+        ''',
+    ],
+    # 5 - validadores do histórico: última confirmação de cada device (com
+    # lease os acks chegam fora da ordem de id)
+    [
+        '''
+        CREATE INDEX IF NOT EXISTS idx_device_commands_device_executed
+        ON device_commands (device_id, executed_at)
+        WHERE status = 'executed'
+        ''',
+    ],
+    # 6 - índice de presença: comandos devolvidos à fila por ordem de
+    # devolução (lease_expires_at), vistos pela reconciliação dos workers
+    [
+        '''
+        CREATE INDEX IF NOT EXISTS idx_device_commands_requeued
+        ON device_commands (lease_expires_at)
+        WHERE status = 'pending' AND lease_expires_at IS NOT NULL
+        ''',
+    ],
+]
+
+
+def migrate(conn):
+    """
+    Aplica as migrações que ainda não rodaram neste banco
+
+    Todos os workers do gunicorn rodam init() ao subir: a versão é lida
+    e as migrações aplicadas com o lock de escrita (BEGIN IMMEDIATE), em
+    uma única transação. Quem chega depois já vê a versão nova.
+    """
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+
+        for number, statements in enumerate(MIGRATIONS, start=1):
+            if number <= version:
+                continue
+
+            for sql in statements:
+                if callable(sql):
+                    sql(conn)
+                else:
+                    conn.execute(sql)
+
+            conn.execute(f'PRAGMA user_version = {number}')
+    except Exception:
+        conn.rollback()
+        raise
+    conn.commit()
+
+
+def _now():
+    """Timestamp no mesmo formato do CURRENT_TIMESTAMP do SQLite (UTC)"""
+    return datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+
+class StorageBackend:
+    """
+    Interface comum dos engines de armazenamento
+
+    Formatos de retorno:
+    - comandos pendentes/entregues: (id, command, created_at)
+    - listagens de comandos: (id, device_id, command, status, created_at, executed_at)
+    - cópia de comandos (reshard): listagem + lease_expires_at
+    - licença: (license_number, created_at) ou None
+    - listagem de licenças: (id, uuid, license_number, created_at)
+
+    filters é um dict com as chaves opcionais device_id, status,
+    created_from, created_to, after_id e order ('asc'/'desc').
+
+    Claims com lease_until (prazo no formato de leases.LEASE_FORMAT) deixam
+    os comandos in_flight até o ack; sem lease_until saem como executados.
+    """
+
+    name = None
+
+    def init(self):
+        """Prepara o armazenamento (schema, estado inicial)"""
+        raise NotImplementedError
+
+    def close(self):
+        """Libera os recursos do backend"""
+
+    def add_command(self, device_id, command):
+        raise NotImplementedError
+
+    def add_commands(self, commands):
+        raise NotImplementedError
+
+    def claim(self, device_id, limit=1, lease_until=None):
+        """Marca os `limit` pendentes mais antigos do device como executados (ou in_flight)"""
+        raise NotImplementedError
+
+    def claim_many(self, device_ids, limit, lease_until=None):
+        """Claim de vários devices; retorna {device_id: [linhas]}"""
+        raise NotImplementedError
+
+    def ack(self, device_id, command_ids):
+        """Confirma comandos entregues com lease; retorna os ids confirmados"""
+        raise NotImplementedError
+
+    def requeue_expired(self, now, limit):
+        """
+        Devolve até `limit` leases vencidos para pending; retorna os device_ids
+
+        lease_expires_at dos devolvidos passa a ser `now`: continua marcando
+        que o comando já foi entregue (ver ack) e registra quando o status
+        mudou (validadores do histórico).
+        """
+        raise NotImplementedError
+
+    def next_lease_expiry(self):
+        """Menor prazo entre os comandos in_flight (ou None)"""
+        raise NotImplementedError
+
+    def in_flight_devices(self, device_ids):
+        """Quais dos devices têm comandos in_flight"""
+        raise NotImplementedError
+
+    def delivered_since(self, device_id, last_id, executed_from, limit):
+        """
+        Até `limit` comandos executados do device com id maior que last_id
+        e executed_at a partir de executed_from, em ordem de id
+        """
+        raise NotImplementedError
+
+    def list_commands(self, filters, limit):
+        raise NotImplementedError
+
+    def iter_commands(self, filters):
+        """Como list_commands, sem limite, lido em páginas de EXPORT_FETCH_SIZE"""
+        raise NotImplementedError
+
+    def iter_command_rows(self):
+        """Todas as linhas de device_commands em ordem de id, com o lease, para cópia"""
+        raise NotImplementedError
+
+    def history_validators(self, device_id):
+        """
+        Retorna (maior id, total, pendentes, in_flight, último created_at,
+        último executed_at, último lease_expires_at entre pendentes e in_flight)
+        """
+        raise NotImplementedError
+
+    def count_by_status(self):
+        """Retorna {status: quantidade} dos comandos"""
+        raise NotImplementedError
+
+    def pending_devices(self):
+        """
+        Devices com comandos pendentes ou in_flight e o cursor do snapshot
+
+        Retorna (device_ids, cursor); pending_since(cursor) traz os devices
+        que ganharam pendentes depois do snapshot. Os in_flight entram
+        porque podem voltar para a fila sem um id novo.
+        """
+        raise NotImplementedError
+
+    def pending_since(self, cursor):
+        """
+        Devices com pendentes criados ou devolvidos à fila depois do cursor
+
+        Retorna (device_ids, requeued_device_ids, cursor).
+        """
+        raise NotImplementedError
+
+    def get_license(self, uuid):
+        raise NotImplementedError
+
+    def add_license(self, uuid, license_number):
+        """Grava a licença; ValueError se o UUID já existir"""
+        raise NotImplementedError
+
+    def iter_licenses(self):
+        raise NotImplementedError
+
+
+class SQLiteStorage(StorageBackend):
+    """
+    Engine SQLite (usa o pool global ou um pool próprio por arquivo)
+
+    Com group_commit ('durable' ou 'relaxed') as escritas passam por uma
+    thread escritora que agrupa várias operações em um único commit.
+    """
+
+    name = 'sqlite'
+
+    def __init__(self, db_path=None, pool_size=None, group_commit=None,
+                 id_stride=1, id_offset=0):
+        self.db_path = db_path
+        self._pool = ConnectionPool(db_path, pool_size) if db_path else None
+        self.group_commit = group_commit or GROUP_COMMIT
+        self.writer = None
+        # Em shards, os ids seguem id % id_stride == id_offset para serem
+        # únicos entre todos os arquivos
+        self.id_stride = id_stride
+        self.id_offset = id_offset
+
+    @property
+    def pool(self):
+        return self._pool or get_pool()
+
+    @contextmanager
+    def connection(self):
+        with self.pool.connection() as conn:
+            yield conn
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.stop()
+            self.writer = None
+        if self._pool is not None:
+            self._pool.close()
+
+    def _write(self, operation):
+        """
+        Executa operation(cursor) em uma transação de escrita
+
+        Sem group commit abre a transação aqui e faz commit; com group
+        commit a operação vai para o lote da thread escritora.
+        """
+        if self.writer is not None:
+            return self.writer.submit(operation)
+
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            result = operation(cursor)
+            conn.commit()
+            return result
+
+    def init(self):
+        with self.connection() as conn:
+            cursor = conn.cursor()
+
+            # Banco novo: auto_vacuum incremental permite devolver ao disco
+            # o espaço dos comandos arquivados sem um VACUUM completo
+            cursor.execute('SELECT COUNT(*) FROM sqlite_master')
+            if cursor.fetchone()[0] == 0:
+                cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+                cursor.execute('VACUUM')
+
+            # Tabela única para comandos por device
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS device_commands (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    device_id TEXT NOT NULL,
+                    command TEXT NOT NULL,
+                    status TEXT DEFAULT 'pending',
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    executed_at TIMESTAMP NULL
+                )
+            ''')
+
+            # Tabela para licenças por UUID
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS licenses (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    uuid TEXT UNIQUE NOT NULL,
+                    license_number TEXT NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+
+            conn.commit()
+
+            migrate(conn)
+
+        if self.group_commit != 'off' and self.writer is None:
+            self.writer = GroupCommitWriter(self.pool, self.group_commit)
+            self.writer.start()
+
+    def add_command(self, device_id, command):
+        if self.id_stride > 1:
+            return self.add_commands([(device_id, command)])[0]
+
+        def insert(cursor):
+            cursor.execute('''
+                INSERT INTO device_commands (device_id, command)
+                VALUES (?, ?)
+            ''', (device_id, command))
+            return cursor.lastrowid
+
+        return self._write(insert)
+
+    def _next_ids(self, cursor, count):
+        """Próximos `count` ids do shard (chamado com o lock de escrita)"""
+        cursor.execute('''
+            SELECT seq FROM sqlite_sequence WHERE name = 'device_commands'
+        ''')
+        row = cursor.fetchone()
+        last_id = row[0] if row else 0
+
+        first = (last_id // self.id_stride + 1) * self.id_stride + self.id_offset
+        return list(range(first, first + count * self.id_stride, self.id_stride))
+
+    def add_commands(self, commands):
+        if not commands:
+            return []
+
+        if self.id_stride > 1:
+            def insert_strided(cursor):
+                # AUTOINCREMENT atualiza sqlite_sequence com o maior id explícito
+                command_ids = self._next_ids(cursor, len(commands))
+                cursor.executemany('''
+                    INSERT INTO device_commands (id, device_id, command)
+                    VALUES (?, ?, ?)
+                ''', [(command_id, device_id, command)
+                      for command_id, (device_id, command) in zip(command_ids, commands)])
+                return command_ids
+
+            return self._write(insert_strided)
+
+        def insert_many(cursor):
+            # Com o lock de escrita e AUTOINCREMENT os ids são contíguos
+            cursor.executemany('''
+                INSERT INTO device_commands (device_id, command)
+                VALUES (?, ?)
+            ''', commands)
+
+            cursor.execute('''
+                SELECT seq FROM sqlite_sequence WHERE name = 'device_commands'
+            ''')
+            last_id = cursor.fetchone()[0]
+            return list(range(last_id - len(commands) + 1, last_id + 1))
+
+        return self._write(insert_many)
+
+    def claim(self, device_id, limit=1, lease_until=None):
+        with self.connection() as conn:
+            cursor = conn.cursor()
+
+            # Leitura sem lock pelo índice parcial; polls vazios não
+            # disputam o lock de escrita
+            cursor.execute('''
+                SELECT id
+                FROM device_commands INDEXED BY idx_device_commands_pending
+                WHERE device_id = ? AND status = 'pending'
+                ORDER BY id ASC
+                LIMIT 1
+            ''', (device_id,))
+
+            if cursor.fetchone() is None:
+                return []
+
+        return self._write(lambda cursor: self._claim(cursor, device_id, limit, lease_until))
+
+    def claim_many(self, device_ids, limit, lease_until=None):
+        claimed = {}
+
+        with self.connection() as conn:
+            cursor = conn.cursor()
+
+            # Leitura sem lock: só os devices com pendentes entram no claim
+            with_pending = []
+            for start in range(0, len(device_ids), CLAIM_PROBE_CHUNK):
+                chunk = device_ids[start:start + CLAIM_PROBE_CHUNK]
+                placeholders = ', '.join('?' * len(chunk))
+                cursor.execute(f'''
+                    SELECT DISTINCT device_id
+                    FROM device_commands INDEXED BY idx_device_commands_pending
+                    WHERE status = 'pending' AND device_id IN ({placeholders})
+                ''', chunk)
+                with_pending.extend(row[0] for row in cursor.fetchall())
+
+        if not with_pending:
+            return claimed
+
+        def claim_all(cursor):
+            for device_id in with_pending:
+                rows = self._claim(cursor, device_id, limit, lease_until)
+                if rows:
+                    claimed[device_id] = rows
+            return claimed
+
+        return self._write(claim_all)
+
+    @staticmethod
+    def _claim(cursor, device_id, limit=1, lease_until=None):
+        """
+        Marca os `limit` comandos pendentes mais antigos como executados e os retorna
+
+        Com lease_until ficam in_flight até o ack ou o fim do lease.
+        """
+        if lease_until is not None:
+            assignment, params = "status = 'in_flight', lease_expires_at = ?", [lease_until]
+        else:
+            assignment, params = "status = 'executed', executed_at = CURRENT_TIMESTAMP", []
+
+        if HAS_RETURNING:
+            cursor.execute(f'''
+                UPDATE device_commands
+                SET {assignment}
+                WHERE id IN (
+                    SELECT id
+                    FROM device_commands INDEXED BY idx_device_commands_pending
+                    WHERE device_id = ? AND status = 'pending'
+                    ORDER BY id ASC
+                    LIMIT ?
+                )
+                RETURNING id, command, created_at
+            ''', params + [device_id, limit])
+            return sorted(cursor.fetchall())
+
+        # SQLite antigo: trava de escrita antes de ler os próximos pendentes
+        if not cursor.connection.in_transaction:
+            cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute('''
+            SELECT id, command, created_at
+            FROM device_commands INDEXED BY idx_device_commands_pending
+            WHERE device_id = ? AND status = 'pending'
+            ORDER BY id ASC
+            LIMIT ?
+        ''', (device_id, limit))
+        rows = cursor.fetchall()
+
+        if rows:
+            placeholders = ', '.join('?' * len(rows))
+            cursor.execute(f'''
+                UPDATE device_commands
+                SET {assignment}
+                WHERE id IN ({placeholders})
+            ''', params + [row[0] for row in rows])
+
+        return rows
+
+    def ack(self, device_id, command_ids):
+        if not command_ids:
+            return []
+
+        # Pendentes com lease_expires_at já foram entregues uma vez (o lease
+        # venceu antes do ack chegar) e também podem ser confirmados
+        placeholders = ', '.join('?' * len(command_ids))
+        where = f'''
+            WHERE device_id = ? AND id IN ({placeholders})
+              AND (status = 'in_flight' OR (status = 'pending' AND lease_expires_at IS NOT NULL))
+        '''
+        params = [device_id] + list(command_ids)
+
+        def confirm(cursor):
+            if HAS_RETURNING:
+                cursor.execute(f'''
+                    UPDATE device_commands
+                    SET status = 'executed', executed_at = CURRENT_TIMESTAMP
+                    {where}
+                    RETURNING id
+                ''', params)
+                return sorted(row[0] for row in cursor.fetchall())
+
+            if not cursor.connection.in_transaction:
+                cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute(f'SELECT id FROM device_commands {where}', params)
+            acked = sorted(row[0] for row in cursor.fetchall())
+            if acked:
+                cursor.execute(f'''
+                    UPDATE device_commands
+                    SET status = 'executed', executed_at = CURRENT_TIMESTAMP
+                    WHERE id IN ({', '.join('?' * len(acked))})
+                ''', acked)
+            return acked
+
+        return self._write(confirm)
+
+    def requeue_expired(self, now, limit):
+        with self.connection() as conn:
+            # Leitura sem lock: sem leases vencidos não pega o lock de escrita
+            expired = conn.execute('''
+                SELECT 1
+                FROM device_commands INDEXED BY idx_device_commands_lease
+                WHERE status = 'in_flight' AND lease_expires_at <= ?
+                LIMIT 1
+            ''', (now,)).fetchone()
+
+        if expired is None:
+            return []
+
+        # Percorre só o começo do índice de prazos: custo proporcional aos
+        # leases vencidos. lease_expires_at passa a ser o momento da devolução
+        select = '''
+            SELECT id
+            FROM device_commands INDEXED BY idx_device_commands_lease
+            WHERE status = 'in_flight' AND lease_expires_at <= ?
+            ORDER BY lease_expires_at ASC
+            LIMIT ?
+        '''
+
+        def requeue(cursor):
+            if HAS_RETURNING:
+                cursor.execute(f'''
+                    UPDATE device_commands
+                    SET status = 'pending', lease_expires_at = ?
+                    WHERE id IN ({select})
+                    RETURNING device_id
+                ''', (now, now, limit))
+                return [row[0] for row in cursor.fetchall()]
+
+            if not cursor.connection.in_transaction:
+                cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute(select.replace('SELECT id', 'SELECT id, device_id', 1), (now, limit))
+            rows = cursor.fetchall()
+            if rows:
+                cursor.execute(f'''
+                    UPDATE device_commands
+                    SET status = 'pending', lease_expires_at = ?
+                    WHERE id IN ({', '.join('?' * len(rows))})
+                ''', [now] + [row[0] for row in rows])
+            return [row[1] for row in rows]
+
+        return self._write(requeue)
+
+    def next_lease_expiry(self):
+        with self.connection() as conn:
+            return conn.execute('''
+                SELECT MIN(lease_expires_at)
+                FROM device_commands INDEXED BY idx_device_commands_lease
+                WHERE status = 'in_flight'
+            ''').fetchone()[0]
+
+    def in_flight_devices(self, device_ids):
+        found = set()
+
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            for start in range(0, len(device_ids), CLAIM_PROBE_CHUNK):
+                chunk = device_ids[start:start + CLAIM_PROBE_CHUNK]
+                placeholders = ', '.join('?' * len(chunk))
+                cursor.execute(f'''
+                    SELECT DISTINCT device_id
+                    FROM device_commands INDEXED BY idx_device_commands_in_flight
+                    WHERE status = 'in_flight' AND device_id IN ({placeholders})
+                ''', chunk)
+                found.update(row[0] for row in cursor.fetchall())
+
+        return found
+
+    def delivered_since(self, device_id, last_id, executed_from, limit):
+        # A janela de executed_at limita a leitura do índice, mesmo com um
+        # last_id antigo (ou 0)
+        with self.connection() as conn:
+            cursor = conn.cursor()
+
+            cursor.execute('''
+                SELECT id, command, created_at
+                FROM device_commands INDEXED BY idx_device_commands_device_executed
+                WHERE device_id = ? AND status = 'executed' AND executed_at >= ? AND id > ?
+                ORDER BY id ASC
+                LIMIT ?
+            ''', (device_id, executed_from, last_id, limit))
+
+            return cursor.fetchmany(limit)
+
+    @staticmethod
+    def _command_filters(filters):
+        """Monta o WHERE das listagens de comandos"""
+        clauses = []
+        params = []
+
+        if filters.get('device_id') is not None:
+            clauses.append('device_id = ?')
+            params.append(filters['device_id'])
+        if filters.get('status') is not None:
+            clauses.append('status = ?')
+            params.append(filters['status'])
+        if filters.get('created_from') is not None:
+            clauses.append('created_at >= ?')
+            params.append(filters['created_from'])
+        if filters.get('created_to') is not None:
+            clauses.append('created_at <= ?')
+            params.append(filters['created_to'])
+        if filters.get('after_id') is not None:
+            # Cursor: continua depois do último id da página anterior
+            clauses.append('id < ?' if filters.get('order', 'desc') == 'desc' else 'id > ?')
+            params.append(filters['after_id'])
+
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+        direction = 'DESC' if filters.get('order', 'desc') == 'desc' else 'ASC'
+        return where, params, direction
+
+    def list_commands(self, filters, limit):
+        where, params, direction = self._command_filters(filters)
+
+        with self.connection() as conn:
+            cursor = conn.cursor()
+
+            cursor.execute(f'''
+                SELECT id, device_id, command, status, created_at, executed_at
+                FROM device_commands
+                {where}
+                ORDER BY id {direction}
+                LIMIT ?
+            ''', params + [limit])
+
+            return cursor.fetchmany(limit)
+
+    def iter_commands(self, filters):
+        # Cada página continua depois do último id da anterior (after_id)
+        filters = dict(filters)
+        while True:
+            rows = self.list_commands(filters, EXPORT_FETCH_SIZE)
+            yield from rows
+            if len(rows) < EXPORT_FETCH_SIZE:
+                return
+            filters['after_id'] = rows[-1][0]
+
+    def iter_command_rows(self):
+        last_id = 0
+        while True:
+            with self.connection() as conn:
+                rows = conn.execute('''
+                    SELECT id, device_id, command, status, created_at, executed_at, lease_expires_at
+                    FROM device_commands
+                    WHERE id > ?
+                    ORDER BY id ASC
+                    LIMIT ?
+                ''', (last_id, EXPORT_FETCH_SIZE)).fetchall()
+            yield from rows
+            if len(rows) < EXPORT_FETCH_SIZE:
+                return
+            last_id = rows[-1][0]
+
+    def history_validators(self, device_id):
+        # Tudo sai dos índices; os leases só são lidos nas linhas pendentes
+        # e in_flight do device
+        with self.connection() as conn:
+            cursor = conn.cursor()
+
+            cursor.execute('''
+                SELECT
+                    (SELECT id FROM device_commands
+                     WHERE device_id = ? ORDER BY id DESC LIMIT 1),
+                    (SELECT COUNT(*) FROM device_commands
+                     INDEXED BY idx_device_commands_device_id
+                     WHERE device_id = ?),
+                    (SELECT COUNT(*) FROM device_commands
+                     INDEXED BY idx_device_commands_pending
+                     WHERE device_id = ? AND status = 'pending'),
+                    (SELECT COUNT(*) FROM device_commands
+                     INDEXED BY idx_device_commands_in_flight
+                     WHERE device_id = ? AND status = 'in_flight'),
+                    (SELECT created_at FROM device_commands
+                     WHERE device_id = ? ORDER BY id DESC LIMIT 1),
+                    (SELECT MAX(executed_at) FROM device_commands
+                     INDEXED BY idx_device_commands_device_executed
+                     WHERE device_id = ? AND status = 'executed'),
+                    (SELECT MAX(lease_expires_at) FROM device_commands
+                     INDEXED BY idx_device_commands_pending
+                     WHERE device_id = ? AND status = 'pending'),
+                    (SELECT MAX(lease_expires_at) FROM device_commands
+                     INDEXED BY idx_device_commands_in_flight
+                     WHERE device_id = ? AND status = 'in_flight')
+            ''', (device_id,) * 8)
+
+            *validators, pending_lease, in_flight_lease = cursor.fetchone()
+            last_lease = max(filter(None, (pending_lease, in_flight_lease)), default=None)
+            return (*validators, last_lease)
+
+    def count_by_status(self):
+        # Cada contagem percorre só o índice parcial do seu status
+        with self.connection() as conn:
+            cursor = conn.cursor()
+
+            cursor.execute('''
+                SELECT
+                    (SELECT COUNT(*) FROM device_commands
+                     INDEXED BY idx_device_commands_pending
+                     WHERE status = 'pending'),
+                    (SELECT COUNT(*) FROM device_commands
+                     INDEXED BY idx_device_commands_in_flight
+                     WHERE status = 'in_flight'),
+                    (SELECT COUNT(*) FROM device_commands
+                     INDEXED BY idx_device_commands_executed
+                     WHERE status = 'executed')
+            ''')
+            pending, in_flight, executed = cursor.fetchone()
+
+        return {'pending': pending, 'in_flight': in_flight, 'executed': executed}
+
+    def pending_devices(self):
+        with self.connection() as conn:
+            cursor = conn.cursor()
+
+            # As leituras na mesma transação: o cursor corresponde
+            # exatamente ao conjunto de devices lido
+            cursor.execute('BEGIN')
+            try:
+                cursor.execute('SELECT COALESCE(MAX(id), 0) FROM device_commands')
+                last_id = cursor.fetchone()[0]
+                cursor.execute('''
+                    SELECT MAX(lease_expires_at)
+                    FROM device_commands INDEXED BY idx_device_commands_requeued
+                    WHERE status = 'pending' AND lease_expires_at IS NOT NULL
+                ''')
+                last_requeue = cursor.fetchone()[0] or ''
+                cursor.execute('''
+                    SELECT DISTINCT device_id
+                    FROM device_commands INDEXED BY idx_device_commands_pending
+                    WHERE status = 'pending'
+                ''')
+                devices = {row[0] for row in cursor.fetchall()}
+                cursor.execute('''
+                    SELECT DISTINCT device_id
+                    FROM device_commands INDEXED BY idx_device_commands_in_flight
+                    WHERE status = 'in_flight'
+                ''')
+                devices.update(row[0] for row in cursor.fetchall())
+            finally:
+                conn.rollback()
+
+        return list(devices), (last_id, last_requeue)
+
+    def pending_since(self, cursor):
+        # Os ids crescem na ordem dos commits (as escritas são serializadas),
+        # então varrer a chave primária a partir do cursor não perde linhas.
+        # Devoluções não geram id novo: são lidas pelo prazo gravado no
+        # requeue, crescente porque só o processo líder devolve
+        last_id, last_requeue = cursor
+        with self.connection() as conn:
+            rows = conn.execute('''
+                SELECT id, device_id, status
+                FROM device_commands
+                WHERE id > ?
+                ORDER BY id ASC
+            ''', (last_id,)).fetchall()
+            requeued = conn.execute('''
+                SELECT device_id, lease_expires_at
+                FROM device_commands INDEXED BY idx_device_commands_requeued
+                WHERE status = 'pending' AND lease_expires_at > ?
+                ORDER BY lease_expires_at ASC
+            ''', (last_requeue,)).fetchall()
+
+        devices = [row[1] for row in rows if row[2] == 'pending']
+        if rows:
+            last_id = rows[-1][0]
+        if requeued:
+            last_requeue = requeued[-1][1]
+        return devices, [row[0] for row in requeued], (last_id, last_requeue)
+
+    def get_license(self, uuid):
+        with self.connection() as conn:
+            cursor = conn.cursor()
+
+            cursor.execute('''
+                SELECT license_number, created_at
+                FROM licenses
+                WHERE uuid = ?
+            ''', (uuid,))
+
+            return cursor.fetchone()
+
+    def add_license(self, uuid, license_number):
+        def insert(cursor):
+            cursor.execute('''
+                INSERT INTO licenses (uuid, license_number)
+                VALUES (?, ?)
+            ''', (uuid, license_number))
+            return cursor.lastrowid
+
+        try:
+            return self._write(insert)
+        except sqlite3.IntegrityError:
+            raise ValueError("UUID já existe no banco de dados")
+
+    def iter_licenses(self):
+        last_id = sys.maxsize
+        while True:
+            with self.connection() as conn:
+                rows = conn.execute('''
+                    SELECT id, uuid, license_number, created_at
+                    FROM licenses
+                    WHERE id < ?
+                    ORDER BY id DESC
+                    LIMIT ?
+                ''', (last_id, EXPORT_FETCH_SIZE)).fetchall()
+            yield from rows
+            if len(rows) < EXPORT_FETCH_SIZE:
+                return
+            last_id = rows[-1][0]
+
+    def load_hot_state(self):
+        """
+        Estado necessário para o MemoryStorage: comandos pendentes e
+        in_flight (com o prazo do lease), licenças e o último id de cada tabela
+        """
+        with self.connection() as conn:
+            cursor = conn.cursor()
+
+            cursor.execute('''
+                SELECT id, device_id, command, status, created_at, executed_at, lease_expires_at
+                FROM device_commands
+                WHERE status IN ('pending', 'in_flight')
+                ORDER BY id ASC
+            ''')
+            pending = cursor.fetchall()
+
+            cursor.execute('''
+                SELECT id, uuid, license_number, created_at
+                FROM licenses
+            ''')
+            licenses = cursor.fetchall()
+
+            cursor.execute('SELECT name, seq FROM sqlite_sequence')
+            sequences = dict(cursor.fetchall())
+
+        return pending, licenses, sequences
+
+    def apply_writes(self, writes):
+        """
+        Aplica em uma única transação as escritas acumuladas pelo
+        MemoryStorage, na ordem em que aconteceram
+        """
+        statements = {
+            'command': '''
+                INSERT INTO device_commands
+                    (id, device_id, command, status, created_at, executed_at, lease_expires_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''',
+            'claim': '''
+                UPDATE device_commands
+                SET status = 'executed', executed_at = ?
+                WHERE id = ?
+            ''',
+            'lease': '''
+                UPDATE device_commands
+                SET status = 'in_flight', lease_expires_at = ?
+                WHERE id = ?
+            ''',
+            'requeue': '''
+                UPDATE device_commands
+                SET status = 'pending', lease_expires_at = ?
+                WHERE id = ?
+            ''',
+            'ack': '''
+                UPDATE device_commands
+                SET status = 'executed', executed_at = ?
+                WHERE id = ?
+            ''',
+            'license': '''
+                INSERT INTO licenses (id, uuid, license_number, created_at)
+                VALUES (?, ?, ?, ?)
+            ''',
+        }
+
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+
+            # Agrupa escritas consecutivas do mesmo tipo em um executemany
+            kind, batch = None, []
+            for write_kind, params in writes:
+                if write_kind != kind and batch:
+                    cursor.executemany(statements[kind], batch)
+                    batch = []
+                kind = write_kind
+                batch.append(params)
+            if batch:
+                cursor.executemany(statements[kind], batch)
+
+            conn.commit()
+
+
+class MemoryStorage(StorageBackend):
+    """
+    Engine em memória para as filas quentes
+
+    Cada device tem um deque de ids pendentes, então add/claim são O(1).
+    Com `durable` (um SQLiteStorage), as escritas são acumuladas e gravadas
+    em lote a cada WRITE_BEHIND_INTERVAL segundos; só os pendentes ficam em
+    memória e as consultas frias (listagens, histórico, exportações) gravam
+    o que falta e são respondidas pelo SQLite.
+
+    Comandos entregues com lease ficam em memória até o ack; os prazos
+    ficam em um heap, então devolver os vencidos não percorre os comandos.
+    """
+
+    name = 'memory'
+
+    def __init__(self, durable=None, flush_interval=None):
+        self.durable = durable
+        self.flush_interval = WRITE_BEHIND_INTERVAL if flush_interval is None else flush_interval
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._commands = {}
+        self._pending = {}
+        # id -> prazo do último lease; heap de (prazo, id) dos in_flight
+        self._leases = {}
+        self._lease_heap = []
+        self._licenses = {}
+        self._next_command_id = 1
+        self._next_license_id = 1
+        self._writes = []
+        self._stop = threading.Event()
+        self._flusher = None
+
+    def init(self):
+        if self.durable is None:
+            return
+
+        self.durable.init()
+        pending, licenses, sequences = self.durable.load_hot_state()
+
+        with self._lock:
+            for row in pending:
+                self._commands[row[0]] = list(row[:6])
+                if row[6] is not None:
+                    self._leases[row[0]] = row[6]
+                if row[3] == 'in_flight':
+                    self._lease_heap.append((row[6], row[0]))
+                else:
+                    self._pending.setdefault(row[1], deque()).append(row[0])
+            heapq.heapify(self._lease_heap)
+
+            for license_id, uuid, license_number, created_at in licenses:
+                self._licenses[uuid] = (license_id, license_number, created_at)
+
+            self._next_command_id = sequences.get('device_commands', 0) + 1
+            self._next_license_id = sequences.get('licenses', 0) + 1
+
+        self._flusher = threading.Thread(
+            target=self._flush_loop, name='memory-write-behind', daemon=True
+        )
+        self._flusher.start()
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"❌ Erro no write-behind do MemoryStorage: {e}")
+
+    def flush(self):
+        """Grava no SQLite as escritas acumuladas"""
+        if self.durable is None:
+            return
+
+        with self._flush_lock:
+            with self._lock:
+                writes, self._writes = self._writes, []
+
+            if not writes:
+                return
+
+            try:
+                self.durable.apply_writes(writes)
+            except Exception:
+                # Devolve para a próxima tentativa, mantendo a ordem
+                with self._lock:
+                    self._writes[:0] = writes
+                raise
+
+    def close(self):
+        self._stop.set()
+        if self._flusher is not None:
+            self._flusher.join()
+        self.flush()
+        if self.durable is not None:
+            self.durable.close()
+
+    def add_command(self, device_id, command):
+        return self.add_commands([(device_id, command)])[0]
+
+    def add_commands(self, commands):
+        created_at = _now()
+        command_ids = []
+
+        with self._lock:
+            for device_id, command in commands:
+                command_id = self._next_command_id
+                self._next_command_id += 1
+
+                row = [command_id, device_id, command, 'pending', created_at, None]
+                self._commands[command_id] = row
+                self._pending.setdefault(device_id, deque()).append(command_id)
+                command_ids.append(command_id)
+
+                if self.durable is not None:
+                    self._writes.append(('command', tuple(row) + (None,)))
+
+        return command_ids
+
+    def claim(self, device_id, limit=1, lease_until=None):
+        with self._lock:
+            queue = self._pending.get(device_id)
+            if not queue:
+                return []
+
+            executed_at = _now()
+            rows = []
+            while queue and len(rows) < limit:
+                row = self._commands[queue.popleft()]
+                rows.append((row[0], row[2], row[4]))
+
+                if lease_until is not None:
+                    # Fica em memória até o ack ou o fim do lease
+                    row[3] = 'in_flight'
+                    self._leases[row[0]] = lease_until
+                    heapq.heappush(self._lease_heap, (lease_until, row[0]))
+                    if self.durable is not None:
+                        self._writes.append(('lease', (lease_until, row[0])))
+                    continue
+
+                row[3] = 'executed'
+                row[5] = executed_at
+                self._leases.pop(row[0], None)
+
+                if self.durable is not None:
+                    self._writes.append(('claim', (executed_at, row[0])))
+                    # Entregue: a partir daqui o SQLite é a fonte
+                    del self._commands[row[0]]
+
+            if not queue:
+                del self._pending[device_id]
+
+        return rows
+
+    def claim_many(self, device_ids, limit, lease_until=None):
+        claimed = {}
+        for device_id in device_ids:
+            rows = self.claim(device_id, limit, lease_until)
+            if rows:
+                claimed[device_id] = rows
+        return claimed
+
+    def ack(self, device_id, command_ids):
+        acked = []
+
+        with self._lock:
+            executed_at = _now()
+            for command_id in sorted(set(command_ids)):
+                row = self._commands.get(command_id)
+                if row is None or row[1] != device_id or command_id not in self._leases:
+                    continue
+                if row[3] == 'pending':
+                    # Lease venceu e o comando voltou para a fila antes do ack
+                    queue = self._pending[device_id]
+                    queue.remove(command_id)
+                    if not queue:
+                        del self._pending[device_id]
+                elif row[3] != 'in_flight':
+                    continue
+
+                row[3] = 'executed'
+                row[5] = executed_at
+                del self._leases[command_id]
+                acked.append(command_id)
+
+                if self.durable is not None:
+                    self._writes.append(('ack', (executed_at, command_id)))
+                    del self._commands[command_id]
+
+        return acked
+
+    def _drop_stale_leases(self):
+        """Remove do topo do heap prazos de comandos já confirmados ou renovados"""
+        heap = self._lease_heap
+        while heap:
+            deadline, command_id = heap[0]
+            row = self._commands.get(command_id)
+            if row is not None and row[3] == 'in_flight' and self._leases.get(command_id) == deadline:
+                return
+            heapq.heappop(heap)
+
+    def requeue_expired(self, now, limit):
+        device_ids = []
+
+        with self._lock:
+            self._drop_stale_leases()
+            while self._lease_heap and self._lease_heap[0][0] <= now and len(device_ids) < limit:
+                _, command_id = heapq.heappop(self._lease_heap)
+                row = self._commands[command_id]
+                row[3] = 'pending'
+                self._leases[command_id] = now
+
+                # Volta na posição do id: entregue antes dos mais novos
+                queue = self._pending.setdefault(row[1], deque())
+                queue.insert(bisect.bisect_left(queue, command_id), command_id)
+                device_ids.append(row[1])
+
+                if self.durable is not None:
+                    self._writes.append(('requeue', (now, command_id)))
+                self._drop_stale_leases()
+
+        return device_ids
+
+    def next_lease_expiry(self):
+        with self._lock:
+            self._drop_stale_leases()
+            return self._lease_heap[0][0] if self._lease_heap else None
+
+    def in_flight_devices(self, device_ids):
+        wanted = set(device_ids)
+        with self._lock:
+            return {
+                self._commands[command_id][1] for command_id in self._leases
+                if self._commands[command_id][3] == 'in_flight' and self._commands[command_id][1] in wanted
+            }
+
+    def discard_executed(self, executed_before=None, keep_per_device=0):
+        """
+        Retenção sem persistência: remove executados antigos da memória
+
+        Retorna (removidos por idade, removidos pelo limite por device).
+        """
+        by_age = by_device_limit = 0
+
+        with self._lock:
+            if executed_before is not None:
+                for command_id in [row[0] for row in self._commands.values()
+                                   if row[3] == 'executed' and row[5] < executed_before]:
+                    del self._commands[command_id]
+                    by_age += 1
+
+            if keep_per_device > 0:
+                executed = {}
+                for row in self._commands.values():
+                    if row[3] == 'executed':
+                        executed.setdefault(row[1], []).append(row[0])
+                for command_ids in executed.values():
+                    command_ids.sort()
+                    for command_id in command_ids[:-keep_per_device]:
+                        del self._commands[command_id]
+                        by_device_limit += 1
+
+        return by_age, by_device_limit
+
+    @staticmethod
+    def _matches(row, filters):
+        """Aplica os filtros de listagem a uma linha em memória"""
+        after_id = filters.get('after_id')
+        if after_id is not None:
+            if filters.get('order', 'desc') == 'desc' and row[0] >= after_id:
+                return False
+            if filters.get('order', 'desc') == 'asc' and row[0] <= after_id:
+                return False
+
+        return ((filters.get('device_id') is None or row[1] == filters['device_id'])
+                and (filters.get('status') is None or row[3] == filters['status'])
+                and (filters.get('created_from') is None or row[4] >= filters['created_from'])
+                and (filters.get('created_to') is None or row[4] <= filters['created_to']))
+
+    def _snapshot(self, filters):
+        """Linhas em memória que passam nos filtros, já ordenadas"""
+        with self._lock:
+            rows = [tuple(row) for row in self._commands.values() if self._matches(row, filters)]
+        rows.sort(reverse=filters.get('order', 'desc') == 'desc')
+        return rows
+
+    def delivered_since(self, device_id, last_id, executed_from, limit):
+        if self.durable is not None:
+            self.flush()
+            return self.durable.delivered_since(device_id, last_id, executed_from, limit)
+
+        rows = self._snapshot({'device_id': device_id, 'order': 'asc'})
+        return [(row[0], row[2], row[4]) for row in rows
+                if row[0] > last_id and row[3] == 'executed' and row[5] >= executed_from][:limit]
+
+    def list_commands(self, filters, limit):
+        if self.durable is not None:
+            self.flush()
+            return self.durable.list_commands(filters, limit)
+
+        return self._snapshot(filters)[:limit]
+
+    def iter_commands(self, filters):
+        if self.durable is not None:
+            self.flush()
+            return self.durable.iter_commands(filters)
+
+        return iter(self._snapshot(filters))
+
+    def iter_command_rows(self):
+        if self.durable is not None:
+            self.flush()
+            return self.durable.iter_command_rows()
+
+        with self._lock:
+            rows = [tuple(row) + (self._leases.get(row[0]),) for row in self._commands.values()]
+        rows.sort()
+        return iter(rows)
+
+    def history_validators(self, device_id):
+        if self.durable is not None:
+            self.flush()
+            return self.durable.history_validators(device_id)
+
+        rows = self._snapshot({'device_id': device_id})
+        if not rows:
+            return None, 0, 0, 0, None, None, None
+
+        pending = sum(1 for row in rows if row[3] == 'pending')
+        in_flight = sum(1 for row in rows if row[3] == 'in_flight')
+        executed = max((row[5] for row in rows if row[3] == 'executed'), default=None)
+        with self._lock:
+            last_lease = max((self._leases[row[0]] for row in rows
+                              if row[3] != 'executed' and row[0] in self._leases), default=None)
+        return rows[0][0], len(rows), pending, in_flight, rows[0][4], executed, last_lease
+
+    def count_by_status(self):
+        if self.durable is not None:
+            self.flush()
+            return self.durable.count_by_status()
+
+        counts = {}
+        with self._lock:
+            for row in self._commands.values():
+                counts[row[3]] = counts.get(row[3], 0) + 1
+        return counts
+
+    def get_license(self, uuid):
+        entry = self._licenses.get(uuid)
+        return (entry[1], entry[2]) if entry else None
+
+    def add_license(self, uuid, license_number):
+        with self._lock:
+            if uuid in self._licenses:
+                raise ValueError("UUID já existe no banco de dados")
+
+            license_id = self._next_license_id
+            self._next_license_id += 1
+
+            created_at = _now()
+            self._licenses[uuid] = (license_id, license_number, created_at)
+
+            if self.durable is not None:
+                self._writes.append(('license', (license_id, uuid, license_number, created_at)))
+
+        return license_id
+
+    def iter_licenses(self):
+        if self.durable is not None:
+            self.flush()
+            return self.durable.iter_licenses()
+
+        with self._lock:
+            rows = [(entry[0], uuid, entry[1], entry[2]) for uuid, entry in self._licenses.items()]
+        rows.sort(reverse=True)
+        return iter(rows)
+
+
+def shard_db_path(shard, count, path=None, template=None):
+    """Arquivo do shard a partir do caminho base e do template"""
+    root, ext = os.path.splitext(path or DB_NAME)
+    return (template or SHARD_DB_TEMPLATE).format(root=root, ext=ext, shard=shard, count=count)
+
+
+def shard_for(device_id, count):
+    """Shard do device (crc32: estável entre processos, ao contrário de hash())"""
+    return zlib.crc32(device_id.encode('utf-8')) % count
+
+
+class ShardedStorage(StorageBackend):
+    """
+    Engine SQLite particionado por device_id em `count` arquivos
+
+    Cada shard é um SQLiteStorage com pool e group commit próprios, então
+    escritas de devices em shards diferentes não disputam o mesmo lock.
+    Os ids continuam únicos: o shard N gera ids com id % count == N. As
+    licenças ficam no banco principal (DEVICE_DB_PATH).
+
+    Consultas de um device vão só para o seu shard; listagens gerais
+    consultam todos os shards e intercalam os resultados por id.
+    """
+
+    name = 'sharded'
+
+    def __init__(self, count=None, template=None, pool_size=None, group_commit=None):
+        self.count = count or SHARD_COUNT
+        self.main = SQLiteStorage()
+        self.shards = [
+            SQLiteStorage(shard_db_path(shard, self.count, template=template),
+                          pool_size=pool_size or SHARD_POOL_SIZE,
+                          group_commit=group_commit,
+                          id_stride=self.count, id_offset=shard)
+            for shard in range(self.count)
+        ]
+
+    def shard(self, device_id):
+        return self.shards[shard_for(device_id, self.count)]
+
+    def init(self):
+        self.main.init()
+        for shard in self.shards:
+            shard.init()
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+        self.main.close()
+
+    def add_command(self, device_id, command):
+        return self.shard(device_id).add_command(device_id, command)
+
+    def add_commands(self, commands):
+        # Um insert em lote por shard; os ids voltam na ordem recebida
+        by_shard = {}
+        for position, (device_id, command) in enumerate(commands):
+            by_shard.setdefault(shard_for(device_id, self.count), []).append((position, device_id, command))
+
+        command_ids = [None] * len(commands)
+        for shard, entries in by_shard.items():
+            ids = self.shards[shard].add_commands([(device_id, command) for _, device_id, command in entries])
+            for (position, _, _), command_id in zip(entries, ids):
+                command_ids[position] = command_id
+
+        return command_ids
+
+    def claim(self, device_id, limit=1, lease_until=None):
+        return self.shard(device_id).claim(device_id, limit, lease_until)
+
+    def _by_shard(self, device_ids):
+        by_shard = {}
+        for device_id in device_ids:
+            by_shard.setdefault(shard_for(device_id, self.count), []).append(device_id)
+        return by_shard
+
+    def claim_many(self, device_ids, limit, lease_until=None):
+        claimed = {}
+        for shard, shard_device_ids in self._by_shard(device_ids).items():
+            claimed.update(self.shards[shard].claim_many(shard_device_ids, limit, lease_until))
+        return claimed
+
+    def ack(self, device_id, command_ids):
+        return self.shard(device_id).ack(device_id, command_ids)
+
+    def requeue_expired(self, now, limit):
+        device_ids = []
+        for shard in self.shards:
+            if len(device_ids) >= limit:
+                break
+            device_ids.extend(shard.requeue_expired(now, limit - len(device_ids)))
+        return device_ids
+
+    def next_lease_expiry(self):
+        deadlines = [deadline for deadline in (shard.next_lease_expiry() for shard in self.shards)
+                     if deadline is not None]
+        return min(deadlines, default=None)
+
+    def in_flight_devices(self, device_ids):
+        found = set()
+        for shard, shard_device_ids in self._by_shard(device_ids).items():
+            found.update(self.shards[shard].in_flight_devices(shard_device_ids))
+        return found
+
+    def delivered_since(self, device_id, last_id, executed_from, limit):
+        return self.shard(device_id).delivered_since(device_id, last_id, executed_from, limit)
+
+    def _merge(self, sources, filters):
+        """Intercala por id linhas já ordenadas de cada shard"""
+        return heapq.merge(*sources, key=lambda row: row[0],
+                           reverse=filters.get('order', 'desc') == 'desc')
+
+    def list_commands(self, filters, limit):
+        if filters.get('device_id') is not None:
+            return self.shard(filters['device_id']).list_commands(filters, limit)
+
+        pages = [shard.list_commands(filters, limit) for shard in self.shards]
+        return list(itertools.islice(self._merge(pages, filters), limit))
+
+    def iter_commands(self, filters):
+        if filters.get('device_id') is not None:
+            return self.shard(filters['device_id']).iter_commands(filters)
+
+        return self._merge([shard.iter_commands(filters) for shard in self.shards], filters)
+
+    def iter_command_rows(self):
+        return self._merge([shard.iter_command_rows() for shard in self.shards], {'order': 'asc'})
+
+    def history_validators(self, device_id):
+        return self.shard(device_id).history_validators(device_id)
+
+    def count_by_status(self):
+        counts = {}
+        for shard in self.shards:
+            for status, count in shard.count_by_status().items():
+                counts[status] = counts.get(status, 0) + count
+        return counts
+
+    def pending_devices(self):
+        devices, cursors = [], []
+        for shard in self.shards:
+            shard_devices, shard_cursor = shard.pending_devices()
+            devices.extend(shard_devices)
+            cursors.append(shard_cursor)
+        return devices, tuple(cursors)
+
+    def pending_since(self, cursor):
+        devices, requeued, cursors = [], [], []
+        for shard, shard_cursor in zip(self.shards, cursor):
+            shard_devices, shard_requeued, shard_cursor = shard.pending_since(shard_cursor)
+            devices.extend(shard_devices)
+            requeued.extend(shard_requeued)
+            cursors.append(shard_cursor)
+        return devices, requeued, tuple(cursors)
+
+    def get_license(self, uuid):
+        return self.main.get_license(uuid)
+
+    def add_license(self, uuid, license_number):
+        return self.main.add_license(uuid, license_number)
+
+    def iter_licenses(self):
+        return self.main.iter_licenses()
+
+
+def sqlite_backends(storage, flush=True):
+    """
+    Arquivos SQLite com comandos por trás do backend (manutenção)
+
+    Para o MemoryStorage grava o write-behind antes (flush=True); sem
+    persistência retorna lista vazia.
+    """
+    if isinstance(storage, ShardedStorage):
+        return list(storage.shards)
+    if isinstance(storage, MemoryStorage):
+        if storage.durable is None:
+            return []
+        if flush:
+            storage.flush()
+        return [storage.durable]
+    return [storage]
+
+
+def create_storage(name):
+    """Cria o backend pelo nome configurado ('sqlite', 'memory' ou 'sharded')"""
+    if name == 'sqlite':
+        return SQLiteStorage()
+    if name == 'memory':
+        return MemoryStorage(durable=SQLiteStorage() if MEMORY_WRITE_BEHIND else None)
+    if name == 'sharded':
+        return ShardedStorage()
+    raise ValueError(f"Backend de armazenamento desconhecido: {name}")
+
+
+_storage = None
+_storage_lock = threading.Lock()
+
+
+def get_storage():
+    """Retorna o backend em uso (SQLite por padrão)"""
+    global _storage
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                _storage = SQLiteStorage()
+    return _storage
+
+
+def configure_storage(backend):
+    """Troca o backend em uso, encerrando o anterior"""
+    global _storage
+    with _storage_lock:
+        if _storage is not None and _storage is not backend:
+            _storage.close()
+        _storage = backend
+
+
+def close_storage():
+    """Encerra o backend em uso (grava pendências do write-behind)"""
+    global _storage
+    with _storage_lock:
+        if _storage is not None:
+            _storage.close()
+            _storage = None
@@ -0,0 +1,67 @@
+"""Testes do controle de admissão (admission.py)"""
+
+import time
+
+import pytest
+
+from admission import TokenBuckets, admission
+
+
+@pytest.fixture
+def limits(monkeypatch):
+    """Limites pequenos de espera e concorrência durante o teste"""
+    monkeypatch.setattr(admission, 'enabled', True)
+    monkeypatch.setattr(admission.waiting, 'limit', 1)
+    monkeypatch.setattr(admission.concurrency, 'limit', 4)
+    return admission
+
+
+def test_device_bucket_rejects_only_the_noisy_device(client, limits):
+    burst = int(admission.devices.burst)
+    codes = [client.get('/api/device/adm-noisy/pending').status_code for _ in range(burst + 2)]
+    assert codes[-1] == 429
+    response = client.get('/api/device/adm-noisy/pending')
+    assert int(response.headers['Retry-After']) >= 1
+    assert client.get('/api/device/adm-quiet/pending').status_code == 200
+
+
+def test_long_poll_without_waiting_slot_answers_immediately(client, limits):
+    assert admission.waiting.acquire()
+    try:
+        start = time.monotonic()
+        response = client.get('/api/device/adm-lp/pending?wait=5')
+        assert response.status_code == 200
+        assert response.get_json()['data'] is None
+        assert time.monotonic() - start < 2
+    finally:
+        admission.waiting.release()
+
+    assert admission.waiting.in_flight == 0
+    assert admission.concurrency.in_flight == 0
+
+
+def test_stream_without_waiting_slot_gets_429(client, limits):
+    assert admission.waiting.acquire()
+    try:
+        response = client.get('/api/device/adm-sse/stream')
+        assert response.status_code == 429
+        assert 'Retry-After' in response.headers
+    finally:
+        admission.waiting.release()
+
+
+def test_stream_holds_waiting_slot_until_closed(client, limits):
+    response = client.get('/api/device/adm-sse2/stream', buffered=False)
+    assert response.status_code == 200
+    assert next(response.response).startswith(b'retry:')
+    assert admission.waiting.in_flight == 1
+
+    response.close()
+    assert admission.waiting.in_flight == 0
+
+
+def test_token_buckets_stay_bounded():
+    buckets = TokenBuckets(10, 5, max_entries=100, idle_ttl=0)
+    for key in range(1000):
+        buckets.take(key)
+    assert len(buckets) <= 100
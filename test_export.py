@@ -0,0 +1,45 @@
+"""Testes das exportações em streaming (NDJSON)"""
+
+import json
+
+import pytest
+
+import storage as storage_module
+
+
+@pytest.fixture
+def small_pages(monkeypatch):
+    monkeypatch.setattr(storage_module, 'EXPORT_FETCH_SIZE', 2)
+
+
+def test_export_releases_connection_between_pages(storage, small_pages):
+    ids = storage.add_commands([('export-dev', f'cmd-{n}') for n in range(5)])
+    storage.claim('export-dev', limit=1)
+
+    rows = storage.iter_commands({'device_id': 'export-dev', 'order': 'desc'})
+    assert next(rows)[0] == ids[-1]
+    # Nada fica preso ao pool enquanto o cliente ainda baixa
+    assert storage.pool.stats()['in_use'] == 0
+    assert [row[0] for row in rows] == ids[-2::-1]
+
+    pending = storage.iter_commands({'device_id': 'export-dev', 'status': 'pending', 'order': 'asc'})
+    assert [row[0] for row in pending] == ids[1:]
+
+
+def test_license_export_pages(storage, small_pages):
+    for n in range(5):
+        storage.add_license(f'uuid-{n}', f'LIC-{n}')
+
+    rows = storage.iter_licenses()
+    assert next(rows)[1] == 'uuid-4'
+    assert storage.pool.stats()['in_use'] == 0
+    assert [row[1] for row in rows] == ['uuid-3', 'uuid-2', 'uuid-1', 'uuid-0']
+
+
+def test_ndjson_export_streams_every_page(client, storage, small_pages):
+    ids = storage.add_commands([('export-nd', f'cmd-{n}') for n in range(5)])
+
+    response = client.get('/api/commands?format=ndjson&order=asc&device_id=export-nd')
+    assert response.status_code == 200
+    lines = [json.loads(line) for line in response.data.splitlines()]
+    assert [line['id'] for line in lines] == ids
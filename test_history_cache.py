@@ -0,0 +1,53 @@
+"""Testes dos validadores do histórico (ETag / Last-Modified)"""
+
+from leases import lease_deadline, lease_now
+from retention import RetentionPolicy, archive_commands
+
+HISTORY = '/api/device/hist-dev/command'
+
+
+def add_old_commands(storage, count):
+    """Comandos pendentes criados em 2024 (Last-Modified antigo)"""
+    with storage.connection() as conn:
+        conn.executemany(
+            "INSERT INTO device_commands (device_id, command, status, created_at) VALUES (?, ?, 'pending', ?)",
+            [('hist-dev', f'cmd-{n}', '2024-01-15 10:00:00') for n in range(count)])
+        conn.commit()
+
+
+def test_archiving_changes_etag(client, storage):
+    add_old_commands(storage, 3)
+    storage.claim('hist-dev', limit=2)
+    etag = client.get(HISTORY).headers['ETag']
+    assert client.get(HISTORY, headers={'If-None-Match': etag}).status_code == 304
+
+    archived = archive_commands(storage, RetentionPolicy(days=0, keep_per_device=1, mode='delete'))
+    assert archived['by_device_limit'] == 1
+
+    response = client.get(HISTORY, headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert len(response.get_json()['data']) == 2
+
+
+def test_lease_requeue_changes_validators(client, storage):
+    add_old_commands(storage, 1)
+    before = client.get(HISTORY)
+    assert before.headers['Last-Modified'] == 'Mon, 15 Jan 2024 10:00:00 GMT'
+
+    storage.claim('hist-dev', limit=1, lease_until=lease_deadline(-1))
+    assert storage.requeue_expired(lease_now(), 10) == ['hist-dev']
+
+    # Mesmas contagens de antes do claim, mas o comando já foi entregue uma vez
+    response = client.get(HISTORY, headers={'If-None-Match': before.headers['ETag']})
+    assert response.status_code == 200
+    response = client.get(HISTORY, headers={'If-Modified-Since': before.headers['Last-Modified']})
+    assert response.status_code == 200
+
+
+def test_in_flight_history_is_never_older_than_its_lease(client, storage):
+    add_old_commands(storage, 1)
+    storage.claim('hist-dev', limit=1, lease_until=lease_deadline(60))
+
+    response = client.get(HISTORY)
+    assert response.headers['Last-Modified'] != 'Mon, 15 Jan 2024 10:00:00 GMT'
+    assert response.get_json()['data'][0]['status'] == 'in_flight'
@@ -0,0 +1,66 @@
+"""Testes da eleição do processo líder (leader.py)"""
+
+import subprocess
+import sys
+
+from leader import LeaderLock
+
+HOLD_LOCK = '''
+import sys, time
+from leader import LeaderLock
+lock = LeaderLock(sys.argv[1])
+print(lock.is_leader(), flush=True)
+time.sleep(30)
+'''
+
+
+def test_only_one_process_leads(tmp_path):
+    path = str(tmp_path / 'api.db.leader')
+    other = subprocess.Popen([sys.executable, '-c', HOLD_LOCK, path],
+                             stdout=subprocess.PIPE, text=True)
+    try:
+        assert other.stdout.readline().strip() == 'True'
+        lock = LeaderLock(path)
+        assert not lock.is_leader()
+    finally:
+        other.kill()
+        other.wait()
+
+    # Processo líder saiu: o lock é liberado e outro assume
+    assert lock.is_leader()
+    assert lock.is_leader()
+    lock.release()
+
+
+def test_followers_skip_background_jobs(tmp_path, monkeypatch):
+    import leases
+    import retention
+
+    holder = LeaderLock(str(tmp_path / 'api.db.leader'))
+    assert holder.is_leader()
+    follower = LeaderLock(holder.path)
+    monkeypatch.setattr(leases, 'leader', follower)
+    monkeypatch.setattr(retention, 'leader', follower)
+
+    calls = []
+    monkeypatch.setattr(leases, 'requeue_expired', lambda **kwargs: calls.append('leases'))
+    monkeypatch.setattr(retention, 'run_maintenance', lambda **kwargs: calls.append('retention'))
+
+    sweeper = leases.LeaseSweeper(interval=0.01)
+    scheduler = retention.RetentionScheduler(interval=0.01)
+    sweeper.start()
+    scheduler.start()
+    try:
+        # flock vale por descrição de arquivo: no mesmo processo o segundo
+        # LeaderLock também fica de fora
+        import time
+        time.sleep(0.2)
+        assert calls == []
+
+        holder.release()
+        time.sleep(0.2)
+        assert 'leases' in calls and 'retention' in calls
+    finally:
+        sweeper.stop()
+        scheduler.stop()
+        follower.release()
@@ -0,0 +1,30 @@
+"""Testes dos filtros das listagens (parse_list_args em app.py)"""
+
+import pytest
+
+
+@pytest.fixture
+def commands(storage):
+    """Dois comandos criados às 10:00 e às 14:00 UTC"""
+    with storage.connection() as conn:
+        conn.executemany(
+            "INSERT INTO device_commands (device_id, command, status, created_at) VALUES (?, ?, 'pending', ?)",
+            [('tz-dev', 'early', '2024-01-15 10:00:00'), ('tz-dev', 'late', '2024-01-15 14:00:00')])
+        conn.commit()
+
+
+def listed(client, query):
+    response = client.get(f'/api/device/tz-dev/command?order=asc&{query}')
+    assert response.status_code == 200
+    return [item['command'] for item in response.get_json()['data']]
+
+
+def test_offset_is_converted_to_utc(client, commands):
+    # 09:00-03:00 é 12:00 UTC
+    assert listed(client, 'created_from=2024-01-15T09:00:00-03:00') == ['late']
+    assert listed(client, 'created_to=2024-01-15T09:00:00-03:00') == ['early']
+
+
+def test_naive_value_is_utc(client, commands):
+    assert listed(client, 'created_from=2024-01-15T12:00:00') == ['late']
+    assert listed(client, 'created_from=2024-01-15T12:00:00Z') == ['late']
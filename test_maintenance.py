@@ -0,0 +1,38 @@
+"""Testes do CLI de manutenção (maintenance.py)"""
+
+import argparse
+
+import maintenance
+from leases import lease_deadline
+from storage import SQLiteStorage, shard_for
+
+
+def test_reshard_keeps_leases(storage, tmp_path):
+    """in_flight e devolvidos mantêm lease_expires_at ao mudar de shards"""
+    a1, a2, b1 = storage.add_commands([('dev-a', 'a1'), ('dev-a', 'a2'), ('dev-b', 'b1')])
+    storage.claim('dev-a', limit=1, lease_until=lease_deadline(-1))
+    storage.claim('dev-b', limit=1, lease_until=lease_deadline(60))
+    # O lease vencido de a1 volta para pending, ainda aceitando o ack
+    assert storage.requeue_expired(lease_deadline(0), 10) == ['dev-a']
+
+    template = str(tmp_path / 'shard-{shard}of{count}.db')
+    assert maintenance.cmd_reshard(argparse.Namespace(shards=2, template=template)) == 0
+
+    def open_shard(device_id):
+        return SQLiteStorage(template.format(shard=shard_for(device_id, 2), count=2), group_commit='off')
+
+    shard_a, shard_b = open_shard('dev-a'), open_shard('dev-b')
+    try:
+        rows = {row[0]: row for row in shard_a.iter_command_rows()}
+        rows.update({row[0]: row for row in shard_b.iter_command_rows()})
+        assert sorted(rows) == [a1, a2, b1]
+        assert rows[a1][3] == 'pending' and rows[a1][6] is not None
+        assert rows[a2][3] == 'pending' and rows[a2][6] is None
+        assert rows[b1][3] == 'in_flight' and rows[b1][6] is not None
+
+        # No destino o lease vence e o devolvido ainda aceita o ack
+        assert shard_b.requeue_expired(lease_deadline(3600), 10) == ['dev-b']
+        assert shard_a.ack('dev-a', [a1]) == [a1]
+    finally:
+        shard_a.close()
+        shard_b.close()
@@ -0,0 +1,27 @@
+"""Testes das métricas por thread (metrics.py)"""
+
+import threading
+
+import metrics
+
+
+def test_finished_threads_are_retired_without_losing_counts():
+    before, _ = metrics.snapshot()
+    key = ('device_api_test_total', ())
+
+    def work():
+        metrics.inc('device_api_test_total')
+        metrics.observe('device_api_test_seconds', (), 0.01)
+
+    for _ in range(500):
+        thread = threading.Thread(target=work)
+        thread.start()
+        thread.join()
+
+    # Os shards das threads encerradas são descartados enquanto elas nascem
+    assert len(metrics._shards) < 100
+
+    counters, histograms = metrics.snapshot()
+    assert counters[key] - before.get(key, 0) == 500
+    assert histograms[('device_api_test_seconds', ())][-1] >= 500
+    assert all(shard.thread.is_alive() for shard in metrics._shards)
@@ -0,0 +1,83 @@
+"""Testes das migrações de schema (storage.migrate)"""
+
+import sqlite3
+import subprocess
+import sys
+import time
+
+import pytest
+
+from storage import MIGRATIONS, SQLiteStorage
+
+INIT = '''
+import sys, time
+from storage import SQLiteStorage
+time.sleep(max(float(sys.argv[2]) - time.time(), 0))
+storage = SQLiteStorage(sys.argv[1], group_commit='off')
+storage.init()
+storage.close()
+'''
+
+
+def legacy_database(path):
+    """Banco na versão 3: sem a coluna lease_expires_at"""
+    conn = sqlite3.connect(path)
+    conn.executescript('''
+        CREATE TABLE device_commands (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            device_id TEXT NOT NULL,
+            command TEXT NOT NULL,
+            status TEXT DEFAULT 'pending',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            executed_at TIMESTAMP NULL
+        );
+        PRAGMA user_version = 3;
+    ''')
+    conn.close()
+
+
+def schema(path):
+    conn = sqlite3.connect(path)
+    try:
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(device_commands)')]
+        return version, columns
+    finally:
+        conn.close()
+
+
+@pytest.mark.parametrize('legacy', [True, False])
+def test_workers_migrate_the_same_file_at_once(tmp_path, legacy):
+    for run in range(5):
+        path = str(tmp_path / f'api-{run}.db')
+        if legacy:
+            legacy_database(path)
+
+        start_at = str(time.time() + 0.5)
+        workers = [subprocess.Popen([sys.executable, '-c', INIT, path, start_at],
+                                    stderr=subprocess.PIPE, text=True)
+                   for _ in range(4)]
+        errors = [worker.communicate()[1] for worker in workers]
+
+        assert [worker.returncode for worker in workers] == [0] * 4, errors
+        version, columns = schema(path)
+        assert version == len(MIGRATIONS)
+        assert columns.count('lease_expires_at') == 1
+
+
+def test_column_added_outside_migrations_is_kept(tmp_path):
+    path = str(tmp_path / 'api.db')
+    legacy_database(path)
+    conn = sqlite3.connect(path)
+    conn.execute('ALTER TABLE device_commands ADD COLUMN lease_expires_at TIMESTAMP NULL')
+    conn.commit()
+    conn.close()
+
+    storage = SQLiteStorage(path, group_commit='off')
+    try:
+        storage.init()
+    finally:
+        storage.close()
+    version, columns = schema(path)
+    assert version == len(MIGRATIONS)
+    assert columns.count('lease_expires_at') == 1
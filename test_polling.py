@@ -0,0 +1,36 @@
+"""Testes do next_poll (polling.py)"""
+
+import polling
+from presence import presence
+
+
+def overloaded(monkeypatch):
+    """Carga máxima sem depender do pool real"""
+    monkeypatch.setattr(polling.hints, 'load', lambda: 1.0)
+
+
+def test_warmup_is_off_by_default():
+    assert polling.POLL_WARMUP == 0
+    assert polling.PollHints().measure_load() < 1.0
+
+
+def test_delivered_device_is_never_spaced_by_load(storage, monkeypatch):
+    overloaded(monkeypatch)
+    hint = polling.hints.next_poll('poll-busy', delivered=True)
+    assert hint <= polling.POLL_INTERVAL_MIN * (1 + polling.POLL_JITTER)
+
+
+def test_device_with_pending_rows_is_never_spaced_by_load(storage, monkeypatch):
+    overloaded(monkeypatch)
+    storage.add_commands([('poll-pending', 'cmd')])
+    presence.mark('poll-pending')
+    assert presence.token('poll-pending') is not None
+
+    hint = polling.hints.next_poll('poll-pending', delivered=False)
+    assert hint <= polling.POLL_INTERVAL_MIN * (1 + polling.POLL_JITTER)
+
+
+def test_idle_device_is_spaced_by_load(storage, monkeypatch):
+    overloaded(monkeypatch)
+    hint = polling.hints.next_poll('poll-idle', delivered=False)
+    assert hint > polling.POLL_INTERVAL * (1 - polling.POLL_JITTER)
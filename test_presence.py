@@ -0,0 +1,54 @@
+"""Testes do índice de presença (presence.py)"""
+
+from leases import lease_deadline, lease_now
+from notifications import notifier
+from presence import PresenceIndex
+
+
+def test_requeue_reaches_other_workers(storage):
+    """Dois índices sobre o mesmo banco, como dois workers do gunicorn"""
+    leader, follower = PresenceIndex(), PresenceIndex()
+    leader._storage = follower._storage = storage
+    leader.enabled = follower.enabled = True
+
+    storage.add_commands([('presence-dev', 'cmd')])
+    assert storage.claim('presence-dev', 1, lease_deadline(-1))
+
+    # Com o comando in_flight a reconstrução mantém o device marcado
+    follower.rebuild()
+    assert follower.token('presence-dev') is not None
+
+    # Mesmo sem a marcação (índice construído antes do claim e desmarcado
+    # por um claim vazio) a devolução traz o device de volta
+    follower.discard('presence-dev', follower.token('presence-dev'))
+    assert follower.token('presence-dev') is None
+
+    with notifier.subscribe('presence-dev') as event:
+        assert storage.requeue_expired(lease_now(), 10) == ['presence-dev']
+        follower.reconcile()
+        assert follower.token('presence-dev') is not None
+        assert event.is_set()
+
+
+def test_requeue_wakes_long_polls_of_marked_devices(storage):
+    follower = PresenceIndex()
+    follower._storage = storage
+    follower.enabled = True
+
+    storage.add_commands([('presence-lp', 'cmd')])
+    assert storage.claim('presence-lp', 1, lease_deadline(-1))
+    follower.rebuild()
+    assert follower.token('presence-lp') is not None
+
+    with notifier.subscribe('presence-lp') as event:
+        follower.reconcile()
+        assert not event.is_set()
+
+        storage.requeue_expired(lease_now(), 10)
+        follower.reconcile()
+        assert event.is_set()
+
+    # A mesma devolução não é vista duas vezes
+    with notifier.subscribe('presence-lp') as event:
+        follower.reconcile()
+        assert not event.is_set()
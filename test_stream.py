@@ -0,0 +1,66 @@
+"""Testes do stream SSE de comandos (/api/device/<device_id>/stream)"""
+
+import json
+
+
+def test_stream_sends_command_as_single_line_json(client, storage):
+    command = 'ação\nlinha 2 "aspas"'
+    [command_id] = storage.add_commands([('sse-dev', command)])
+
+    response = client.get('/api/device/sse-dev/stream', buffered=False)
+    try:
+        events = iter(response.response)
+        assert next(events).startswith(b'retry:')
+        event = next(events)
+    finally:
+        response.close()
+
+    lines = event.decode('utf-8').split('\n')
+    assert lines[0] == f'id: {command_id}'
+    assert lines[1] == 'event: command'
+    assert lines[3:] == ['', '']
+    data = json.loads(lines[2][len('data: '):])
+    assert data['id'] == command_id
+    assert data['command'] == command
+
+
+def replayed(client, device_id, last_event_id):
+    """Ids reenviados ao reconectar com Last-Event-ID"""
+    response = client.get(f'/api/device/{device_id}/stream', buffered=False,
+                          headers={'Last-Event-ID': str(last_event_id)})
+    ids = []
+    try:
+        events = iter(response.response)
+        next(events)
+        for event in events:
+            if not event.startswith(b'id: '):
+                break
+            ids.append(int(event.split(b'\n', 1)[0][4:]))
+    finally:
+        response.close()
+    return ids
+
+
+def test_replay_is_capped(client, storage, monkeypatch):
+    import app
+    monkeypatch.setattr(app, 'STREAM_REPLAY_LIMIT', 3)
+    monkeypatch.setattr(app, 'STREAM_HEARTBEAT', 0.05)
+
+    ids = storage.add_commands([('sse-replay', f'cmd-{n}') for n in range(5)])
+    assert len(storage.claim('sse-replay', limit=5)) == 5
+
+    assert replayed(client, 'sse-replay', 0) == ids[:3]
+    assert replayed(client, 'sse-replay', ids[2]) == ids[3:]
+
+
+def test_replay_skips_commands_outside_the_window(client, storage, monkeypatch):
+    import app
+    monkeypatch.setattr(app, 'STREAM_HEARTBEAT', 0.05)
+
+    old, recent = storage.add_commands([('sse-window', 'old'), ('sse-window', 'recent')])
+    storage.claim('sse-window', limit=2)
+    with storage.connection() as conn:
+        conn.execute("UPDATE device_commands SET executed_at = '2024-01-15 10:00:00' WHERE id = ?", (old,))
+        conn.commit()
+
+    assert replayed(client, 'sse-window', 0) == [recent]
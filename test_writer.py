@@ -0,0 +1,32 @@
+"""Testes do group commit (writer.py)"""
+
+import pytest
+
+from database import ConnectionPool
+from writer import GroupCommitWriter
+
+FULL = 2
+
+
+def synchronous(cursor):
+    return cursor.execute('PRAGMA synchronous').fetchone()[0]
+
+
+@pytest.mark.parametrize('mode', ['durable', 'relaxed'])
+def test_durable_mode_fsyncs_each_batch(tmp_path, mode):
+    pool = ConnectionPool(str(tmp_path / 'writer.db'), size=1)
+    with pool.connection() as conn:
+        default = synchronous(conn.cursor())
+    expected = FULL if mode == 'durable' else default
+
+    writer = GroupCommitWriter(pool, mode)
+    writer.start()
+    try:
+        assert writer.submit(synchronous) == expected
+    finally:
+        writer.stop()
+
+    # A conexão volta ao pool com o pragma de sempre
+    with pool.connection() as conn:
+        assert synchronous(conn.cursor()) == default
+    pool.close()
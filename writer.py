@@ -0,0 +1,164 @@
+"""
+Group commit para escritas no SQLite
+
+Uma única thread escritora recebe as escritas de todas as threads de
+requisição e as grava em uma só transação a cada GROUP_COMMIT_INTERVAL_MS
+ou a cada GROUP_COMMIT_MAX_BATCH operações, dividindo um commit (e seu
+fsync) entre muitas escritas.
+
+Modos (GROUP_COMMIT):
+- off: cada escrita faz seu próprio commit (padrão)
+- durable: quem escreve aguarda o commit do lote. A conexão da thread
+  escritora usa synchronous=FULL: em WAL com NORMAL (DB_SYNCHRONOUS
+  padrão) o commit não faz fsync e uma queda de energia ainda o desfaz
+- relaxed: quem escreve recebe o resultado assim que a operação executa,
+  sem aguardar o commit (uma queda pode perder o último lote)
+"""
+
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+GROUP_COMMIT = os.environ.get('GROUP_COMMIT', 'off')
+GROUP_COMMIT_INTERVAL_MS = float(os.environ.get('GROUP_COMMIT_INTERVAL_MS', '2'))
+GROUP_COMMIT_MAX_BATCH = int(os.environ.get('GROUP_COMMIT_MAX_BATCH', '512'))
+
+GROUP_COMMIT_MODES = ('off', 'durable', 'relaxed')
+
+# Sinaliza para a thread escritora que deve encerrar
+_STOP = object()
+
+
+class GroupCommitWriter:
+    """Thread escritora que agrupa operações em uma única transação"""
+
+    def __init__(self, pool, mode=None, interval_ms=None, max_batch=None):
+        self.pool = pool
+        self.mode = mode or GROUP_COMMIT
+        self.interval = (GROUP_COMMIT_INTERVAL_MS if interval_ms is None else interval_ms) / 1000
+        self.max_batch = max_batch or GROUP_COMMIT_MAX_BATCH
+        self._queue = queue.Queue()
+        self._thread = None
+        self.batches = 0
+        self.operations = 0
+
+        if self.mode not in ('durable', 'relaxed'):
+            raise ValueError(f"Modo de group commit inválido: {self.mode}")
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='group-commit-writer', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Grava o que estiver na fila e encerra a thread"""
+        if self._thread is not None:
+            self._queue.put(_STOP)
+            self._thread.join()
+            self._thread = None
+
+    def submit(self, operation):
+        """
+        Enfileira operation(cursor) e retorna seu resultado
+
+        Exceções levantadas pela operação são repassadas para quem chamou;
+        as demais operações do lote não são afetadas.
+        """
+        if self._thread is None:
+            raise RuntimeError("Group commit writer não está em execução")
+
+        future = Future()
+        self._queue.put((operation, future))
+        return future.result()
+
+    def _next_batch(self):
+        """Aguarda a primeira operação e junta as que chegarem na janela"""
+        first = self._queue.get()
+        if first is _STOP:
+            return None, True
+
+        batch = [first]
+        deadline = time.monotonic() + self.interval
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is _STOP:
+                return batch, True
+            batch.append(item)
+
+        return batch, False
+
+    def _run(self):
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+
+            # Só a conexão da escritora: as leituras seguem com o pragma do pool
+            synchronous = cursor.execute('PRAGMA synchronous').fetchone()[0]
+            if self.mode == 'durable':
+                cursor.execute('PRAGMA synchronous = FULL')
+
+            try:
+                while True:
+                    batch, stop = self._next_batch()
+                    if batch:
+                        self._write_batch(conn, cursor, batch)
+                    if stop:
+                        break
+            finally:
+                cursor.execute(f'PRAGMA synchronous = {synchronous}')
+
+    def _write_batch(self, conn, cursor, batch):
+        done = []
+
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+
+            for operation, future in batch:
+                # Savepoint por operação: uma falha não desfaz o lote
+                cursor.execute('SAVEPOINT group_write')
+                try:
+                    result = operation(cursor)
+                except Exception as e:
+                    cursor.execute('ROLLBACK TO group_write')
+                    cursor.execute('RELEASE group_write')
+                    future.set_exception(e)
+                    continue
+
+                cursor.execute('RELEASE group_write')
+                if self.mode == 'relaxed':
+                    future.set_result(result)
+                else:
+                    done.append((future, result))
+
+            conn.commit()
+
+        except Exception as e:
+            if conn.in_transaction:
+                conn.rollback()
+            for future, _ in done:
+                future.set_exception(e)
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            if self.mode == 'relaxed':
+                print(f"❌ Erro no commit do lote em modo relaxed: {e}")
+            return
+
+        for future, result in done:
+            future.set_result(result)
+
+        self.batches += 1
+        self.operations += len(batch)
+
+    def stats(self):
+        """Lotes gravados, operações e tamanho atual da fila"""
+        return {
+            'mode': self.mode,
+            'batches': self.batches,
+            'operations': self.operations,
+            'queued': self._queue.qsize()
+        }